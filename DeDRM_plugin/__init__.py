@@ -238,84 +238,73 @@ class DeDRM(FileTypePlugin):
             traceback.print_exc()
             raise
 
+    def postProcessStages(self):
+        # Returns the EPUB pipeline stages for the post-processing that is
+        # enabled in the settings, like de-obfuscating fonts or removing
+        # watermarks. They run in the same pass that removes the DRM.
+        import prefs
+        import epubpipeline
+        return epubpipeline.postProcessStages(prefs.DeDRM_Prefs())
+
+    def checkEPUBResult(self, result):
+        # ineptepub.decryptBook returns 3 if the key was right, but one of
+        # the post-processing stages (or writing the book) failed. Trying
+        # the other keys won't help, so stop with the error it printed.
+        if result == 3:
+            raise DeDRMError("{0} v{1}: Decrypted the book, but post-processing it failed after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
+
     def postProcessEPUB(self, path_to_ebook):
-        # This is called after the DRM is removed (or if no DRM was present)
-        # It does stuff like de-obfuscating fonts (by calling checkFonts) 
-        # or removing watermarks. 
+        # This is called for books where the DRM isn't removed by ineptepub
+        # (LCP or no DRM at all). It runs the post-processing stages and
+        # rewrites the book once.
 
         postProcessStart = time.time()
 
         try: 
-            import prefs
-            dedrmprefs = prefs.DeDRM_Prefs()
-
-            if dedrmprefs["deobfuscate_fonts"] is True:
-                # Deobfuscate fonts
-                path_to_ebook = self.checkFonts(path_to_ebook) or path_to_ebook
-
-            if dedrmprefs["remove_watermarks"] is True:
-                import epubwatermark as watermark
-
-                # Remove Tolino's CDP watermark file
-                path_to_ebook = watermark.removeCDPwatermark(self, path_to_ebook) or path_to_ebook
+            import epubpipeline
 
-                # Remove watermarks (Amazon or LemonInk) from the OPF file
-                path_to_ebook = watermark.removeOPFwatermarks(self, path_to_ebook) or path_to_ebook
-
-                # Remove watermarks (Adobe, Pocketbook or LemonInk) from all HTML and XHTML files
-                path_to_ebook = watermark.removeHTMLwatermarks(self, path_to_ebook) or path_to_ebook
+            stages = self.postProcessStages()
+            if len(stages) == 0:
+                return path_to_ebook
+            output = self.temporary_file(".epub").name
+            modified = epubpipeline.processBook(path_to_ebook, output, stages)
 
-            
-            
             postProcessEnd = time.time()
             print("{0} v{1}: Post-processing took {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, postProcessEnd-postProcessStart))
 
-            return path_to_ebook
-
-        except: 
-            print("Error while checking settings")
-            return path_to_ebook
-
-    def checkFonts(self, path_to_ebook):
-        # This is called after the normal DRM removal is done. 
-        # It checks if there's fonts that need to be deobfuscated
-
-        try: 
-            import epubfontdecrypt
-
-            output = self.temporary_file(".epub").name
-            ret = epubfontdecrypt.decryptFontsBook(path_to_ebook, output)
-
-            if (ret == 0):
-                return output
-            elif (ret == 1):
+            if not modified:
+                # nothing to remove, keep the book as it was
                 return path_to_ebook
-            else:
-                print("{0} v{1}: Error during font deobfuscation".format(PLUGIN_NAME, PLUGIN_VERSION))
-                raise DeDRMError("Font deobfuscation failed")
- 
+            return output
+
         except: 
-            print("{0} v{1}: Error during font deobfuscation".format(PLUGIN_NAME, PLUGIN_VERSION))
+            print("{0} v{1}: Error during post-processing".format(PLUGIN_NAME, PLUGIN_VERSION))
             traceback.print_exc()
             return path_to_ebook
 
     def ePubDecrypt(self,path_to_ebook):
-        # Create a TemporaryPersistent file to work with.
         # Check original epub archive for zip errors.
+        # Only if it's broken, fix it into a TemporaryPersistent file up front.
+        # Otherwise the output gets repaired in the same pass that removes the DRM.
         import zipfix
 
-        inf = self.temporary_file(".epub")
-        try:
-            print("{0} v{1}: Verifying zip archive integrity".format(PLUGIN_NAME, PLUGIN_VERSION))
-            fr = zipfix.fixZip(path_to_ebook, inf.name)
-            fr.fix()
-        except Exception as e:
-            print("{0} v{1}: Error \'{2}\' when checking zip archive".format(PLUGIN_NAME, PLUGIN_VERSION, e.args[0]))
-            raise
+        inpath = path_to_ebook
+        print("{0} v{1}: Verifying zip archive integrity".format(PLUGIN_NAME, PLUGIN_VERSION))
+        if zipfix.needsRepair(path_to_ebook):
+            inf = self.temporary_file(".epub")
+            try:
+                fr = zipfix.fixZip(path_to_ebook, inf.name)
+                fr.fix()
+            except Exception as e:
+                print("{0} v{1}: Error \'{2}\' when checking zip archive".format(PLUGIN_NAME, PLUGIN_VERSION, e.args[0]))
+                raise
+            inpath = inf.name
 
         # import the decryption keys
         import prefs
+        import keyaffinity
         dedrmprefs = prefs.DeDRM_Prefs()
+        affinity = keyaffinity.DeDRM_KeyAffinity()
 
 
         # import the LCP handler
@@ -336,20 +325,33 @@ class DeDRM(FileTypePlugin):
         # import the Adobe ePub handler
         import ineptepub
 
-        if ineptepub.adeptBook(inf.name):
+        if ineptepub.adeptBook(inpath):
+
+            # Parse the license once so we only need to do the (slow) full
+            # decryption with a key that actually unwraps the book key.
+            try:
+                keymatcher = ineptepub.BookKeyMatcher(inpath)
+            except:
+                print("{0} v{1}: Exception when reading book license, will try keys the slow way".format(PLUGIN_NAME, PLUGIN_VERSION))
+                traceback.print_exc()
+                keymatcher = None
 
-            if ineptepub.isPassHashBook(inf.name): 
+            if ineptepub.isPassHashBook(inpath): 
                 # This is an Adobe PassHash / B&N encrypted eBook
                 print("{0} v{1}: “{2}” is a secure PassHash-protected (B&N) ePub".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook)))
 
-                # Attempt to decrypt epub with each encryption key (generated or provided).
-                for keyname, userkey in dedrmprefs['bandnkeys'].items():
+                # Attempt to decrypt epub with each encryption key (generated or provided),
+                # starting with the ones that decrypted most other books.
+                for keyname, userkey in affinity.order("epub-passhash", dedrmprefs['bandnkeys'].items()):
                     print("{0} v{1}: Trying Encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
+                    if keymatcher is not None and not keymatcher.check(userkey):
+                        print("{0} v{1}: Key {2:s} does not match this book".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
+                        continue
                     of = self.temporary_file(".epub")
 
                     # Give the user key, ebook and TemporaryPersistent file to the decryption function.
                     try:
-                        result = ineptepub.decryptBook(userkey, inf.name, of.name)
+                        result = ineptepub.decryptBook(userkey, inpath, of.name, self.postProcessStages())
                     except:
                         print("{0} v{1}: Exception when trying to decrypt after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
                         traceback.print_exc()
@@ -357,10 +359,13 @@ class DeDRM(FileTypePlugin):
 
                     of.close()
 
+                    self.checkEPUBResult(result)
+
                     if  result == 0:
                         # Decryption was successful.
                         # Return the modified PersistentTemporary file to calibre.
-                        return self.postProcessEPUB(of.name)
+                        affinity.record("epub-passhash", keyname)
+                        return of.name
 
                     print("{0} v{1}: Failed to decrypt with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
 
@@ -447,12 +452,15 @@ class DeDRM(FileTypePlugin):
                                 continue
 
                             print("{0} v{1}: Trying a new default key".format(PLUGIN_NAME, PLUGIN_VERSION))
+                            if keymatcher is not None and not keymatcher.check(userkey):
+                                print("{0} v{1}: New default key does not match this book".format(PLUGIN_NAME, PLUGIN_VERSION))
+                                continue
 
                             of = self.temporary_file(".epub")
 
                             # Give the user key, ebook and TemporaryPersistent file to the decryption function.
                             try:
-                                result = ineptepub.decryptBook(userkey, inf.name, of.name)
+                                result = ineptepub.decryptBook(userkey, inpath, of.name, self.postProcessStages())
                             except:
                                 print("{0} v{1}: Exception when trying to decrypt after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
                                 traceback.print_exc()
@@ -460,6 +468,8 @@ class DeDRM(FileTypePlugin):
 
                             of.close()
 
+                            self.checkEPUBResult(result)
+
                             if result == 0:
                                 # Decryption was a success
                                 # Store the new successful key in the defaults
@@ -475,16 +485,16 @@ class DeDRM(FileTypePlugin):
                                     print("{0} v{1}: Exception saving a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
                                     traceback.print_exc()
                                 # Return the modified PersistentTemporary file to calibre.
-                                return self.postProcessEPUB(of.name)
+                                return of.name
 
                             print("{0} v{1}: Failed to decrypt with new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
-                            return inf.name
+                            return inpath
                     
                     except:
                         pass
 
                 # Looks like we were unable to decrypt the book ...
-                return inf.name
+                return inpath
 
             else: 
                 # This is a "normal" Adobe eBook.
@@ -494,7 +504,7 @@ class DeDRM(FileTypePlugin):
                     # This tries to figure out which Adobe account UUID the book is licensed for. 
                     # If we know that we can directly use the correct key instead of having to
                     # try them all.
-                    book_uuid = ineptepub.adeptGetUserUUID(inf.name)
+                    book_uuid = ineptepub.adeptGetUserUUID(inpath)
                 except: 
                     pass
 
@@ -513,13 +523,13 @@ class DeDRM(FileTypePlugin):
                         # Found matching key
                         userkey = codecs.decode(userkeyhex, 'hex')
                         print("{0} v{1}: Trying UUID-matched encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
+                        if keymatcher is not None and not keymatcher.check(userkey):
+                            print("{0} v{1}: Key {2:s} does not match this book".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
+                            continue
                         of = self.temporary_file(".epub")
                         try: 
-                            result = ineptepub.decryptBook(userkey, inf.name, of.name)
+                            result = ineptepub.decryptBook(userkey, inpath, of.name, self.postProcessStages())
                             of.close()
-                            if result == 0:
-                                print("{0} v{1}: Decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
-                                return self.postProcessEPUB(of.name)
                         except ineptepub.ADEPTNewVersionError:
                             print("{0} v{1}: Book uses unsupported (too new) Adobe DRM.".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
                             return self.postProcessEPUB(path_to_ebook)
@@ -527,17 +537,28 @@ class DeDRM(FileTypePlugin):
                         except:
                             print("{0} v{1}: Exception when decrypting after {2:.1f} seconds - trying other keys".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
                             traceback.print_exc()
+                            result = 1
 
+                        self.checkEPUBResult(result)
+                        if result == 0:
+                            print("{0} v{1}: Decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
+                            affinity.record("epub-adept", keyname, book_uuid)
+                            return of.name
 
-                # Attempt to decrypt epub with each encryption key (generated or provided).
-                for keyname, userkeyhex in dedrmprefs['adeptkeys'].items():
+
+                # Attempt to decrypt epub with each encryption key (generated or provided),
+                # starting with the one that decrypted other books for this UUID.
+                for keyname, userkeyhex in affinity.order("epub-adept", dedrmprefs['adeptkeys'].items(), book_uuid):
                     userkey = codecs.decode(userkeyhex, 'hex')
                     print("{0} v{1}: Trying Encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
+                    if keymatcher is not None and not keymatcher.check(userkey):
+                        print("{0} v{1}: Key {2:s} does not match this book".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
+                        continue
                     of = self.temporary_file(".epub")
 
                     # Give the user key, ebook and TemporaryPersistent file to the decryption function.
                     try:
-                        result = ineptepub.decryptBook(userkey, inf.name, of.name)
+                        result = ineptepub.decryptBook(userkey, inpath, of.name, self.postProcessStages())
                     except ineptepub.ADEPTNewVersionError:
                         print("{0} v{1}: Book uses unsupported (too new) Adobe DRM.".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
                         return self.postProcessEPUB(path_to_ebook)
@@ -551,11 +572,14 @@ class DeDRM(FileTypePlugin):
                     except:
                         print("{0} v{1}: Exception closing temporary file after {2:.1f} seconds. Ignored.".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
 
+                    self.checkEPUBResult(result)
+
                     if  result == 0:
                         # Decryption was successful.
                         # Return the modified PersistentTemporary file to calibre.
                         print("{0} v{1}: Decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
-                        return self.postProcessEPUB(of.name)
+                        affinity.record("epub-adept", keyname, book_uuid)
+                        return of.name
 
                     print("{0} v{1}: Failed to decrypt with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
 
@@ -608,11 +632,14 @@ class DeDRM(FileTypePlugin):
                     try:
                         for i,userkey in enumerate(newkeys):
                             print("{0} v{1}: Trying a new default key".format(PLUGIN_NAME, PLUGIN_VERSION))
+                            if keymatcher is not None and not keymatcher.check(userkey):
+                                print("{0} v{1}: New default key does not match this book".format(PLUGIN_NAME, PLUGIN_VERSION))
+                                continue
                             of = self.temporary_file(".epub")
 
                             # Give the user key, ebook and TemporaryPersistent file to the decryption function.
                             try:
-                                result = ineptepub.decryptBook(userkey, inf.name, of.name)
+                                result = ineptepub.decryptBook(userkey, inpath, of.name, self.postProcessStages())
                             except:
                                 print("{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
                                 traceback.print_exc()
@@ -620,6 +647,8 @@ class DeDRM(FileTypePlugin):
 
                             of.close()
 
+                            self.checkEPUBResult(result)
+
                             if  result == 0:
                                 # Decryption was a success
                                 # Store the new successful key in the defaults
@@ -633,7 +662,7 @@ class DeDRM(FileTypePlugin):
                                     traceback.print_exc()
                                 print("{0} v{1}: Decrypted with new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
                                 # Return the modified PersistentTemporary file to calibre.
-                                return self.postProcessEPUB(of.name)
+                                return of.name
 
                             print("{0} v{1}: Failed to decrypt with new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
                     except Exception as e:
@@ -649,14 +678,16 @@ class DeDRM(FileTypePlugin):
 
         # Not a Barnes & Noble nor an Adobe Adept
         # Probably a DRM-free EPUB, but we should still check for fonts.
-        return self.postProcessEPUB(inf.name)
+        return self.postProcessEPUB(inpath)
 
     
     def PDFIneptDecrypt(self, path_to_ebook):
         # Sub function to prevent PDFDecrypt from becoming too large ...
         import prefs
+        import keyaffinity
         import ineptpdf
         dedrmprefs = prefs.DeDRM_Prefs()
+        affinity = keyaffinity.DeDRM_KeyAffinity()
 
         book_uuid = None
         try: 
@@ -682,6 +713,7 @@ class DeDRM(FileTypePlugin):
                     of.close()
                     if result == 0:
                         print("{0} v{1}: Decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
+                        affinity.record("pdf-adept", keyname, book_uuid)
                         return of.name
                        
                 except ineptpdf.ADEPTNewVersionError:
@@ -694,8 +726,9 @@ class DeDRM(FileTypePlugin):
 
         # If we end up here, we didn't find a key with a matching UUID, so lets just try all of them.
 
-        # Attempt to decrypt PDF with each encryption key (generated or provided).        
-        for keyname, userkeyhex in dedrmprefs['adeptkeys'].items():
+        # Attempt to decrypt PDF with each encryption key (generated or provided),
+        # starting with the one that decrypted other books for this UUID.
+        for keyname, userkeyhex in affinity.order("pdf-adept", dedrmprefs['adeptkeys'].items(), book_uuid):
             userkey = codecs.decode(userkeyhex,'hex')
             print("{0} v{1}: Trying encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
             of = self.temporary_file(".pdf")
@@ -717,6 +750,7 @@ class DeDRM(FileTypePlugin):
                 # Decryption was successful.
                 # Return the modified PersistentTemporary file to calibre.
                 print("{0} v{1}: Decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
+                affinity.record("pdf-adept", keyname, book_uuid)
                 return of.name
 
             print("{0} v{1}: Failed to decrypt with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
@@ -802,7 +836,7 @@ class DeDRM(FileTypePlugin):
 
         # Unable to decrypt the PDF with any of the existing keys. Is it a B&N PDF?
         # Attempt to decrypt PDF with each encryption key (generated or provided).        
-        for keyname, userkey in dedrmprefs['bandnkeys'].items():
+        for keyname, userkey in affinity.order("pdf-passhash", dedrmprefs['bandnkeys'].items()):
             print("{0} v{1}: Trying Encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
             of = self.temporary_file(".pdf")
 
@@ -823,6 +857,7 @@ class DeDRM(FileTypePlugin):
                 # Decryption was successful.
                 # Return the modified PersistentTemporary file to calibre.
                 print("{0} v{1}: Decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
+                affinity.record("pdf-passhash", keyname)
                 return of.name
 
             print("{0} v{1}: Failed to decrypt with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
@@ -922,9 +957,11 @@ class DeDRM(FileTypePlugin):
         # extracted to the appropriate places beforehand these routines
         # look for them.
         import prefs
+        import keyaffinity
         import k4mobidedrm
 
         dedrmprefs = prefs.DeDRM_Prefs()
+        affinity = keyaffinity.DeDRM_KeyAffinity()
         pids = dedrmprefs['pids']
         serials = dedrmprefs['serials']
         for android_serials_list in dedrmprefs['androidkeys'].values():
@@ -934,8 +971,12 @@ class DeDRM(FileTypePlugin):
         androidFiles = []
         kindleDatabases = list(dedrmprefs['kindlekeys'].items())
 
+        # Try the PID that worked for this book (or for most other books) first.
+        def pidorder(md1, md2, totalpids):
+            return affinity.order("kindle", totalpids, keyaffinity.kindlebookid(md1, md2), keyaffinity.pidkeyid)
+
         try:
-            book = k4mobidedrm.GetDecryptedBook(path_to_ebook,kindleDatabases,androidFiles,serials,pids,self.starttime)
+            book = k4mobidedrm.GetDecryptedBook(path_to_ebook,kindleDatabases,androidFiles,serials,pids,self.starttime,pidorder)
         except Exception as e:
             decoded = False
             # perhaps we need to get a new default Kindle for Mac/PC key
@@ -987,6 +1028,9 @@ class DeDRM(FileTypePlugin):
                 print("{0} v{1}: Ultimately failed to decrypt after {2:.1f} seconds. Read the FAQs at noDRM's repository: https://github.com/noDRM/DeDRM_tools/blob/master/FAQs.md".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
                 raise DeDRMError("{0} v{1}: Ultimately failed to decrypt after {2:.1f} seconds. Read the FAQs at noDRM's repository: https://github.com/noDRM/DeDRM_tools/blob/master/FAQs.md".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
 
+        if book.pid is not None:
+            affinity.record("kindle", keyaffinity.pidkeyid(book.pid), keyaffinity.kindlebookid(*book.getPIDMetaInfo()))
+
         of = self.temporary_file(book.getBookExtension())
         book.getFile(of.name)
         of.close()
@@ -997,11 +1041,13 @@ class DeDRM(FileTypePlugin):
     def eReaderDecrypt(self,path_to_ebook):
 
         import prefs
+        import keyaffinity
         import erdr2pml
 
         dedrmprefs = prefs.DeDRM_Prefs()
+        affinity = keyaffinity.DeDRM_KeyAffinity()
         # Attempt to decrypt epub with each encryption key (generated or provided).
-        for keyname, userkey in dedrmprefs['ereaderkeys'].items():
+        for keyname, userkey in affinity.order("ereader", dedrmprefs['ereaderkeys'].items()):
             print("{0} v{1}: Trying Encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
             of = self.temporary_file(".pmlz")
 
@@ -1014,6 +1060,7 @@ class DeDRM(FileTypePlugin):
             # file to Calibre's import process.
             if  result == 0:
                 print("{0} v{1}: Successfully decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
+                affinity.record("ereader", keyname)
                 return of.name
 
             print("{0} v{1}: Failed to decrypt with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
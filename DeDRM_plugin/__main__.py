@@ -20,4 +20,7 @@ Run DeDRM plugin without Calibre.
 import standalone.__init__ as mdata
 import sys
 
-mdata.main(sys.argv)
\ No newline at end of file
+# remove_drm --jobs starts worker processes that import this file again,
+# so only run the CLI when executed as the main module.
+if __name__ == "__main__":
+    mdata.main(sys.argv)
@@ -13,6 +13,193 @@ import hmac
 from struct import pack
 import hashlib
 
+# Table driven Python implementation of the Pukall Cipher 1
+#
+# In the original algorithm every byte runs an 8 step key schedule over
+# wkey[0..7], and afterwards every wkey[j] gets XORed with the same value
+# (curByte * 257). So for each byte wkey[j] = key[j] ^ (x * 257), where x
+# is the XOR of all plaintext bytes so far, and everything the schedule
+# computes from wkey (temp1, sum1) only depends on x. Only sum2 depends
+# on the earlier bytes, and it only goes through multiplications by 20021
+# and additions modulo 0x10000. With
+#   s = sum2 + sum1 * inverse(20021)
+# the 8 intermediate sum2 values are s * 20021**(j+1) + D[x][j], which we
+# compute at once for all j with one multiplication of packed 32 bit lanes.
+
+_PC1_MASK = 0xFFFF
+_PC1_INV = 0x141D    # 20021 * 0x141D == 1 (mod 0x10000)
+_PC1_LANES = sum(pow(20021, j + 1, 0x10000) << (32 * j) for j in range(8))
+_PC1_LOW16 = sum(_PC1_MASK << (32 * j) for j in range(8))
+
+_pc1_tables = {}
+
+def _pc1_tables_for(key):
+    tables = _pc1_tables.get(key)
+    if tables is not None:
+        return tables
+
+    wkey0 = [key[i*2]<<8 | key[i*2+1] for i in range(8)]
+    tables = []
+    for x in range(256):
+        keyXorVal = x * 257
+        temp1 = 0
+        sum1 = 0
+        sum2 = 0
+        byteXorVal = 0
+        lanes = 0
+        for j in range(8):
+            temp1 ^= wkey0[j] ^ keyXorVal
+            sum2  = (sum2+j)*20021 + sum1
+            sum1  = (temp1*346)&0xFFFF
+            sum2  = (sum2+sum1)&0xFFFF
+            temp1 = (temp1*20021+1)&0xFFFF
+            byteXorVal ^= temp1
+            lanes |= sum2 << (32 * j)
+        # (sum2 lanes, the temp1 part of byteXorVal, sum1 carried to the next byte)
+        tables.append((lanes, ((byteXorVal >> 8) ^ byteXorVal) & 0xFF, (sum1 * _PC1_INV) & _PC1_MASK))
+
+    if len(_pc1_tables) >= 16:
+        _pc1_tables.clear()
+    _pc1_tables[key] = tables
+    return tables
+
+def _pc1_python(key, src, decryption=True):
+    if len(key)!=16:
+        raise Exception('Pukall_Cipher: Bad key length.')
+    if isinstance(key, str):
+        key = key.encode('latin-1')
+    if isinstance(src, str):
+        src = src.encode('latin-1')
+    tables = _pc1_tables_for(bytes(key))
+
+    lanes_mul = _PC1_LANES
+    low16 = _PC1_LOW16
+    x = 0
+    s = 0
+    i = 0
+    dst = bytearray(len(src))
+    for curByte in src:
+        lanes, xorval, carry = tables[x]
+        v = (s * lanes_mul + lanes) & low16
+        s = ((v >> 224) + carry) & 0xFFFF
+        # XOR the 8 sum2 values together
+        v ^= v >> 128
+        v ^= v >> 64
+        v ^= v >> 32
+        outByte = curByte ^ xorval ^ (((v >> 8) ^ v) & 0xFF)
+        dst[i] = outByte
+        i += 1
+        x ^= outByte if decryption else curByte
+    return bytes(dst)
+
+
+def benchmark_pc1(size=1000000, records=4096):
+    # Compares the PC1 implementations on random data, split into
+    # records like the text records of a Mobipocket book.
+    import time
+    import mobidedrm
+
+    key = os.urandom(16)
+    data = [os.urandom(records) for i in range(max(1, size // records))]
+
+    backends = [("python (table driven)", _pc1_python),
+                ("python (reference)", mobidedrm.PC1_reference)]
+    try:
+        lib = _load_libalfcrypto()[1]()
+        backends.insert(0, ("libalfcrypto", lib.PC1))
+    except Exception as e:
+        print("libalfcrypto not available: {0}".format(e))
+
+    expected = None
+    for name, func in backends:
+        start = time.time()
+        result = [func(key, record) for record in data]
+        elapsed = time.time() - start
+        if expected is None:
+            expected = result
+        status = "ok" if result == expected else "MISMATCH"
+        print("{0:<24s} {1:8.3f} s  {2:8.2f} MB/s  {3}".format(name, elapsed, len(data) * records / max(elapsed, 1e-9) / 1e6, status))
+
+
+# Table driven Python implementation of the Topaz cipher
+#
+# There's not much to precompute here, every key stream byte depends on
+# all plaintext bytes before it. But the plaintext byte only goes into the
+# state as m * m * 0x0F902007, which comes from a table, and the part of
+# the key stream byte that comes from the state before (ctx2 << 3) is kept
+# from the previous iteration instead of being shifted again.
+
+_TOPAZ_SQUARES = [(m * m * 0x0F902007) & 0xFFFFFFFF for m in range(256)]
+
+def _topaz_init(key):
+    if isinstance(key, str):
+        key = key.encode('latin-1')
+    ctx1 = 0x0CAFFE19E
+    for keyByte in key:
+        ctx2 = ctx1
+        ctx1 = ((((ctx1 >>2) * (ctx1 >>7))&0xFFFFFFFF) ^ (keyByte * keyByte * 0x0F902007)& 0xFFFFFFFF )
+    return [ctx1, ctx2]
+
+def _topaz_python(ctx, data):
+    if isinstance(data, str):
+        data = data.encode('latin-1')
+    squares = _TOPAZ_SQUARES
+    ctx1 = ctx[0]
+    prev = (ctx[1] << 3) & 0xFF
+    # output buffer of the right size, every byte gets overwritten
+    dst = bytearray(data)
+    i = 0
+    for dataByte in data:
+        m = dataByte ^ ((ctx1 >> 3) & 0xFF) ^ prev
+        prev = (ctx1 << 3) & 0xFF
+        ctx1 = (((ctx1 >> 2) * (ctx1 >> 7)) & 0xFFFFFFFF) ^ squares[m]
+        dst[i] = m
+        i += 1
+    return bytes(dst)
+
+# (key, ciphertext, plaintext), encrypted with the reference implementation
+_TOPAZ_KNOWN_ANSWERS = [
+    (b'ABCDEFGH', bytes.fromhex('5e0ecbace2ba16fb5862a5780d20ba91d492b815b2701d'), b'Topaz known answer test'),
+    (b'\x00\xff\x10\x80\x7f\x01\xfe\x33',
+     bytes.fromhex('3e8c5c57a3c4a45702d521ab9678c246175a81261e4162884cb71eb7b8b186ab49fb652f1e'),
+     bytes(range(0, 256, 7))),
+]
+
+def benchmark_topaz(size=1000000, records=4096):
+    # Checks the Topaz cipher implementations against the known answers,
+    # then compares them on random records like the pages of a book.
+    import time
+    import topazextract
+
+    def reference(key, data):
+        return topazextract.topazCryptoDecryptReference(data, topazextract.topazCryptoInitReference(key))
+
+    def table(key, data):
+        return _topaz_python(_topaz_init(key), data)
+
+    backends = [("python (table driven)", table),
+                ("python (reference)", reference)]
+    try:
+        cipher = _load_libalfcrypto()[2]()
+        backends.insert(0, ("libalfcrypto", lambda key, data: cipher.decrypt(data, cipher.ctx_init(key))))
+    except Exception as e:
+        print("libalfcrypto not available: {0}".format(e))
+
+    key = os.urandom(8)
+    data = [os.urandom(records) for i in range(max(1, size // records))]
+
+    expected = None
+    for name, func in backends:
+        known = all(func(k, ct) == pt for k, ct, pt in _TOPAZ_KNOWN_ANSWERS)
+        start = time.time()
+        result = [func(key, record) for record in data]
+        elapsed = time.time() - start
+        if expected is None:
+            expected = result
+        status = "ok" if known and result == expected else "MISMATCH"
+        print("{0:<24s} {1:8.3f} s  {2:8.2f} MB/s  {3}".format(name, elapsed, len(data) * records / max(elapsed, 1e-9) / 1e6, status))
+
+
 # interface to needed routines libalfcrypto
 def _load_libalfcrypto():
     import ctypes
@@ -130,6 +317,9 @@ def _load_libalfcrypto():
             return out.raw
 
     class Pukall_Cipher(object):
+        # The library releases the GIL, so records can be decrypted in threads.
+        native = True
+
         def __init__(self):
             self.key = None
 
@@ -154,6 +344,8 @@ def _load_libalfcrypto():
         def decrypt(self, data,  ctx=None):
             if ctx == None:
                 ctx = self._ctx
+            if not isinstance(data, bytes):
+                data = bytes(data)
             out = create_string_buffer(len(data))
             topazCryptoDecrypt(ctx, data, out, len(data))
             return out.raw
@@ -167,68 +359,27 @@ def _load_python_alfcrypto():
     import aescbc
 
     class Pukall_Cipher(object):
+        native = False
+
         def __init__(self):
             self.key = None
 
         def PC1(self, key, src, decryption=True):
-            sum1 = 0;
-            sum2 = 0;
-            keyXorVal = 0;
-            if len(key)!=16:
-                raise Exception('Pukall_Cipher: Bad key length.')
-            wkey = []
-            for i in range(8):
-                wkey.append(ord(key[i*2])<<8 | ord(key[i*2+1]))
-            dst = ""
-            for i in range(len(src)):
-                temp1 = 0;
-                byteXorVal = 0;
-                for j in range(8):
-                    temp1 ^= wkey[j]
-                    sum2  = (sum2+j)*20021 + sum1
-                    sum1  = (temp1*346)&0xFFFF
-                    sum2  = (sum2+sum1)&0xFFFF
-                    temp1 = (temp1*20021+1)&0xFFFF
-                    byteXorVal ^= temp1 ^ sum2
-                curByte = ord(src[i])
-                if not decryption:
-                    keyXorVal = curByte * 257;
-                curByte = ((curByte ^ (byteXorVal >> 8)) ^ byteXorVal) & 0xFF
-                if decryption:
-                    keyXorVal = curByte * 257;
-                for j in range(8):
-                    wkey[j] ^= keyXorVal;
-                dst+=chr(curByte)
-            return dst
+            self.key = key
+            return _pc1_python(key, src, decryption)
 
     class Topaz_Cipher(object):
         def __init__(self):
             self._ctx = None
 
         def ctx_init(self, key):
-            ctx1 = 0x0CAFFE19E
-            if isinstance(key, str):
-                key = key.encode('latin-1')
-            for keyByte in key:
-                ctx2 = ctx1
-                ctx1 = ((((ctx1 >>2) * (ctx1 >>7))&0xFFFFFFFF) ^ (keyByte * keyByte * 0x0F902007)& 0xFFFFFFFF )
-            self._ctx = [ctx1, ctx2]
-            return [ctx1,ctx2]
+            self._ctx = _topaz_init(key)
+            return self._ctx
 
         def decrypt(self, data,  ctx=None):
             if ctx == None:
                 ctx = self._ctx
-            ctx1 = ctx[0]
-            ctx2 = ctx[1]
-            plainText = ""
-            if isinstance(data, str):
-                data = data.encode('latin-1')
-            for dataByte in data:
-                m = (dataByte ^ ((ctx1 >> 3) &0xFF) ^ ((ctx2<<3) & 0xFF)) &0xFF
-                ctx2 = ctx1
-                ctx1 = (((ctx1 >> 2) * (ctx1 >> 7)) &0xFFFFFFFF) ^((m * m * 0x0F902007) &0xFFFFFFFF)
-                plainText += chr(m)
-            return plainText
+            return _topaz_python(ctx, data)
 
     class AES_CBC(object):
         def __init__(self):
@@ -301,3 +452,8 @@ class KeyIVGen(object):
         return T[0: keylen]
 
 
+
+
+if __name__ == '__main__':
+    benchmark_pc1()
+    benchmark_topaz()
@@ -33,44 +33,16 @@ import sys
 import csv
 import os
 import getopt
+from array import array
+from bisect import bisect_left
 from struct import pack
 from struct import unpack
 
+import topazreader
+
 class TpzDRMError(Exception):
     pass
 
-# Get a 7 bit encoded number from string. The most
-# significant byte comes first and has the high bit (8th) set
-
-def readEncodedNumber(file):
-    flag = False
-    c = file.read(1)
-    if (len(c) == 0):
-        return None
-    data = ord(c)
-
-    if data == 0xFF:
-        flag = True
-        c = file.read(1)
-        if (len(c) == 0):
-            return None
-        data = ord(c)
-
-    if data >= 0x80:
-        datax = (data & 0x7F)
-        while data >= 0x80 :
-            c = file.read(1)
-            if (len(c) == 0):
-                return None
-            data = c[0]
-            datax = (datax <<7) + (data & 0x7F)
-        data = datax
-
-    if flag:
-        data = -data
-    return data
-
-
 # returns a binary string that encodes a number into 7 bits
 # most significant byte first which has the high bit set
 
@@ -106,15 +78,6 @@ def encodeNumber(number):
 def lengthPrefixString(data):
     return encodeNumber(len(data))+data
 
-def readString(file):
-    stringLength = readEncodedNumber(file)
-    if (stringLength == None):
-        return ""
-    sv = file.read(stringLength)
-    if (len(sv)  != stringLength):
-        return ""
-    return unpack(str(stringLength)+"s",sv)[0]
-
 
 # convert a binary string generated by encodeNumber (7 bit encoded number)
 # to the value you would find inside the page*.dat files to be processed
@@ -136,12 +99,14 @@ class Dictionary(object):
     def __init__(self, dictFile):
         self.filename = dictFile
         self.size = 0
-        self.fo = open(dictFile,'rb')
+        with open(dictFile,'rb') as f:
+            reader = topazreader.TopazReader(f.read())
         self.stable = []
-        self.size = readEncodedNumber(self.fo)
+        self.size = reader.readNumber()
         for i in range(self.size):
-            self.stable.append(self.escapestr(readString(self.fo)))
+            self.stable.append(self.escapestr(reader.readString()))
         self.pos = 0
+        self.tagpaths = TagPaths()
 
     def escapestr(self, str):
         str = str.replace('&','&amp;')
@@ -170,13 +135,197 @@ class Dictionary(object):
             print("%d %s %s" % (i, convert(i), self.stable[i]))
         return
 
+# The page description as the converters use it. Tag paths (b'page.region.img')
+# are interned: every node only stores the number of its path, and the
+# table is shared by all pages of a book. It is held by the book's
+# dictionary, so it goes away with the book.
+
+class TagPaths(object):
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        # (tag path number, suffix) -> does the path end with that suffix
+        self.suffixes = {}
+        # for PageParser.tagInfo: the token_tags entry for a tag path (from
+        # the longest part of the path that has one) and the full path
+        self.tag_info = {}
+
+    def id(self, path):
+        tid = self.ids.get(path)
+        if tid is None:
+            tid = len(self.names)
+            self.ids[path] = tid
+            self.names.append(path)
+        return tid
+
+    def name(self, tid):
+        return self.names[tid]
+
+    def endswith(self, tid, suffix):
+        key = (tid, suffix)
+        result = self.suffixes.get(key)
+        if result is None:
+            result = self.names[tid].endswith(suffix)
+            self.suffixes[key] = result
+        return result
+
+def numberArray(values):
+    try:
+        return array('i', values)
+    except OverflowError:
+        return array('q', values)
+
+
+class PageDoc(object):
+    # One node per tag, in the same order as the lines of the flat xml
+    # (so positions mean the same thing as the line numbers did).
+    # Arguments are kept as they were decoded: an array of ints for
+    # numbers, a list of (escaped) dictionary strings for text, or None
+    # if the tag has no arguments.
+    #
+    # Lookups go through an index built on first use: the positions of
+    # every tag path, and for each suffix searched for the sorted
+    # positions of all tag paths that end with it.
+
+    def __init__(self, tagpaths):
+        self.tagpaths = tagpaths
+        self.tags = array('i')
+        self.args = []
+        self.bytag = None
+        self.index = {}
+
+    def __len__(self):
+        return len(self.tags)
+
+    def append(self, name, argtype, argList):
+        self.bytag = None
+        self.index = {}
+        self.tags.append(self.tagpaths.id(name))
+        if len(argList) == 0:
+            self.args.append(None)
+        elif (argtype == 'text') or (argtype == 'scalar_text'):
+            self.args.append(list(argList))
+        else:
+            self.args.append(numberArray(argList))
+
+    def extend(self, other):
+        self.bytag = None
+        self.index = {}
+        self.tags.extend(other.tags)
+        self.args.extend(other.args)
+
+    def name(self, pos):
+        return self.tagpaths.names[self.tags[pos]]
+
+    def endswith(self, pos, suffix):
+        return self.tagpaths.endswith(self.tags[pos], suffix)
+
+    # tag path number -> positions of the nodes with that path
+    def byTag(self):
+        if self.bytag is None:
+            self.bytag = {}
+            for j, tid in enumerate(self.tags):
+                plist = self.bytag.get(tid)
+                if plist is None:
+                    self.bytag[tid] = [j]
+                else:
+                    plist.append(j)
+        return self.bytag
+
+    # sorted positions of all nodes whose tag path is exactly tagpath
+    def exactPositions(self, tagpath):
+        if isinstance(tagpath, str):
+            tagpath = tagpath.encode('utf-8')
+        tid = self.tagpaths.ids.get(tagpath)
+        if tid is None:
+            return []
+        return self.byTag().get(tid, [])
+
+    # sorted positions of all nodes whose tag path ends with tagpath
+    def positions(self, tagpath):
+        if isinstance(tagpath, str):
+            tagpath = tagpath.encode('utf-8')
+        result = self.index.get(tagpath)
+        if result is None:
+            self.byTag()
+            endswith = self.tagpaths.endswith
+            plists = [plist for tid, plist in self.bytag.items() if endswith(tid, tagpath)]
+            if len(plists) == 1:
+                result = plists[0]
+            else:
+                result = sorted([j for plist in plists for j in plist])
+            self.index[tagpath] = result
+        return result
+
+    # first node in [pos, end) whose tag path ends with tagpath, or -1
+    def find(self, tagpath, pos=0, end=-1):
+        if end == -1:
+            end = len(self.tags)
+        plist = self.positions(tagpath)
+        i = bisect_left(plist, pos)
+        if i < len(plist) and plist[i] < end:
+            return plist[i]
+        return -1
+
+    # the arguments the way the flat xml had them (b'1|2|3')
+    def text(self, pos):
+        args = self.args[pos]
+        if args is None:
+            return b''
+        if isinstance(args, list):
+            return b'|'.join(args)
+        return b'|'.join([b'%d' % v for v in args])
+
+    # the arguments as a list of byte strings
+    def strings(self, pos):
+        args = self.args[pos]
+        if args is None:
+            return []
+        if isinstance(args, list):
+            return list(args)
+        return [b'%d' % v for v in args]
+
+    # the arguments as a list of numbers
+    def values(self, pos):
+        args = self.args[pos]
+        if args is None:
+            return []
+        if isinstance(args, list):
+            return [int(v) for v in args]
+        return args.tolist()
+
+    # the flat xml text, for debugging
+    def dump(self):
+        rlst = []
+        for j in range(len(self.tags)):
+            rlst.append(self.name(j))
+            if self.args[j] is not None:
+                rlst.append(b'=' + self.text(j))
+            rlst.append(b'\n')
+        return b"".join(rlst)
+
+    # docs are pages of the same book
+    @staticmethod
+    def join(docs):
+        result = PageDoc(docs[0].tagpaths)
+        for doc in docs:
+            result.extend(doc)
+        return result
+
+
 # parses the xml snippets that are represented by each page*.dat file.
 # also parses the other0.dat file - the main stylesheet
 # and information used to inject the xml snippets into page*.dat files
 
 class PageParser(object):
     def __init__(self, filename, dict, debug, flat_xml):
-        self.fo = open(filename,'rb')
+        # filename can also be an open file
+        if isinstance(filename, str):
+            with open(filename,'rb') as f:
+                self.fo = topazreader.TopazReader(f.read())
+        else:
+            self.fo = topazreader.TopazReader(filename.read())
+            filename = getattr(filename, 'name', '')
         self.id = os.path.basename(filename).replace('.dat','')
         self.dict = dict
         self.debug = debug
@@ -185,6 +334,9 @@ class PageParser(object):
         self.tagpath = []
         self.doc = []
         self.snippetList = []
+        # tag paths and tag info, for all pages of the book
+        self.tagpaths = dict.tagpaths
+        self.tag_info = self.tagpaths.tag_info
 
 
     # hash table used to enable the decoding process
@@ -440,6 +592,23 @@ class PageParser(object):
         return result
 
 
+    # token_tags entry for the current tag path (from the longest
+    # part of the path that has one) and the full path
+    def tagInfo(self):
+        key = tuple(self.tagpath)
+        info = self.tag_info.get(key)
+        if info is None:
+            tagdef = None
+            for j in range(len(key)):
+                tkn = self.get_tagpath(j)
+                if tkn in self.token_tags :
+                    tagdef = self.token_tags[tkn]
+                    break
+            info = (tagdef, self.get_tagpath(0))
+            self.tag_info[key] = info
+        return info
+
+
     # list of absolute command byte values values that indicate
     # various types of loop meachanisms typically used to generate vectors
 
@@ -447,21 +616,12 @@ class PageParser(object):
 
     # peek at and return 1 byte that is ahead by i bytes
     def peek(self, aheadi):
-        c = self.fo.read(aheadi)
-        if (len(c) == 0):
-            return None
-        self.fo.seek(-aheadi,1)
-        c = c[-1:]
-        return ord(c)
+        return self.fo.peek(aheadi)
 
 
     # get the next value from the file being processed
     def getNext(self):
-        nbyte = self.peek(1);
-        if (nbyte == None):
-            return None
-        val = readEncodedNumber(self.fo)
-        return val
+        return self.fo.readNumber()
 
 
     # format an arg by argtype
@@ -478,6 +638,16 @@ class PageParser(object):
         return result
 
 
+    # format a list of args by argtype
+    def formatArgs(self, args, argtype):
+        if (argtype == 'text') or (argtype == 'scalar_text') :
+            lookup = self.dict.lookup
+            return [lookup(arg) for arg in args]
+        if (argtype == 'raw') or (argtype == 'number') or (argtype == 'scalar_number') or (argtype == 'snippets') :
+            return args
+        return [self.formatArg(arg, argtype) for arg in args]
+
+
     # process the next tag token, recursively handling subtags,
     # arguments, and commands
     def procToken(self, token):
@@ -486,17 +656,11 @@ class PageParser(object):
         self.tag_push(token)
 
         if self.debug : print('Processing: ', self.get_tagpath(0))
-        cnt = self.tagpath_len()
-        for j in range(cnt):
-            tkn = self.get_tagpath(j)
-            if tkn in self.token_tags :
-                num_args = self.token_tags[tkn][0]
-                argtype = self.token_tags[tkn][1]
-                subtags = self.token_tags[tkn][2]
-                splcase = self.token_tags[tkn][3]
-                ntags = -1
-                known_token = True
-                break
+        (tagdef, tkn) = self.tagInfo()
+        if tagdef != None :
+            (num_args, argtype, subtags, splcase) = tagdef
+            ntags = -1
+            known_token = True
 
         if known_token :
 
@@ -505,15 +669,15 @@ class PageParser(object):
             if (splcase == 1):
                 # this type of tag uses of escape marker 0x74 indicate subtag count
                 if self.peek(1) == 0x74:
-                    skip = readEncodedNumber(self.fo)
+                    skip = self.fo.readNumber()
                     subtags = 1
                     num_args = 0
 
             if (subtags == 1):
-                ntags = readEncodedNumber(self.fo)
+                ntags = self.fo.readNumber()
                 if self.debug : print('subtags: ', token , ' has ' , str(ntags))
                 for j in range(ntags):
-                    val = readEncodedNumber(self.fo)
+                    val = self.fo.readNumber()
                     subtagres.append(self.procToken(self.dict.lookup(val)))
 
             # arguments can be scalars or vectors of text or numbers
@@ -522,16 +686,15 @@ class PageParser(object):
                 firstarg = self.peek(1)
                 if (firstarg in self.cmd_list) and (argtype != 'scalar_number') and (argtype != 'scalar_text'):
                     # single argument is a variable length vector of data
-                    arg = readEncodedNumber(self.fo)
+                    arg = self.fo.readNumber()
                     argres = self.decodeCMD(arg,argtype)
                 else :
                     # num_arg scalar arguments
                     for i in range(num_args):
-                        argres.append(self.formatArg(readEncodedNumber(self.fo), argtype))
+                        argres.append(self.formatArg(self.fo.readNumber(), argtype))
 
             # build the return tag
             result = []
-            tkn = self.get_tagpath(0)
             result.append(tkn)
             result.append(subtagres)
             result.append(argtype)
@@ -555,7 +718,7 @@ class PageParser(object):
     # it is NEVER used to format arguments.
     # builds the snippetList
     def doLoop72(self, argtype):
-        cnt = readEncodedNumber(self.fo)
+        cnt = self.fo.readNumber()
         if self.debug :
             result = 'Set of '+ str(cnt) + ' xml snippets. The overall structure \n'
             result += 'of the document is indicated by snippet number sets at the\n'
@@ -565,7 +728,7 @@ class PageParser(object):
             if self.debug: print('Snippet:',str(i))
             snippet = []
             snippet.append(i)
-            val = readEncodedNumber(self.fo)
+            val = self.fo.readNumber()
             snippet.append(self.procToken(self.dict.lookup(val)))
             self.snippetList.append(snippet)
         return
@@ -574,20 +737,7 @@ class PageParser(object):
 
     # general loop code gracisouly submitted by "skindle" - thank you!
     def doLoop76Mode(self, argtype, cnt, mode):
-        result = []
-        adj = 0
-        if mode & 1:
-            adj = readEncodedNumber(self.fo)
-        mode = mode >> 1
-        x = []
-        for i in range(cnt):
-            x.append(readEncodedNumber(self.fo) - adj)
-        for i in range(mode):
-            for j in range(1, cnt):
-                x[j] = x[j] + x[j - 1]
-        for i in range(cnt):
-            result.append(self.formatArg(x[i],argtype))
-        return result
+        return self.formatArgs(self.fo.readVector(cnt, mode), argtype)
 
 
     # dispatches loop commands bytes with various modes
@@ -601,8 +751,8 @@ class PageParser(object):
         if (cmd == 0x76):
 
             # loop with cnt, and mode to control loop styles
-            cnt = readEncodedNumber(self.fo)
-            mode = readEncodedNumber(self.fo)
+            cnt = self.fo.readNumber()
+            mode = self.fo.readNumber()
 
             if self.debug : print('Loop for', cnt, 'with  mode', mode,  ':  ')
             return self.doLoop76Mode(argtype, cnt, mode)
@@ -726,6 +876,24 @@ class PageParser(object):
         return b"".join(rlst)
 
 
+    # add tag and its subtags to the page model
+    def buildTag(self, node, doc):
+        doc.append(node[0], node[2], node[3])
+        for j in node[1]:
+            if len(j) > 0 :
+                self.buildTag(j, doc)
+
+
+    # build the page model
+    def buildDoc(self):
+        doc = PageDoc(self.tagpaths)
+        for j in self.doc :
+            if len(j) > 0:
+                self.buildTag(j, doc)
+        if self.debug : print(doc.dump())
+        return doc
+
+
     # reduce create xml output
     def formatDoc(self, flat_xml):
         rlst = []
@@ -749,7 +917,7 @@ class PageParser(object):
     # every dictionary and seems close to what is meant
     # The alternative is to special case the last _ "0x5f" to mean something
 
-    def process(self):
+    def parse(self):
 
         # peek at the first bytes to see what type of file it is
         magic = self.fo.read(9)
@@ -807,6 +975,10 @@ class PageParser(object):
             if len(tag_add) > 0:
                 self.doc.append(tag_add)
 
+
+    def process(self):
+        self.parse()
+
         # handle generation of xml output
         xmlpage = self.formatDoc(self.flat_xml)
 
@@ -820,6 +992,11 @@ def fromData(dict, fname):
     xmlpage = pp.process()
     return xmlpage
 
+def getDoc(dict, fname, debug=False):
+    pp = PageParser(fname, dict, debug, True)
+    pp.parse()
+    return pp.buildDoc()
+
 def getXML(dict, fname):
     flat_xml = False
     debug = True
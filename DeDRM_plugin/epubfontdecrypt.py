@@ -10,6 +10,7 @@
 
 # Revision history:
 #   1 - Initial release
+#   2 - Run as a stage of the single-pass EPUB pipeline
 
 """
 Decrypts / deobfuscates font files in EPUB files
@@ -18,7 +19,7 @@ Decrypts / deobfuscates font files in EPUB files
 from __future__ import print_function
 
 __license__ = 'GPL v3'
-__version__ = "1"
+__version__ = "2"
 
 import os
 import traceback
@@ -30,6 +31,7 @@ from lxml import etree
 import itertools
 import hashlib
 import binascii
+from epubpipeline import PipelineStage, EPUBPipeline
 
 
 class Decryptor(object):
@@ -85,6 +87,12 @@ class Decryptor(object):
     def check_if_remaining(self):
         return self._has_remaining_xml
 
+    def is_obfuscated(self, path):
+        path = path.encode('utf-8')
+        if path in self._obfuscatedIETF and self.obfuscation_key_IETF is not None:
+            return True
+        return path in self._obfuscatedAdobe and self.obfuscation_key_Adobe is not None
+
     def get_xml(self):
         return "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n" + etree.tostring(self._encryption, encoding="utf-8", pretty_print=True, xml_declaration=False).decode("utf-8")
 
@@ -143,177 +151,178 @@ class Decryptor(object):
 
 
 
-def decryptFontsBook(inpath, outpath):
+def getFontKeys(read):
+    # Finds the main OPF through container.xml and derives the font keys from it.
+    # "read" returns the contents of a file in the book.
+    # Returns None if there's no OPF, else a tuple with the IETF and Adobe keys.
+
+    font_master_key = None
+    adobe_master_encryption_key = None
+
+    contNS = lambda tag: '{%s}%s' % ('urn:oasis:names:tc:opendocument:xmlns:container', tag)
+    path = None
+
+    try:
+        container = etree.fromstring(read("META-INF/container.xml"))
+        rootfiles = container.find(contNS("rootfiles")).findall(contNS("rootfile"))
+        for rootfile in rootfiles: 
+            path = rootfile.get("full-path", None)
+            if (path is not None):
+                break
+    except: 
+        pass
+
+    # If path is None, we didn't find an OPF, so we probably don't have a font key.
+    # If path is set, it's the path to the main content OPF file.
+
+    if (path is None):
+        print("FontDecrypt: No OPF for font obfuscation found")
+        return None
+
+    packageNS = lambda tag: '{%s}%s' % ('http://www.idpf.org/2007/opf', tag)
+    metadataDCNS = lambda tag: '{%s}%s' % ('http://purl.org/dc/elements/1.1/', tag) 
+
+    try:
+        container = etree.fromstring(read(path))
+    except: 
+        container = []
+
+    ## IETF font key algorithm:
+    print("FontDecrypt: Checking {0} for IETF font obfuscation keys ... ".format(path), end='')
+    secret_key_name = None
+    try:
+        secret_key_name = container.get("unique-identifier")
+    except: 
+        pass
+
+    try: 
+        identify_element = container.find(packageNS("metadata")).find(metadataDCNS("identifier"))
+        if (secret_key_name is None or secret_key_name == identify_element.get("id")):
+            font_master_key = identify_element.text
+    except: 
+        pass
+
+    if (font_master_key is not None):
+        if (secret_key_name is None):
+            print("found '%s'" % (font_master_key))
+        else:
+            print("found '%s' (%s)" % (font_master_key, secret_key_name))
+
+        # Trim / remove forbidden characters from the key, then hash it:
+        font_master_key = font_master_key.replace(' ', '')
+        font_master_key = font_master_key.replace('\t', '')
+        font_master_key = font_master_key.replace('\r', '')
+        font_master_key = font_master_key.replace('\n', '')
+        font_master_key = font_master_key.encode('utf-8')
+        font_master_key = hashlib.sha1(font_master_key).digest()
+    else:
+        print("not found")
+
+    ## Adobe font key algorithm
+    print("FontDecrypt: Checking {0} for Adobe font obfuscation keys ... ".format(path), end='')
+
+    try: 
+        metadata = container.find(packageNS("metadata"))
+        identifiers = metadata.findall(metadataDCNS("identifier"))
+
+        uid = None
+        uidMalformed = False
+
+        for identifier in identifiers: 
+            if identifier.get(packageNS("scheme")) == "UUID":
+                if identifier.text[:9] == "urn:uuid:":
+                    uid = identifier.text[9:]
+                else: 
+                    uid = identifier.text
+                break
+            if identifier.text[:9] == "urn:uuid:":
+                uid = identifier.text[9:]
+                break
 
-    with closing(ZipFile(open(inpath, 'rb'))) as inf:
-        namelist = inf.namelist()
-        if 'META-INF/encryption.xml' not in namelist:
-            return 1
+        
+        if uid is not None:
+            uid = uid.replace(chr(0x20),'').replace(chr(0x09),'')
+            uid = uid.replace(chr(0x0D),'').replace(chr(0x0A),'').replace('-','')
+
+            if len(uid) < 16:
+                uidMalformed = True
+            if not all(c in "0123456789abcdefABCDEF" for c in uid):
+                uidMalformed = True
+            
+            
+            if not uidMalformed:
+                print("found '{0}'".format(uid))
+                uid = uid + uid
+                adobe_master_encryption_key = binascii.unhexlify(uid[:32])
+        
+        if adobe_master_encryption_key is None:
+            print("not found")
 
-        # Font key handling:
+    except:
+        print("exception")
+        pass
 
-        font_master_key = None
-        adobe_master_encryption_key = None
+    return font_master_key, adobe_master_encryption_key
 
-        contNS = lambda tag: '{%s}%s' % ('urn:oasis:names:tc:opendocument:xmlns:container', tag)
-        path = None
 
-        try:
-            container = etree.fromstring(inf.read("META-INF/container.xml"))
-            rootfiles = container.find(contNS("rootfiles")).findall(contNS("rootfile"))
-            for rootfile in rootfiles: 
-                path = rootfile.get("full-path", None)
-                if (path is not None):
-                    break
-        except: 
-            pass
-
-        # If path is None, we didn't find an OPF, so we probably don't have a font key.
-        # If path is set, it's the path to the main content OPF file.
-
-        if (path is None):
-            print("FontDecrypt: No OPF for font obfuscation found")
+# Pipeline stage that deobfuscates all fonts it has a key for
+class FontDecryptionStage(PipelineStage):
+    def __init__(self):
+        self._decryptor = None
+
+    def is_active(self):
+        return self._decryptor is not None
+
+    def prepare(self, pipeline):
+        if 'META-INF/encryption.xml' not in pipeline.namelist():
+            return
+        encryption = pipeline.read('META-INF/encryption.xml')
+        if encryption is None:
+            # An earlier stage removed the whole file, nothing left to do.
+            return
+
+        keys = getFontKeys(pipeline.read)
+        if keys is None:
+            return
+        self._decryptor = Decryptor(keys[0], keys[1], encryption)
+
+    def touches(self, path):
+        if self._decryptor is None:
+            return False
+        return path == "META-INF/encryption.xml" or self._decryptor.is_obfuscated(path)
+
+    def transform(self, path, data):
+        if self._decryptor is None:
+            return data
+        if path == "META-INF/encryption.xml":
+            # Check if there's still other entries not related to fonts
+            if self._decryptor.check_if_remaining():
+                print("FontDecrypt: There's remaining entries in encryption.xml, adding file ...")
+                return self._decryptor.get_xml().encode('utf-8')
+            # No remaining entries, no need for that file.
+            return None
+        return self._decryptor.decrypt(path, data)
+
+
+def decryptFontsBook(inpath, outpath):
+    try:
+        pipeline = EPUBPipeline(inpath)
+    except:
+        print("FontDecrypt: Could not open {0:s} because of an exception:\n{1:s}".format(os.path.basename(inpath), traceback.format_exc()))
+        return 2
+
+    try:
+        stage = FontDecryptionStage()
+        pipeline.add_stage(stage)
+        if not stage.is_active():
             return 1
-        else:
-            packageNS = lambda tag: '{%s}%s' % ('http://www.idpf.org/2007/opf', tag)
-            metadataDCNS = lambda tag: '{%s}%s' % ('http://purl.org/dc/elements/1.1/', tag) 
-
-            try:
-                container = etree.fromstring(inf.read(path))
-            except: 
-                container = []
-
-            ## IETF font key algorithm:
-            print("FontDecrypt: Checking {0} for IETF font obfuscation keys ... ".format(path), end='')
-            secret_key_name = None
-            try:
-                secret_key_name = container.get("unique-identifier")
-            except: 
-                pass
-
-            try: 
-                identify_element = container.find(packageNS("metadata")).find(metadataDCNS("identifier"))
-                if (secret_key_name is None or secret_key_name == identify_element.get("id")):
-                    font_master_key = identify_element.text
-            except: 
-                pass
-
-            if (font_master_key is not None):
-                if (secret_key_name is None):
-                    print("found '%s'" % (font_master_key))
-                else:
-                    print("found '%s' (%s)" % (font_master_key, secret_key_name))
-
-                # Trim / remove forbidden characters from the key, then hash it:
-                font_master_key = font_master_key.replace(' ', '')
-                font_master_key = font_master_key.replace('\t', '')
-                font_master_key = font_master_key.replace('\r', '')
-                font_master_key = font_master_key.replace('\n', '')
-                font_master_key = font_master_key.encode('utf-8')
-                font_master_key = hashlib.sha1(font_master_key).digest()
-            else:
-                print("not found")
-
-            ## Adobe font key algorithm
-            print("FontDecrypt: Checking {0} for Adobe font obfuscation keys ... ".format(path), end='')
-
-            try: 
-                metadata = container.find(packageNS("metadata"))
-                identifiers = metadata.findall(metadataDCNS("identifier"))
-
-                uid = None
-                uidMalformed = False
-
-                for identifier in identifiers: 
-                    if identifier.get(packageNS("scheme")) == "UUID":
-                        if identifier.text[:9] == "urn:uuid:":
-                            uid = identifier.text[9:]
-                        else: 
-                            uid = identifier.text
-                        break
-                    if identifier.text[:9] == "urn:uuid:":
-                        uid = identifier.text[9:]
-                        break
-
-                
-                if uid is not None:
-                    uid = uid.replace(chr(0x20),'').replace(chr(0x09),'')
-                    uid = uid.replace(chr(0x0D),'').replace(chr(0x0A),'').replace('-','')
-
-                    if len(uid) < 16:
-                        uidMalformed = True
-                    if not all(c in "0123456789abcdefABCDEF" for c in uid):
-                        uidMalformed = True
-                    
-                    
-                    if not uidMalformed:
-                        print("found '{0}'".format(uid))
-                        uid = uid + uid
-                        adobe_master_encryption_key = binascii.unhexlify(uid[:32])
-                
-                if adobe_master_encryption_key is None:
-                    print("not found")
-
-            except:
-                print("exception")
-                pass
 
         # Begin decrypting.
-
-        try:
-            encryption = inf.read('META-INF/encryption.xml')
-            decryptor = Decryptor(font_master_key, adobe_master_encryption_key, encryption)
-            kwds = dict(compression=ZIP_DEFLATED, allowZip64=False)
-            with closing(ZipFile(open(outpath, 'wb'), 'w', **kwds)) as outf:
-
-                # Mimetype needs to be the first entry, so remove it from the list
-                # whereever it is, then add it at the beginning. 
-                namelist.remove("mimetype")
-
-                for path in (["mimetype"] + namelist):
-                    data = inf.read(path)
-                    zi = ZipInfo(path)
-                    zi.compress_type=ZIP_DEFLATED
-
-                    if path == "mimetype":
-                        # mimetype must not be compressed
-                        zi.compress_type = ZIP_STORED
-                    
-                    elif path == "META-INF/encryption.xml":
-                        # Check if there's still other entries not related to fonts
-                        if (decryptor.check_if_remaining()):
-                            data = decryptor.get_xml()
-                            print("FontDecrypt: There's remaining entries in encryption.xml, adding file ...")
-                        else: 
-                            # No remaining entries, no need for that file.
-                            continue
-
-                    try:
-                        # get the file info, including time-stamp
-                        oldzi = inf.getinfo(path)
-                        # copy across useful fields
-                        zi.date_time = oldzi.date_time
-                        zi.comment = oldzi.comment
-                        zi.extra = oldzi.extra
-                        zi.internal_attr = oldzi.internal_attr
-                        # external attributes are dependent on the create system, so copy both.
-                        zi.external_attr = oldzi.external_attr
-                        zi.create_system = oldzi.create_system
-                        if any(ord(c) >= 128 for c in path) or any(ord(c) >= 128 for c in zi.comment):
-                            # If the file name or the comment contains any non-ASCII char, set the UTF8-flag
-                            zi.flag_bits |= 0x800
-                    except:
-                        pass
-
-                    if path == "mimetype":
-                        outf.writestr(zi, inf.read('mimetype'))
-                    elif path == "META-INF/encryption.xml":
-                        outf.writestr(zi, data)
-                    else: 
-                        outf.writestr(zi, decryptor.decrypt(path, data))
-        except:
-            print("FontDecrypt: Could not decrypt fonts in {0:s} because of an exception:\n{1:s}".format(os.path.basename(inpath), traceback.format_exc()))
-            traceback.print_exc()
-            return 2
+        pipeline.write(outpath)
+    except:
+        print("FontDecrypt: Could not decrypt fonts in {0:s} because of an exception:\n{1:s}".format(os.path.basename(inpath), traceback.format_exc()))
+        traceback.print_exc()
+        return 2
+    finally:
+        pipeline.close()
     return 0
-
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# epubpipeline.py
+# Copyright © 2021 NoDRM
+
+# Released under the terms of the GNU General Public Licence, version 3
+# <http://www.gnu.org/licenses/>
+
+# Revision history:
+#   1.0 - Initial version
+#   1.1 - Copy files that no stage touches without recompressing them
+
+"""
+Rewrites an EPUB in a single pass, running every member through a chain of stages
+"""
+
+import time
+import zipfilerugged
+import zipfix
+
+_MIMETYPE = b'application/epub+zip'
+
+
+class PipelineStage(object):
+    # Base class for all stages. A stage looks at the book in prepare()
+    # (through EPUBPipeline.read, so it sees the output of the stages that
+    # were added before it), then gets every member through transform().
+
+    def prepare(self, pipeline):
+        pass
+
+    def touches(self, path):
+        # Return False if transform() is guaranteed to leave this file alone,
+        # so it can be copied over without decompressing it.
+        return True
+
+    def transform(self, path, data):
+        # Return the new file data, or None to drop the file from the book.
+        return data
+
+    def finish(self):
+        # Called once the output has been written, for status messages.
+        pass
+
+
+class RemoveFileStage(PipelineStage):
+    def __init__(self, path):
+        self._path = path
+
+    def touches(self, path):
+        return path == self._path
+
+    def transform(self, path, data):
+        if path == self._path:
+            return None
+        return data
+
+
+class EPUBPipeline(object):
+    def __init__(self, inpath):
+        self.reader = zipfix.readZip(inpath)
+        self.stages = []
+        self.modified = False
+
+        self._infos = {}
+        self._names = []
+        for zinfo in self.reader.inzip.infolist():
+            name = self.decodename(zinfo)
+            if name in self._infos:
+                continue
+            self._infos[name] = zinfo
+            self._names.append(name)
+
+        # Files read by the stages while preparing, together with the
+        # number of stages that have already been applied to them.
+        self._cache = {}
+        self._localnames = {}
+
+    def decodename(self, zinfo):
+        if zinfo.flag_bits & 0x800:
+            return zinfo.filename.decode('utf-8')
+        return zinfo.filename.decode('cp437')
+
+    def namelist(self):
+        return list(self._names)
+
+    def getinfo(self, path):
+        return self._infos[path]
+
+    def add_stage(self, stage):
+        stage.prepare(self)
+        self.stages.append(stage)
+
+    def _readraw(self, path):
+        zinfo = self._infos[path]
+        local_name, data = self.reader.readmember(zinfo)
+        if local_name != zinfo.filename:
+            self._localnames[path] = local_name
+        return data
+
+    def _process(self, path, stage_count):
+        if path in self._cache:
+            done, data = self._cache.pop(path)
+        else:
+            done, data = 0, self._readraw(path)
+        for stage in self.stages[done:stage_count]:
+            if data is None:
+                break
+            newdata = stage.transform(path, data)
+            if newdata is not data and newdata != data:
+                self.modified = True
+            data = newdata
+        return data
+
+    def read(self, path):
+        # Returns the contents of a file as seen by the next stage to be added,
+        # or None if one of the earlier stages removed it.
+        data = self._process(path, len(self.stages))
+        self._cache[path] = (len(self.stages), data)
+        return data
+
+    def write(self, outpath):
+        outzip = zipfilerugged.ZipFile(outpath, 'w')
+        try:
+            # mimetype needs to be the first entry, uncompressed
+            mimeinfo = zipfix.ZipInfo(b'mimetype', compress_type=zipfilerugged.ZIP_STORED)
+            mimeinfo.internal_attr = 1 # text file
+            if 'mimetype' in self._infos:
+                self.copyattributes(self._infos['mimetype'], mimeinfo)
+                if self._process('mimetype', len(self.stages)) != _MIMETYPE:
+                    self.modified = True
+            else:
+                self.modified = True
+            outzip.writestr(mimeinfo, _MIMETYPE)
+
+            for path in self._names:
+                if path == 'mimetype':
+                    continue
+                zinfo = self._infos[path]
+                nzinfo = zipfix.ZipInfo(zinfo.filename, zinfo.date_time, compress_type=zipfilerugged.ZIP_DEFLATED)
+                self.copyattributes(zinfo, nzinfo)
+
+                if not any(stage.touches(path) for stage in self.stages):
+                    # Nothing to change, copy the compressed data as it is.
+                    self._cache.pop(path, None)
+                    try:
+                        outzip.copyraw(self.reader.inzip, zinfo, nzinfo)
+                        continue
+                    except (zipfilerugged.BadZipfile, RuntimeError):
+                        # Broken or encrypted entry, go the slow way.
+                        nzinfo.compress_type = zipfilerugged.ZIP_DEFLATED
+
+                data = self._process(path, len(self.stages))
+                if data is None:
+                    self.modified = True
+                    continue
+                if not isinstance(data, bytes):
+                    data = data.encode('utf-8')
+
+                if path in self._localnames:
+                    nzinfo.filename = self._localnames[path]
+                outzip.writestr(nzinfo, data)
+        finally:
+            outzip.close()
+
+        for stage in self.stages:
+            stage.finish()
+
+        return self.modified
+
+    def close(self):
+        self.reader.close()
+
+    def copyattributes(self, zinfo, nzinfo):
+        # copy across the useful fields, including the time-stamp
+        nzinfo.date_time = zinfo.date_time
+        nzinfo.comment = zinfo.comment
+        nzinfo.extra = zinfo.extra
+        nzinfo.internal_attr = zinfo.internal_attr
+        nzinfo.external_attr = zinfo.external_attr
+        nzinfo.create_system = zinfo.create_system
+        nzinfo.flag_bits = zinfo.flag_bits & 0x800  # preserve UTF-8 flag
+
+
+def postProcessStages(dedrmprefs):
+    # Returns the stages for the post-processing that's enabled in the settings.
+    stages = []
+
+    if dedrmprefs["deobfuscate_fonts"] is True:
+        # Deobfuscate fonts
+        import epubfontdecrypt
+        stages.append(epubfontdecrypt.FontDecryptionStage())
+
+    if dedrmprefs["remove_watermarks"] is True:
+        import epubwatermark as watermark
+
+        # Remove Tolino's CDP watermark file
+        stages.append(watermark.CDPWatermarkStage())
+
+        # Remove watermarks (Amazon or LemonInk) from the OPF file
+        stages.append(watermark.OPFWatermarkStage())
+
+        # Remove watermarks (Adobe, Pocketbook or LemonInk) from all HTML and XHTML files
+        stages.append(watermark.HTMLWatermarkStage())
+
+    return stages
+
+
+def processBook(inpath, outpath, stages):
+    # Runs the book through the given stages and writes the result to outpath.
+    # Returns True if any of the stages changed something.
+    start = time.time()
+    pipeline = EPUBPipeline(inpath)
+    try:
+        for stage in stages:
+            pipeline.add_stage(stage)
+        modified = pipeline.write(outpath)
+    finally:
+        pipeline.close()
+    print("EPUBPipeline: Rewrote book with {0} stage(s) in {1:.1f} seconds".format(len(stages), time.time() - start))
+    return modified
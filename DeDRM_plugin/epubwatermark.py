@@ -6,6 +6,7 @@
 
 # Revision history:
 #  1.0   - Initial version
+#  1.1   - Run as stages of the single-pass EPUB pipeline
 
 # Released under the terms of the GNU General Public Licence, version 3
 # <http://www.gnu.org/licenses/>
@@ -15,186 +16,123 @@ Removes various watermarks from EPUB files
 """
 
 import traceback
-from zipfile import ZipInfo, ZipFile, ZIP_STORED, ZIP_DEFLATED
-from contextlib import closing
 from lxml import etree
 import re
+from epubpipeline import PipelineStage, RemoveFileStage, EPUBPipeline
 
 # Runs a RegEx over all HTML/XHTML files to remove watermakrs.
-def removeHTMLwatermarks(object, path_to_ebook):
-    try: 
-        inf = ZipFile(open(path_to_ebook, 'rb'))
-        namelist = inf.namelist()
-
-        modded_names = []
-        modded_contents = []
+class HTMLWatermarkStage(PipelineStage):
+    def __init__(self):
+        self.count_adept = 0
+        self.count_pocketbook = 0
+        self.count_lemonink_invisible = 0
+        self.count_lemonink_visible = 0
+        self.lemonink_trackingID = None
 
-        count_adept = 0
-        count_pocketbook = 0
-        count_lemonink_invisible = 0
-        count_lemonink_visible = 0
-        lemonink_trackingID = None
+    def touches(self, file):
+        return file.endswith('.html') or file.endswith('.xhtml') or file.endswith('.xml')
 
-        for file in namelist:
-            if not (file.endswith('.html') or file.endswith('.xhtml') or file.endswith('.xml')):
-                continue
+    def transform(self, file, data):
+        if not (file.endswith('.html') or file.endswith('.xhtml') or file.endswith('.xml')):
+            return data
 
-            try:
-                file_str = inf.read(file).decode("utf-8")
-                str_new = file_str
+        try:
+            file_str = data.decode("utf-8")
+            str_new = file_str
 
-                # Remove Adobe ADEPT watermarks
-                # Match optional newline at the beginning, then a "meta" tag with name = "Adept.expected.resource" or "Adept.resource"
-                # and either a "value" or a "content" element with an Adobe UUID
-                pre_remove = str_new
-                str_new = re.sub(r'((\r\n|\r|\n)\s*)?\<meta\s+name=\"(Adept\.resource|Adept\.expected\.resource)\"\s+(content|value)=\"urn:uuid:[0-9a-fA-F\-]+\"\s*\/>', '', str_new)
-                str_new = re.sub(r'((\r\n|\r|\n)\s*)?\<meta\s+(content|value)=\"urn:uuid:[0-9a-fA-F\-]+\"\s+name=\"(Adept\.resource|Adept\.expected\.resource)\"\s*\/>', '', str_new)
+            # Remove Adobe ADEPT watermarks
+            # Match optional newline at the beginning, then a "meta" tag with name = "Adept.expected.resource" or "Adept.resource"
+            # and either a "value" or a "content" element with an Adobe UUID
+            pre_remove = str_new
+            str_new = re.sub(r'((\r\n|\r|\n)\s*)?\<meta\s+name=\"(Adept\.resource|Adept\.expected\.resource)\"\s+(content|value)=\"urn:uuid:[0-9a-fA-F\-]+\"\s*\/>', '', str_new)
+            str_new = re.sub(r'((\r\n|\r|\n)\s*)?\<meta\s+(content|value)=\"urn:uuid:[0-9a-fA-F\-]+\"\s+name=\"(Adept\.resource|Adept\.expected\.resource)\"\s*\/>', '', str_new)
 
-                if (str_new != pre_remove):
-                    count_adept += 1
+            if (str_new != pre_remove):
+                self.count_adept += 1
 
-                # Remove Pocketbook watermarks
-                pre_remove = str_new
-                str_new = re.sub(r'\<div style\=\"padding\:0\;border\:0\;text\-indent\:0\;line\-height\:normal\;margin\:0 1cm 0.5cm 1cm\;[^\"]*opacity:0.0\;[^\"]*text\-decoration\:none\;[^\"]*background\:none\;[^\"]*\"\>(.*?)\<\/div\>', '', str_new)
+            # Remove Pocketbook watermarks
+            pre_remove = str_new
+            str_new = re.sub(r'\<div style\=\"padding\:0\;border\:0\;text\-indent\:0\;line\-height\:normal\;margin\:0 1cm 0.5cm 1cm\;[^\"]*opacity:0.0\;[^\"]*text\-decoration\:none\;[^\"]*background\:none\;[^\"]*\"\>(.*?)\<\/div\>', '', str_new)
 
-                if (str_new != pre_remove):
-                    count_pocketbook += 1
+            if (str_new != pre_remove):
+                self.count_pocketbook += 1
 
 
-                # Remove eLibri / LemonInk watermark
-                # Run this in a loop, as it is possible a file has been watermarked twice ...
-                while True: 
+            # Remove eLibri / LemonInk watermark
+            # Run this in a loop, as it is possible a file has been watermarked twice ...
+            while True: 
+                pre_remove = str_new
+                unique_id = re.search(r'<body[^>]+class="[^"]*(t0x[0-9a-fA-F]{25})[^"]*"[^>]*>', str_new)
+                if (unique_id):
+                    self.lemonink_trackingID = unique_id.groups()[0]
+                    self.count_lemonink_invisible += 1
+                    str_new = re.sub(self.lemonink_trackingID, '', str_new)
                     pre_remove = str_new
-                    unique_id = re.search(r'<body[^>]+class="[^"]*(t0x[0-9a-fA-F]{25})[^"]*"[^>]*>', str_new)
-                    if (unique_id):
-                        lemonink_trackingID = unique_id.groups()[0]
-                        count_lemonink_invisible += 1
-                        str_new = re.sub(lemonink_trackingID, '', str_new)
-                        pre_remove = str_new
-                        pm = r'(<body[^>]+class="[^"]*"[^>]*>)'
-                        pm += r'\<div style\=\'padding\:0\;border\:0\;text\-indent\:0\;line\-height\:normal\;margin\:0 1cm 0.5cm 1cm\;[^\']*text\-decoration\:none\;[^\']*background\:none\;[^\']*\'\>(.*?)</div>'
-                        pm += r'\<div style\=\'padding\:0\;border\:0\;text\-indent\:0\;line\-height\:normal\;margin\:0 1cm 0.5cm 1cm\;[^\']*text\-decoration\:none\;[^\']*background\:none\;[^\']*\'\>(.*?)</div>'
-                        str_new = re.sub(pm, r'\1', str_new)
-
-                        if (str_new != pre_remove):
-                            count_lemonink_visible += 1
-                    else: 
-                        break
-
-            except:
-                traceback.print_exc()
-                continue
-
-            if (file_str == str_new):
-                continue
-
-            modded_names.append(file)
-            modded_contents.append(str_new)
-
-        
-        if len(modded_names) == 0:
-            # No file modified, return original
-            return path_to_ebook
+                    pm = r'(<body[^>]+class="[^"]*"[^>]*>)'
+                    pm += r'\<div style\=\'padding\:0\;border\:0\;text\-indent\:0\;line\-height\:normal\;margin\:0 1cm 0.5cm 1cm\;[^\']*text\-decoration\:none\;[^\']*background\:none\;[^\']*\'\>(.*?)</div>'
+                    pm += r'\<div style\=\'padding\:0\;border\:0\;text\-indent\:0\;line\-height\:normal\;margin\:0 1cm 0.5cm 1cm\;[^\']*text\-decoration\:none\;[^\']*background\:none\;[^\']*\'\>(.*?)</div>'
+                    str_new = re.sub(pm, r'\1', str_new)
 
-        if len(modded_names) != len(modded_contents):
-            # Something went terribly wrong, return original
-            print("Watermark: Error during watermark removal")
-            return path_to_ebook
+                    if (str_new != pre_remove):
+                        self.count_lemonink_visible += 1
+                else: 
+                    break
 
-        # Re-package with modified files:
-        namelist.remove("mimetype")
-
-        try: 
-            output = object.temporary_file(".epub").name
-            kwds = dict(compression=ZIP_DEFLATED, allowZip64=False)
-            with closing(ZipFile(open(output, 'wb'), 'w', **kwds)) as outf:
-                for path in (["mimetype"] + namelist):
-
-                    data = inf.read(path)
-                    
-                    try: 
-                        modded_index = None
-                        modded_index = modded_names.index(path)
-                    except:
-                        pass
-
-                    if modded_index is not None:
-                        # Found modified file - replace contents
-                        data = modded_contents[modded_index]
-
-                    zi = ZipInfo(path)
-                    oldzi = inf.getinfo(path)
-                    try: 
-                        zi.compress_type = oldzi.compress_type
-                        if path == "mimetype":
-                            zi.compress_type = ZIP_STORED
-                        zi.date_time = oldzi.date_time
-                        zi.comment = oldzi.comment
-                        zi.extra = oldzi.extra
-                        zi.internal_attr = oldzi.internal_attr
-                        zi.external_attr = oldzi.external_attr
-                        zi.create_system = oldzi.create_system
-                        if any(ord(c) >= 128 for c in path) or any(ord(c) >= 128 for c in zi.comment):
-                            # If the file name or the comment contains any non-ASCII char, set the UTF8-flag
-                            zi.flag_bits |= 0x800
-                    except:
-                        pass
-
-                    outf.writestr(zi, data)
         except:
             traceback.print_exc()
-            return path_to_ebook
+            return data
+
+        if (file_str == str_new):
+            return data
 
-        if (count_adept > 0):
-            print("Watermark: Successfully stripped {0} ADEPT watermark(s) from ebook.".format(count_adept))
+        return str_new.encode("utf-8")
+
+    def finish(self):
+        if (self.count_adept > 0):
+            print("Watermark: Successfully stripped {0} ADEPT watermark(s) from ebook.".format(self.count_adept))
         
-        if (count_lemonink_invisible > 0 or count_lemonink_visible > 0):
+        if (self.count_lemonink_invisible > 0 or self.count_lemonink_visible > 0):
             print("Watermark: Successfully stripped {0} visible and {1} invisible LemonInk watermark(s) (\"{2}\") from ebook."
-                .format(count_lemonink_visible, count_lemonink_invisible, lemonink_trackingID))
+                .format(self.count_lemonink_visible, self.count_lemonink_invisible, self.lemonink_trackingID))
             
-        if (count_pocketbook > 0):
-            print("Watermark: Successfully stripped {0} Pocketbook watermark(s) from ebook.".format(count_pocketbook))
+        if (self.count_pocketbook > 0):
+            print("Watermark: Successfully stripped {0} Pocketbook watermark(s) from ebook.".format(self.count_pocketbook))
 
-        return output
 
-    except:
-        traceback.print_exc()
-        return path_to_ebook
-        
+# Finds the main OPF file, then uses RegEx to remove watermarks
+class OPFWatermarkStage(PipelineStage):
+    def __init__(self):
+        self.opf_path = None
+        self.had_amazon = False
+        self.had_elibri = False
 
+    def prepare(self, pipeline):
+        contNS = lambda tag: '{%s}%s' % ('urn:oasis:names:tc:opendocument:xmlns:container', tag)
 
+        try:
+            container = etree.fromstring(pipeline.read("META-INF/container.xml"))
+            rootfiles = container.find(contNS("rootfiles")).findall(contNS("rootfile"))
+            for rootfile in rootfiles: 
+                self.opf_path = rootfile.get("full-path", None)
+                if (self.opf_path is not None):
+                    break
+        except: 
+            traceback.print_exc()
 
-# Finds the main OPF file, then uses RegEx to remove watermarks
-def removeOPFwatermarks(object, path_to_ebook):
-    contNS = lambda tag: '{%s}%s' % ('urn:oasis:names:tc:opendocument:xmlns:container', tag)
-    opf_path = None
-
-    try:
-        inf = ZipFile(open(path_to_ebook, 'rb'))
-        container = etree.fromstring(inf.read("META-INF/container.xml"))
-        rootfiles = container.find(contNS("rootfiles")).findall(contNS("rootfile"))
-        for rootfile in rootfiles: 
-            opf_path = rootfile.get("full-path", None)
-            if (opf_path is not None):
-                break
-    except: 
-        traceback.print_exc()
-        return path_to_ebook
+        # If path is None, we didn't find an OPF - no watermark
+        # If path is set, it's the path to the main content OPF file.
 
-    # If path is None, we didn't find an OPF, so we probably don't have a font key.
-    # If path is set, it's the path to the main content OPF file.
+    def touches(self, path):
+        return path == self.opf_path
+
+    def transform(self, path, data):
+        if path != self.opf_path:
+            return data
 
-    if (opf_path is None):
-        # No OPF found - no watermark
-        return path_to_ebook
-    else:
         try:
-            container_str = inf.read(opf_path).decode("utf-8")
+            container_str = data.decode("utf-8")
             container_str_new = container_str
 
-            had_amazon = False
-            had_elibri = False
-
             # Remove Amazon hex watermarks
             # Match optional newline at the beginning, then spaces, then a "meta" tag with name = "Watermark" or "Watermark_(hex)" and a "content" element.
             # This regex also matches DuMont watermarks with meta name="watermark", with the case-insensitive match on the "w" in watermark.
@@ -202,7 +140,7 @@ def removeOPFwatermarks(object, path_to_ebook):
             container_str_new = re.sub(r'((\r\n|\r|\n)\s*)?\<meta\s+name=\"[Ww]atermark(_\(hex\))?\"\s+content=\"[0-9a-fA-F]+\"\s*\/>', '', container_str_new)
             container_str_new = re.sub(r'((\r\n|\r|\n)\s*)?\<meta\s+content=\"[0-9a-fA-F]+\"\s+name=\"[Ww]atermark(_\(hex\))?\"\s*\/>', '', container_str_new)
             if pre_remove != container_str_new:
-                had_amazon = True
+                self.had_amazon = True
 
             # Remove elibri / lemonink watermark
             # Lemonink replaces all "id" fields in the opf with "idX_Y", with X being the watermark and Y being a number for that particular ID.
@@ -213,106 +151,66 @@ def removeOPFwatermarks(object, path_to_ebook):
                 # To prevent this Regex from applying to books without that watermark, only do that if the watermark above was found.
                 container_str_new = re.sub(r'\=\"id[0-9]+_([0-9]+)\"', r'="id_\1"', container_str_new)
             if pre_remove != container_str_new:
-                had_elibri = True
+                self.had_elibri = True
 
         except:
             traceback.print_exc()
-            return path_to_ebook
+            return data
 
         if (container_str == container_str_new):
             # container didn't change - no watermark
-            return path_to_ebook
+            return data
 
-        # Re-package without watermark
-        namelist = inf.namelist()
-        namelist.remove("mimetype")
+        return container_str_new.encode("utf-8")
 
-        try: 
-            output = object.temporary_file(".epub").name
-            kwds = dict(compression=ZIP_DEFLATED, allowZip64=False)
-            with closing(ZipFile(open(output, 'wb'), 'w', **kwds)) as outf:
-                for path in (["mimetype"] + namelist):
-
-                    data = inf.read(path)
-                    if path == opf_path:
-                        # Found OPF, replacing ...
-                        data = container_str_new
-
-                    zi = ZipInfo(path)
-                    oldzi = inf.getinfo(path)
-                    try: 
-                        zi.compress_type = oldzi.compress_type
-                        if path == "mimetype":
-                            zi.compress_type = ZIP_STORED
-                        zi.date_time = oldzi.date_time
-                        zi.comment = oldzi.comment
-                        zi.extra = oldzi.extra
-                        zi.internal_attr = oldzi.internal_attr
-                        zi.external_attr = oldzi.external_attr
-                        zi.create_system = oldzi.create_system
-                        if any(ord(c) >= 128 for c in path) or any(ord(c) >= 128 for c in zi.comment):
-                            # If the file name or the comment contains any non-ASCII char, set the UTF8-flag
-                            zi.flag_bits |= 0x800
-                    except:
-                        pass
-
-                    outf.writestr(zi, data)
-        except:
-            traceback.print_exc()
-            return path_to_ebook
-        
-        if had_elibri:
+    def finish(self):
+        if self.had_elibri:
             print("Watermark: Successfully stripped eLibri watermark from OPF file.")
-        if had_amazon:
+        if self.had_amazon:
             print("Watermark: Successfully stripped Amazon watermark from OPF file.")
 
-        return output
 
+# "META-INF/cdp.info" is a watermark file used by some Tolino vendors. 
+# We don't want that in our eBooks, so lets remove that file.
+class CDPWatermarkStage(RemoveFileStage):
+    def __init__(self):
+        super(CDPWatermarkStage, self).__init__('META-INF/cdp.info')
+        self.found = False
 
+    def prepare(self, pipeline):
+        self.found = 'META-INF/cdp.info' in pipeline.namelist()
 
-def removeCDPwatermark(object, path_to_ebook):
-    # "META-INF/cdp.info" is a watermark file used by some Tolino vendors. 
-    # We don't want that in our eBooks, so lets remove that file.
+    def finish(self):
+        if self.found:
+            print("Watermark: Successfully removed cdp.info watermark")
+
+
+def _runStage(object, path_to_ebook, stage):
+    # Rewrites the book with just this one stage.
+    # Returns the original path if the stage didn't change anything.
     try: 
-        infile = ZipFile(open(path_to_ebook, 'rb'))
-        namelist = infile.namelist()
-        if 'META-INF/cdp.info' not in namelist:
-            return path_to_ebook
-
-        namelist.remove("mimetype")
-        namelist.remove("META-INF/cdp.info")
-
-        output = object.temporary_file(".epub").name
-
-        kwds = dict(compression=ZIP_DEFLATED, allowZip64=False)
-        with closing(ZipFile(open(output, 'wb'), 'w', **kwds)) as outf:
-            for path in (["mimetype"] + namelist):
-
-                data = infile.read(path)
-                
-                zi = ZipInfo(path)
-                oldzi = infile.getinfo(path)
-                try: 
-                    zi.compress_type = oldzi.compress_type
-                    if path == "mimetype":
-                        zi.compress_type = ZIP_STORED
-                    zi.date_time = oldzi.date_time
-                    zi.comment = oldzi.comment
-                    zi.extra = oldzi.extra
-                    zi.internal_attr = oldzi.internal_attr
-                    zi.external_attr = oldzi.external_attr
-                    zi.create_system = oldzi.create_system
-                    if any(ord(c) >= 128 for c in path) or any(ord(c) >= 128 for c in zi.comment):
-                        # If the file name or the comment contains any non-ASCII char, set the UTF8-flag
-                        zi.flag_bits |= 0x800
-                except:
-                    pass
-
-                outf.writestr(zi, data)
-        
-        print("Watermark: Successfully removed cdp.info watermark")
-        return output
+        pipeline = EPUBPipeline(path_to_ebook)
+        try:
+            pipeline.add_stage(stage)
+            output = object.temporary_file(".epub").name
+            modified = pipeline.write(output)
+        finally:
+            pipeline.close()
+
+        if modified:
+            return output
+        return path_to_ebook
 
     except: 
         traceback.print_exc()
-        return path_to_ebook
\ No newline at end of file
+        return path_to_ebook
+
+
+def removeHTMLwatermarks(object, path_to_ebook):
+    return _runStage(object, path_to_ebook, HTMLWatermarkStage())
+
+def removeOPFwatermarks(object, path_to_ebook):
+    return _runStage(object, path_to_ebook, OPFWatermarkStage())
+
+def removeCDPwatermark(object, path_to_ebook):
+    return _runStage(object, path_to_ebook, CDPWatermarkStage())
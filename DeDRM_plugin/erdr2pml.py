@@ -66,11 +66,13 @@
 #  1.00 - Added Python 3 compatibility for calibre 5.0
 #  1.01 - Bugfixes for standalone version.
 #  1.02 - Remove OpenSSL support; only use PyCryptodome
+#  1.03 - Memory map the input file, build the PML text in one go
 
-__version__='1.02'
+__version__='1.03'
 
 import sys, re
 import struct, binascii, getopt, zlib, os, os.path, urllib, tempfile, traceback, hashlib
+import mmap
 
 try:
     from Cryptodome.Cipher import DES
@@ -153,8 +155,16 @@ class Sectionizer(object):
     bkType = "Book"
 
     def __init__(self, filename, ident):
-        self.contents = open(filename, 'rb').read()
-        self.header = self.contents[0:72]
+        # loadSection returns memoryviews into the mapped file,
+        # so the sections don't get copied around.
+        self.fo = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(self.fo.fileno(), 0, access=mmap.ACCESS_READ)
+            self.contents = memoryview(self.map)
+        except (ValueError, OSError):
+            self.map = None
+            self.contents = memoryview(self.fo.read())
+        self.header = bytes(self.contents[0:72])
         self.num_sections, = struct.unpack('>H', self.contents[76:78])
         # Dictionary or normal content (TODO: Not hard-coded)
         if self.header[0x3C:0x3C+8] != ident:
@@ -174,6 +184,15 @@ class Sectionizer(object):
             end_off = self.sections[section + 1][0]
         off = self.sections[section][0]
         return self.contents[off:end_off]
+    def close(self):
+        self.contents.release()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # a section is still in use, it gets closed once that's gone
+                pass
+        self.fo.close()
 
 # cleanup unicode filenames
 # borrowed from calibre from calibre/src/calibre/__init__.py
@@ -219,7 +238,7 @@ class EreaderProcessor(object):
         logging.info('eReader file format version %s', version)
         if version != 272 and version != 260 and version != 259:
             raise ValueError('incorrect eReader version %d (error 1)' % version)
-        data = self.section_reader(1)
+        data = bytes(self.section_reader(1))
         self.data = data
         des = DES.new(fixKey(data[0:8]), DES.MODE_ECB)
         cookie_shuf, cookie_size = struct.unpack('>LL', des.decrypt(data[-8:]))
@@ -312,7 +331,7 @@ class EreaderProcessor(object):
 
     def getImage(self, i):
         sect = self.section_reader(self.first_image_page + i)
-        name = sect[4:4+32].strip(b'\0')
+        name = bytes(sect[4:4+32]).strip(b'\0')
         data = sect[62:]
         return sanitizeFileName(name.decode('windows-1252')), data
 
@@ -362,10 +381,11 @@ class EreaderProcessor(object):
 
     def getText(self):
         des = DES.new(fixKey(self.content_key), DES.MODE_ECB)
-        r = b''
+        pages = []
         for i in range(self.num_text_pages):
             logging.debug('get page %d', i)
-            r += zlib.decompress(des.decrypt(self.section_reader(1 + i)))
+            pages.append(zlib.decompress(des.decrypt(self.section_reader(1 + i))))
+        r = b''.join(pages)
 
         # now handle footnotes pages
         if self.num_footnote_pages > 0:
@@ -429,6 +449,7 @@ def decryptBook(infile, outpath, make_pmlz, user_key):
         outdir = outpath
         imagedirpath = os.path.join(outdir,bookname + "_img")
 
+    sect = None
     try:
         if not os.path.exists(outdir):
             os.makedirs(outdir)
@@ -442,7 +463,9 @@ def decryptBook(infile, outpath, make_pmlz, user_key):
                 os.makedirs(imagedirpath)
             for i in range(er.getNumImages()):
                 name, contents = er.getImage(i)
-                open(os.path.join(imagedirpath, name), 'wb').write(contents)
+                with open(os.path.join(imagedirpath, name), 'wb') as f:
+                    f.write(contents)
+                contents = None
 
         print("Extracting pml")
         pml_string = er.getText()
@@ -478,6 +501,10 @@ def decryptBook(infile, outpath, make_pmlz, user_key):
         print("Error: {0}".format(e))
         traceback.print_exc()
         return 1
+    finally:
+        if sect is not None:
+            er = None
+            sect.close()
     return 0
 
 
@@ -10,11 +10,13 @@ from struct import unpack
 
 
 class PParser(object):
-    def __init__(self, gd, flatxml, meta_array):
+    def __init__(self, gd, doc, meta_array):
         self.gd = gd
-        self.flatdoc = flatxml.split(b'\n')
-        self.docSize = len(self.flatdoc)
-        self.temp = []
+        # convert2xml.PageDoc of the page(s)
+        self.doc = doc
+        self.docSize = len(doc)
+        self.tempused = set()
+        self.tempnext = {}
 
         self.ph = -1
         self.pw = -1
@@ -57,111 +59,57 @@ class PParser(object):
     # return tag at line pos in document
     def lineinDoc(self, pos) :
         if (pos >= 0) and (pos < self.docSize) :
-            item = self.flatdoc[pos]
-            if item.find(b'=') >= 0:
-                (name, argres) = item.split(b'=',1)
-            else :
-                name = item
-                argres = b''
+            name = self.doc.name(pos)
+            argres = self.doc.text(pos)
         return name, argres
 
     # find tag in doc if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
         result = None
-        if end == -1 :
-            end = self.docSize
-        else:
-            end = min(self.docSize, end)
-        foundat = -1
-        for j in range(pos, end):
-            item = self.flatdoc[j]
-            if item.find(b'=') >= 0:
-                (name, argres) = item.split(b'=',1)
-            else :
-                name = item
-                argres = b''
-            if (isinstance(tagpath,str)):
-                tagpath = tagpath.encode('utf-8')
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
+        foundat = self.doc.find(tagpath, pos, end)
+        if foundat >= 0 :
+            result = self.doc.text(foundat)
         return foundat, result
 
     # return list of start positions for the tagpath
     def posinDoc(self, tagpath):
-        startpos = []
-        pos = 0
-        res = ""
-        while res != None :
-            (foundpos, res) = self.findinDoc(tagpath, pos, -1)
-            if res != None :
-                startpos.append(foundpos)
-            pos = foundpos + 1
-        return startpos
+        return list(self.doc.positions(tagpath))
 
     def getData(self, path):
         result = None
-        cnt = len(self.flatdoc)
-        for j in range(cnt):
-            item = self.flatdoc[j]
-            if item.find(b'=') >= 0:
-                (name, argt) = item.split(b'=')
-                argres = argt.split(b'|')
-            else:
-                name = item
-                argres = []
-            if (name.endswith(path)):
-                result = argres
-                break
-        if (len(argres) > 0) :
-            for j in range(0,len(argres)):
-                argres[j] = int(argres[j])
+        pos = self.doc.find(path, 0, -1)
+        if pos >= 0 :
+            result = self.doc.values(pos)
         return result
 
     def getDataatPos(self, path, pos):
         result = None
-        item = self.flatdoc[pos]
-        if item.find(b'=') >= 0:
-            (name, argt) = item.split(b'=')
-            argres = argt.split(b'|')
-        else:
-            name = item
-            argres = []
-        if (len(argres) > 0) :
-            for j in range(0,len(argres)):
-                argres[j] = int(argres[j])
         if (isinstance(path,str)):
             path = path.encode('utf-8')
-        if (name.endswith(path)):
-            result = argres
+        if self.doc.endswith(pos, path):
+            result = self.doc.values(pos)
         return result
 
     def getDataTemp(self, path):
+        # returns the first node ending with path that was not
+        # returned before
         result = None
-        cnt = len(self.temp)
-        for j in range(cnt):
-            item = self.temp[j]
-            if item.find(b'=') >= 0:
-                (name, argt) = item.split(b'=')
-                argres = argt.split(b'|')
-            else:
-                name = item
-                argres = []
-            if (isinstance(path,str)):
-                path = path.encode('utf-8')
-            if (name.endswith(path)):
-                result = argres
-                self.temp.pop(j)
-                break
-        if (len(argres) > 0) :
-            for j in range(0,len(argres)):
-                argres[j] = int(argres[j])
+        plist = self.doc.positions(path)
+        i = self.tempnext.get(path, 0)
+        while i < len(plist) and plist[i] in self.tempused:
+            i += 1
+        if i < len(plist):
+            pos = plist[i]
+            self.tempused.add(pos)
+            result = self.doc.values(pos)
+            i += 1
+        self.tempnext[path] = i
         return result
 
     def getImages(self):
         result = []
-        self.temp = self.flatdoc
+        self.tempused = set()
+        self.tempnext = {}
         while (self.getDataTemp('img') != None):
             h = self.getDataTemp('img.h')[0]
             w = self.getDataTemp('img.w')[0]
@@ -179,16 +127,15 @@ class PParser(object):
                 glyphs.append(j)
             glyphs.sort()
             for gid in glyphs:
-                id='id="gl%d"' % gid
-                path = self.gd.lookup(id)
+                path = self.gd.lookup(gid)
                 if path:
-                    result.append(id + ' ' + path)
+                    result.append('id="gl%d" ' % gid + path)
         return result
 
 
-def convert2SVG(gdict, flat_xml, pageid, previd, nextid, svgDir, raw, meta_array, scaledpi):
+def convert2SVG(gdict, doc, pageid, previd, nextid, svgDir, raw, meta_array, scaledpi):
     mlst = []
-    pp = PParser(gdict, flat_xml, meta_array)
+    pp = PParser(gdict, doc, meta_array)
     mlst.append('<?xml version="1.0" standalone="no"?>\n')
     if (raw):
         mlst.append('<!DOCTYPE svg PUBLIC "-//W3C/DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
@@ -31,9 +31,14 @@ class SafeUnbuffered:
 import sys
 import csv
 import os
+import io
+import collections
+import itertools
+import operator
 import getopt
 from struct import pack
 from struct import unpack
+from array import array
 
 #@@CALIBRE_COMPAT_CODE@@
 
@@ -42,6 +47,8 @@ class TpzDRMError(Exception):
     pass
 
 # local support routines
+import topazstore
+import topazreader
 import convert2xml
 import flatxml2html
 import flatxml2svg
@@ -50,56 +57,20 @@ import stylexml2css
 # global switch
 buildXML = False
 
-# Get a 7 bit encoded number from a file
-def readEncodedNumber(file):
-    flag = False
-    c = file.read(1)
-    if (len(c) == 0):
-        return None
-    data = ord(c)
-    if data == 0xFF:
-        flag = True
-        c = file.read(1)
-        if (len(c) == 0):
-            return None
-        data = ord(c)
-    if data >= 0x80:
-        datax = (data & 0x7F)
-        while data >= 0x80 :
-            c = file.read(1)
-            if (len(c) == 0):
-                return None
-            data = ord(c)
-            datax = (datax <<7) + (data & 0x7F)
-        data = datax
-    if flag:
-        data = -data
-    return data
-
-# Get a length prefixed string from the file
-def lengthPrefixString(data):
-    return encodeNumber(len(data))+data
-
-def readString(file):
-    stringLength = readEncodedNumber(file)
-    if (stringLength == None):
-        return None
-    sv = file.read(stringLength)
-    if (len(sv)  != stringLength):
-        return ""
-    return unpack(str(stringLength)+"s",sv)[0]
-
 def getMetaArray(metaFile):
     # parse the meta file
     result = {}
-    fo = open(metaFile,'rb')
-    size = readEncodedNumber(fo)
+    fo = metaFile
+    if isinstance(metaFile, str):
+        fo = open(metaFile,'rb')
+    reader = topazreader.TopazReader(fo.read())
+    fo.close()
+    size = reader.readNumber()
     for i in range(size):
-        tag = readString(fo)
-        value = readString(fo)
+        tag = reader.readString()
+        value = reader.readString()
         result[tag] = value
         # print(tag, value)
-    fo.close()
     return result
 
 
@@ -108,12 +79,24 @@ class Dictionary(object):
     def __init__(self, dictFile):
         self.filename = dictFile
         self.size = 0
-        self.fo = open(dictFile,'rb')
+        fo = dictFile
+        if isinstance(dictFile, str):
+            fo = open(dictFile,'rb')
+        reader = topazreader.TopazReader(fo.read())
+        fo.close()
         self.stable = []
-        self.size = readEncodedNumber(self.fo)
+        self.size = reader.readNumber()
         for i in range(self.size):
-            self.stable.append(self.escapestr(readString(self.fo)))
+            self.stable.append(self.escapestr(reader.readString()))
         self.pos = 0
+        # the tag paths of the pages of this book
+        self.tagpaths = convert2xml.TagPaths()
+    def __getstate__(self):
+        # for the page rendering workers, they don't need the (closed) file
+        state = self.__dict__.copy()
+        if not isinstance(self.filename, str):
+            state['filename'] = None
+        return state
     def escapestr(self, str):
         str = str.replace(b'&',b'&amp;')
         str = str.replace(b'<',b'&lt;')
@@ -135,29 +118,15 @@ class Dictionary(object):
 
 
 class PageDimParser(object):
-    def __init__(self, flatxml):
-        self.flatdoc = flatxml.split(b'\n')
+    def __init__(self, doc):
+        # convert2xml.PageDoc of the page
+        self.doc = doc
     # find tag if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
         result = None
-        docList = self.flatdoc
-        cnt = len(docList)
-        if end == -1 :
-            end = cnt
-        else:
-            end = min(cnt,end)
-        foundat = -1
-        for j in range(pos, end):
-            item = docList[j]
-            if item.find(b'=') >= 0:
-                (name, argres) = item.split(b'=')
-            else :
-                name = item
-                argres = ''
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
+        foundat = self.doc.find(tagpath, pos, end)
+        if foundat >= 0 :
+            result = self.doc.text(foundat)
         return foundat, result
     def process(self):
         (pos, sph) = self.findinDoc(b'page.h',0,-1)
@@ -166,15 +135,16 @@ class PageDimParser(object):
         if (spw == None): spw = '-1'
         return sph, spw
 
-def getPageDim(flatxml):
+def getPageDim(doc):
     # create a document parser
-    dp = PageDimParser(flatxml)
+    dp = PageDimParser(doc)
     (ph, pw) = dp.process()
     return ph, pw
 
 class GParser(object):
-    def __init__(self, flatxml):
-        self.flatdoc = flatxml.split(b'\n')
+    def __init__(self, doc):
+        # convert2xml.PageDoc of the glyphs file
+        self.doc = doc
         self.dpi = 1440
         self.gh = self.getData(b'info.glyph.h')
         self.gw = self.getData(b'info.glyph.w')
@@ -198,154 +168,302 @@ class GParser(object):
         elif self.gvtx :
             self.gvtx.append(0)
     def getData(self, path):
-        result = None
-        cnt = len(self.flatdoc)
-        for j in range(cnt):
-            item = self.flatdoc[j]
-            if item.find(b'=') >= 0:
-                (name, argt) = item.split(b'=')
-                argres = argt.split(b'|')
-            else:
-                name = item
-                argres = []
-            if (name == path):
-                result = argres
-                break
-        if (len(argres) > 0) :
-            for j in range(0,len(argres)):
-                argres[j] = int(argres[j])
-        return result
+        # the tag path has to match exactly
+        plist = self.doc.exactPositions(path)
+        if len(plist) == 0:
+            return None
+        return self.doc.values(plist[0])
     def getGlyphDim(self, gly):
         if self.gdpi[gly] == 0:
             return 0, 0
         maxh = (self.gh[gly] * self.dpi) / self.gdpi[gly]
         maxw = (self.gw[gly] * self.dpi) / self.gdpi[gly]
         return maxh, maxw
-    def getPath(self, gly):
-        path = ''
-        if (gly < 0) or (gly >= self.count):
-            return path
-        tx = self.vx[self.gvtx[gly]:self.gvtx[gly+1]]
-        ty = self.vy[self.gvtx[gly]:self.gvtx[gly+1]]
-        p = 0
-        for k in range(self.glen[gly], self.glen[gly+1]):
-            if (p == 0):
-                zx = tx[0:self.vlen[k]+1]
-                zy = ty[0:self.vlen[k]+1]
-            else:
-                zx = tx[self.vlen[k-1]+1:self.vlen[k]+1]
-                zy = ty[self.vlen[k-1]+1:self.vlen[k]+1]
-            p += 1
-            j = 0
-            while ( j  < len(zx) ):
-                if (j == 0):
-                    # Start Position.
-                    path += 'M %d %d ' % (zx[j] * self.dpi / self.gdpi[gly], zy[j] * self.dpi / self.gdpi[gly])
-                elif (j <= len(zx)-3):
-                    # Cubic Bezier Curve
-                    path += 'C %d %d %d %d %d %d ' % (zx[j] * self.dpi / self.gdpi[gly], zy[j] * self.dpi / self.gdpi[gly], zx[j+1] * self.dpi / self.gdpi[gly], zy[j+1] * self.dpi / self.gdpi[gly], zx[j+2] * self.dpi / self.gdpi[gly], zy[j+2] * self.dpi / self.gdpi[gly])
-                    j += 2
-                elif (j == len(zx)-2):
-                    # Cubic Bezier Curve to Start Position
-                    path += 'C %d %d %d %d %d %d ' % (zx[j] * self.dpi / self.gdpi[gly], zy[j] * self.dpi / self.gdpi[gly], zx[j+1] * self.dpi / self.gdpi[gly], zy[j+1] * self.dpi / self.gdpi[gly], zx[0] * self.dpi / self.gdpi[gly], zy[0] * self.dpi / self.gdpi[gly])
-                    j += 1
-                elif (j == len(zx)-1):
-                    # Quadratic Bezier Curve to Start Position
-                    path += 'Q %d %d %d %d ' % (zx[j] * self.dpi / self.gdpi[gly], zy[j] * self.dpi / self.gdpi[gly], zx[0] * self.dpi / self.gdpi[gly], zy[0] * self.dpi / self.gdpi[gly])
-
-                j += 1
-        path += 'z'
+    def getScaledVertices(self):
+        # all vertices of the file at self.dpi, as one array x0, y0, x1,
+        # y1, ...; scaled with one factor if all glyphs have the same
+        # resolution (they usually do), else each with that of its glyph
+        vx = self.vx or []
+        vy = self.vy or []
+        count = min(len(vx), len(vy))
+        dpis = set(self.gdpi or [])
+        if len(dpis) == 1 and 0 not in dpis:
+            xs = scaleVertices(vx[:count], self.dpi, self.gdpi[0])
+            ys = scaleVertices(vy[:count], self.dpi, self.gdpi[0])
+        else:
+            # the resolution of every vertex, from the glyph it belongs to
+            vdpi = [self.dpi] * count
+            for gly in range(self.count):
+                if self.glen[gly] < self.glen[gly+1]:
+                    start, end, step = slice(self.gvtx[gly], self.gvtx[gly+1]).indices(count)
+                    vdpi[start:end] = [self.gdpi[gly]] * max(0, end - start)
+            dpi = self.dpi
+            xs = [int(v * dpi / d) for v, d in zip(vx, vdpi)]
+            ys = [int(v * dpi / d) for v, d in zip(vy, vdpi)]
+        xy = [0] * (2 * count)
+        xy[0::2] = xs
+        xy[1::2] = ys
+        return convert2xml.numberArray(xy)
+
+# coordinates at glyph resolution gdpi -> at dpi, truncated the way the
+# %d in the svg path does it (exact integer arithmetic gives the same
+# numbers as the division in floating point for any realistic
+# coordinate, the values are far below 2**53)
+def scaleVertices(values, dpi, gdpi):
+    if gdpi > 0 and dpi % gdpi == 0:
+        return list(map(operator.mul, values, itertools.repeat(dpi // gdpi)))
+    if gdpi > 0 and (len(values) == 0 or min(values) >= 0):
+        return list(map(operator.floordiv, map(operator.mul, values, itertools.repeat(dpi)), itertools.repeat(gdpi)))
+    return [int(v * dpi / gdpi) for v in values]
+
+
+# Format strings for outlines of n vertices, taking x0, y0, x1, y1, ...
+# An outline starts with a move to its first vertex, then cubic curves
+# through the next three vertices each, and the last one or two vertices
+# go back to the start with a quadratic or cubic curve.
+_outline_formats = {}
+
+def outlineFormat(n):
+    fmt = _outline_formats.get(n)
+    if fmt is None:
+        vertex = lambda j: '{%d} {%d}' % (2 * j, 2 * j + 1)
+        plst = ['M ' + vertex(0)]
+        j = 1
+        while j <= n - 3:
+            plst.append('C %s %s %s' % (vertex(j), vertex(j + 1), vertex(j + 2)))
+            j += 3
+        if j == n - 2:
+            plst.append('C %s %s %s' % (vertex(j), vertex(j + 1), vertex(0)))
+        elif j == n - 1:
+            plst.append('Q %s %s' % (vertex(j), vertex(0)))
+        fmt = ' '.join(plst)
+        _outline_formats[n] = fmt
+    return fmt
+
+
+# all glyphs of the book by glyph id (glyph file number * 256 + number
+# of the glyph in the file)
+class GlyphTable(object):
+    # Every glyph is kept as numbers: the scaled vertices of its glyph
+    # file (shared by all glyphs of the file), where each of its outlines
+    # starts and ends in them, and its width and height. The svg path
+    # definitions are only put together when asked for, and kept.
+    def __init__(self):
+        self.glyphs = {}
+        self.paths = {}
+    def __getstate__(self):
+        # for the page rendering workers, they make their own paths
+        state = self.__dict__.copy()
+        state['paths'] = {}
+        return state
+    def addGlyphs(self, base, gp):
+        # all glyphs of a glyph file, from its GParser
+        xy = gp.getScaledVertices()
+        count = len(xy) // 2
+        for gly in range(gp.count):
+            maxh, maxw = gp.getGlyphDim(gly)
+            outlines = ()
+            if gp.glen[gly] < gp.glen[gly+1]:
+                # the vertices of the glyph, and each outline in them
+                first, last, step = slice(gp.gvtx[gly], gp.gvtx[gly+1]).indices(count)
+                size = max(0, last - first)
+                ends = [k + 1 for k in gp.vlen[gp.glen[gly]:gp.glen[gly+1]]]
+                starts = [0] + ends[:-1]
+                olst = []
+                for start, end in zip(starts, ends):
+                    if not (0 <= start <= end <= size):
+                        start, end, step = slice(start, end).indices(size)
+                        end = max(start, end)
+                    olst += (first + start, first + end)
+                outlines = tuple(olst)
+            self.glyphs[base + gly] = (xy, outlines, int(maxw), int(maxh))
+    def getSize(self, id):
+        # width and height
+        glyph = self.glyphs.get(id)
+        if glyph is None:
+            return None
+        return glyph[2], glyph[3]
+    def getPath(self, id):
+        xy, outlines, maxw, maxh = self.glyphs[id]
+        plst = []
+        for c in range(0, len(outlines), 2):
+            n = outlines[c+1] - outlines[c]
+            if n > 0:
+                plst.append(outlineFormat(n).format(*xy[2*outlines[c]:2*outlines[c+1]]))
+        plst.append('z')
+        return ' '.join(plst)
+    def lookup(self, id):
+        # the svg definition of the glyph, or None
+        path = self.paths.get(id)
+        if path is None:
+            glyph = self.glyphs.get(id)
+            if glyph is None:
+                return None
+            path = '<path id="gl%d" d="%s" fill="black" /><!-- width=%d height=%d -->\n' % (id, self.getPath(id), glyph[2], glyph[3])
+            self.paths[id] = path
         return path
 
 
+# Number of processes used to render the pages of a book.
+# None means a single one, the pages are rendered in this process:
+# starting processes doesn't work reliably inside calibre, so that is
+# only done if the number of jobs is set explicitly (the standalone tool
+# does that).
+RENDER_JOBS = None
 
-# dictionary of all text strings by index value
-class GlyphDict(object):
+def setRenderJobs(jobs):
+    global RENDER_JOBS
+    RENDER_JOBS = jobs
+
+# Returns the number of processes to render numpages pages with.
+def renderJobs(numpages):
+    if RENDER_JOBS is None or numpages < 2:
+        return 1
+    return RENDER_JOBS
+
+
+# What rendering a page needs besides the page itself (the dictionary,
+# the glyphs, the css classes and the settings), set once per worker.
+_render_state = None
+
+def _initRenderer(state):
+    global _render_state
+    _render_state = state
+
+class _ImageCollector(object):
+    # Keeps the images flatxml2html writes for a page, so they can be
+    # sent back with the page and written to the real store in order.
+    # flatxml2html only ever writes to its store.
     def __init__(self):
-        self.gdict = {}
-    def lookup(self, id):
-        # id='id="gl%d"' % val
-        if id in self.gdict:
-            return self.gdict[id]
-        return None
-    def addGlyph(self, val, path):
-        id='id="gl%d"' % val
-        self.gdict[id] = path
+        self.files = []
+    def write(self, path, data):
+        self.files.append((path, data))
+
+# Renders the html of some pages and the svg page they make up.
+# job is (pageid, previd, nextid, pages), pages a list of (page number,
+# page file name, page data); pageid is None for pages that aren't part
+# of any svg page. Returns the html and toc entries of every page, the
+# svg page (or None) and the images written while rendering.
+def _renderPages(job):
+    state = _render_state
+    pageid, previd, nextid, pages = job
+    images = _ImageCollector()
+    htmls = []
+    docs = []
+    for pnum, fname, data in pages:
+        pagedoc = convert2xml.getDoc(state['dict'], io.BytesIO(data))
+        pagehtml, tocinfo = flatxml2html.convert2HTML(pagedoc, state['classlst'], fname, images, state['gd'], state['fixedimage'])
+        htmls.append((pnum, pagehtml, tocinfo))
+        docs.append(pagedoc)
+    svgxml = None
+    if pageid is not None:
+        if len(docs) == 1:
+            svgdoc = docs[0]
+        else:
+            svgdoc = convert2xml.PageDoc.join(docs)
+        svgxml = flatxml2svg.convert2SVG(state['gd'], svgdoc, pageid, previd, nextid, state['svgDir'], state['raw'], state['meta_array'], state['scaledpi'])
+    return htmls, svgxml, images.files
+
+# Renders the jobs with numjobs worker processes, yielding the results
+# in the order of jobs. load(job) reads the pages of a job; only a few
+# jobs per worker are read or waiting to be written at any time. If the
+# workers can't be started (or die), the rest is rendered here.
+def _renderedPages(jobs, load, state, numjobs):
+    done = 0
+    if numjobs > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            with ProcessPoolExecutor(max_workers=numjobs, initializer=_initRenderer, initargs=(state,)) as executor:
+                pending = collections.deque()
+                for job in jobs:
+                    pending.append(executor.submit(_renderPages, load(job)))
+                    if len(pending) >= 2 * numjobs:
+                        result = pending.popleft().result()
+                        done += 1
+                        yield result
+                while pending:
+                    result = pending.popleft().result()
+                    done += 1
+                    yield result
+        except (BrokenProcessPool, OSError) as e:
+            print("Could not render pages in parallel ({0}), continuing in a single process".format(e))
+    _initRenderer(state)
+    for job in jobs[done:]:
+        yield _renderPages(load(job))
 
 
 def generateBook(bookDir, raw, fixedimage):
-    # sanity check Topaz file extraction
-    if not os.path.exists(bookDir) :
-        print("Can not find directory with unencrypted book")
-        return 1
+    # bookDir is either the directory with the unencrypted Topaz files
+    # or a topazstore.TopazStore holding them
+    if isinstance(bookDir, str):
+        # sanity check Topaz file extraction
+        if not os.path.exists(bookDir) :
+            print("Can not find directory with unencrypted book")
+            return 1
+        store = topazstore.TopazDirStore(bookDir)
+    else:
+        store = bookDir
 
-    dictFile = os.path.join(bookDir,'dict0000.dat')
-    if not os.path.exists(dictFile) :
+    dictFile = 'dict0000.dat'
+    if not store.exists(dictFile) :
         print("Can not find dict0000.dat file")
         return 1
 
-    pageDir = os.path.join(bookDir,'page')
-    if not os.path.exists(pageDir) :
+    pageDir = 'page'
+    if not store.exists(pageDir) :
         print("Can not find page directory in unencrypted book")
         return 1
 
-    imgDir = os.path.join(bookDir,'img')
-    if not os.path.exists(imgDir) :
+    imgDir = 'img'
+    if not store.exists(imgDir) :
         print("Can not find image directory in unencrypted book")
         return 1
 
-    glyphsDir = os.path.join(bookDir,'glyphs')
-    if not os.path.exists(glyphsDir) :
+    glyphsDir = 'glyphs'
+    if not store.exists(glyphsDir) :
         print("Can not find glyphs directory in unencrypted book")
         return 1
 
-    metaFile = os.path.join(bookDir,'metadata0000.dat')
-    if not os.path.exists(metaFile) :
+    metaFile = 'metadata0000.dat'
+    if not store.exists(metaFile) :
         print("Can not find metadata0000.dat in unencrypted book")
         return 1
 
-    svgDir = os.path.join(bookDir,'svg')
-    if not os.path.exists(svgDir) :
-        os.makedirs(svgDir)
+    svgDir = 'svg'
 
     if buildXML:
-        xmlDir = os.path.join(bookDir,'xml')
-        if not os.path.exists(xmlDir) :
-            os.makedirs(xmlDir)
+        xmlDir = 'xml'
 
-    otherFile = os.path.join(bookDir,'other0000.dat')
-    if not os.path.exists(otherFile) :
+    otherFile = 'other0000.dat'
+    if not store.exists(otherFile) :
         print("Can not find other0000.dat in unencrypted book")
         return 1
 
     print("Updating to color images if available")
-    spath = os.path.join(bookDir,'color_img')
-    dpath = os.path.join(bookDir,'img')
-    filenames = os.listdir(spath)
+    spath = 'color_img'
+    dpath = 'img'
+    filenames = []
+    if store.exists(spath):
+        filenames = store.listdir(spath)
     filenames = sorted(filenames)
     for filename in filenames:
         imgname = filename.replace('color','img')
-        sfile = os.path.join(spath,filename)
-        dfile = os.path.join(dpath,imgname)
-        imgdata = open(sfile,'rb').read()
-        open(dfile,'wb').write(imgdata)
+        store.copy(spath + '/' + filename, dpath + '/' + imgname)
 
     print("Creating cover.jpg")
     isCover = False
-    cpath = os.path.join(bookDir,'img')
-    cpath = os.path.join(cpath,'img0000.jpg')
-    if os.path.isfile(cpath):
-        cover = open(cpath, 'rb').read()
-        cpath = os.path.join(bookDir,'cover.jpg')
-        open(cpath, 'wb').write(cover)
+    cpath = 'img/img0000.jpg'
+    if store.exists(cpath):
+        store.copy(cpath, 'cover.jpg')
         isCover = True
 
 
     print('Processing Dictionary')
-    dict = Dictionary(dictFile)
+    dict = Dictionary(store.open(dictFile))
 
     print('Processing Meta Data and creating OPF')
-    meta_array = getMetaArray(metaFile)
+    meta_array = getMetaArray(store.open(metaFile))
 
     # replace special chars in title and authors like & < >
     title = meta_array.get('Title','No Title Provided')
@@ -360,13 +478,13 @@ def generateBook(bookDir, raw, fixedimage):
     meta_array['Authors'] = authors
 
     if buildXML:
-        xname = os.path.join(xmlDir, 'metadata.xml')
+        xname = xmlDir + '/metadata.xml'
         mlst = []
         for key in meta_array:
             mlst.append('<meta name="' + key + '" content="' + meta_array[key] + '" />\n')
         metastr = "".join(mlst)
         mlst = None
-        open(xname, 'wb').write(metastr)
+        store.write(xname, metastr)
 
     print('Processing StyleSheet')
 
@@ -379,7 +497,7 @@ def generateBook(bookDir, raw, fixedimage):
 
     # also get the size of a normal text page
     # get the total number of pages unpacked as a safety check
-    filenames = os.listdir(pageDir)
+    filenames = store.listdir(pageDir)
     numfiles = len(filenames)
 
     spage = '1'
@@ -394,10 +512,10 @@ def generateBook(bookDir, raw, fixedimage):
 
     # get page height and width from first text page for use in stylesheet scaling
     pname = 'page%04d.dat' % (pnum - 1)
-    fname = os.path.join(pageDir,pname)
-    flat_xml = convert2xml.fromData(dict, fname)
+    fname = pageDir + '/' + pname
+    pagedoc = convert2xml.getDoc(dict, store.open(fname))
 
-    (ph, pw) = getPageDim(flat_xml)
+    (ph, pw) = getPageDim(pagedoc)
     if (ph == '-1') or (ph == '0') : ph = '11000'
     if (pw == '-1') or (pw == '0') : pw = '8500'
     meta_array['pageHeight'] = ph
@@ -408,14 +526,14 @@ def generateBook(bookDir, raw, fixedimage):
     # process other.dat for css info and for map of page files to svg images
     # this map is needed because some pages actually are made up of multiple
     # pageXXXX.xml files
-    xname = os.path.join(bookDir, 'style.css')
-    flat_xml = convert2xml.fromData(dict, otherFile)
+    xname = 'style.css'
+    styledoc = convert2xml.getDoc(dict, store.open(otherFile))
 
     # extract info.original.pid to get original page information
     pageIDMap = {}
-    pageidnums = stylexml2css.getpageIDMap(flat_xml)
+    pageidnums = stylexml2css.getpageIDMap(styledoc)
     if len(pageidnums) == 0:
-        filenames = os.listdir(pageDir)
+        filenames = store.listdir(pageDir)
         numfiles = len(filenames)
         for k in range(numfiles):
             pageidnums.append(k)
@@ -428,45 +546,43 @@ def generateBook(bookDir, raw, fixedimage):
             pageIDMap[id] = [i]
 
     # now get the css info
-    cssstr , classlst = stylexml2css.convert2CSS(flat_xml, fontsize, ph, pw)
-    open(xname, 'w').write(cssstr)
+    cssstr , classlst = stylexml2css.convert2CSS(styledoc, fontsize, ph, pw)
+    store.write(xname, cssstr)
     if buildXML:
-        xname = os.path.join(xmlDir, 'other0000.xml')
-        open(xname, 'wb').write(convert2xml.getXML(dict, otherFile))
+        xname = xmlDir + '/other0000.xml'
+        store.write(xname, convert2xml.getXML(dict, store.open(otherFile)))
 
     print('Processing Glyphs')
-    gd = GlyphDict()
-    filenames = os.listdir(glyphsDir)
+    gd = GlyphTable()
+    filenames = store.listdir(glyphsDir)
     filenames = sorted(filenames)
-    glyfname = os.path.join(svgDir,'glyphs.svg')
-    glyfile = open(glyfname, 'w')
-    glyfile.write('<?xml version="1.0" standalone="no"?>\n')
-    glyfile.write('<!DOCTYPE svg PUBLIC "-//W3C/DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
-    glyfile.write('<svg width="512" height="512" viewBox="0 0 511 511" xmlns="http://www.w3.org/2000/svg" version="1.1">\n')
-    glyfile.write('<title>Glyphs for %s</title>\n' % meta_array['Title'])
-    glyfile.write('<defs>\n')
+    glyfname = svgDir + '/glyphs.svg'
+    glyfile = []
+    glyfile.append('<?xml version="1.0" standalone="no"?>\n')
+    glyfile.append('<!DOCTYPE svg PUBLIC "-//W3C/DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
+    glyfile.append('<svg width="512" height="512" viewBox="0 0 511 511" xmlns="http://www.w3.org/2000/svg" version="1.1">\n')
+    glyfile.append('<title>Glyphs for %s</title>\n' % meta_array['Title'])
+    glyfile.append('<defs>\n')
     counter = 0
     for filename in filenames:
         # print '     ', filename
         print('.', end=' ')
-        fname = os.path.join(glyphsDir,filename)
-        flat_xml = convert2xml.fromData(dict, fname)
+        fname = glyphsDir + '/' + filename
+        glyphdoc = convert2xml.getDoc(dict, store.open(fname))
 
         if buildXML:
-            xname = os.path.join(xmlDir, filename.replace('.dat','.xml'))
-            open(xname, 'wb').write(convert2xml.getXML(dict, fname))
+            xname = xmlDir + '/' + filename.replace('.dat','.xml')
+            store.write(xname, convert2xml.getXML(dict, store.open(fname)))
 
-        gp = GParser(flat_xml)
+        gp = GParser(glyphdoc)
+        gd.addGlyphs(counter * 256, gp)
         for i in range(0, gp.count):
-            path = gp.getPath(i)
-            maxh, maxw = gp.getGlyphDim(i)
-            fullpath = '<path id="gl%d" d="%s" fill="black" /><!-- width=%d height=%d -->\n' % (counter * 256 + i, path, maxw, maxh)
-            glyfile.write(fullpath)
-            gd.addGlyph(counter * 256 + i, fullpath)
+            glyfile.append(gd.lookup(counter * 256 + i))
         counter += 1
-    glyfile.write('</defs>\n')
-    glyfile.write('</svg>\n')
-    glyfile.close()
+    glyfile.append('</defs>\n')
+    glyfile.append('</svg>\n')
+    store.write(glyfname, "".join(glyfile))
+    glyfile = None
     print(" ")
 
 
@@ -494,36 +610,102 @@ def generateBook(bookDir, raw, fixedimage):
     # readability when rendering to the screen.
     scaledpi = 1440.0
 
-    filenames = os.listdir(pageDir)
+    filenames = store.listdir(pageDir)
     filenames = sorted(filenames)
     numfiles = len(filenames)
 
-    xmllst = []
-    elst = []
-
-    for filename in filenames:
-        # print '     ', filename
-        print(".", end=' ')
-        fname = os.path.join(pageDir,filename)
-        flat_xml = convert2xml.fromData(dict, fname)
-
-        # keep flat_xml for later svg processing
-        xmllst.append(flat_xml)
+    # one job for each svg page, with the page files it is made of, and
+    # one for every page file that isn't part of any svg page
+    jobs = []
+    idlst = sorted(pageIDMap.keys())
+    cnt = len(idlst)
+    previd = None
+    for j in range(cnt):
+        pageid = idlst[j]
+        if j < cnt - 1:
+            nextid = idlst[j+1]
+        else:
+            nextid = None
+        jobs.append((pageid, previd, nextid, pageIDMap[pageid]))
+        previd = pageid
+    for i in range(numfiles):
+        if i >= len(pageidnums):
+            jobs.append((None, None, None, [i]))
+
+    def load(job):
+        pageid, previd, nextid, pagelst = job
+        pages = []
+        for i in pagelst:
+            fname = pageDir + '/' + filenames[i]
+            if buildXML:
+                xname = xmlDir + '/' + filenames[i].replace('.dat','.xml')
+                store.write(xname, convert2xml.getXML(dict, store.open(fname)))
+            pages.append((i, fname, store.read(fname)))
+        return (pageid, previd, nextid, pages)
+
+    state = {
+        'dict': dict,
+        'gd': gd,
+        'classlst': classlst,
+        'fixedimage': fixedimage,
+        'svgDir': svgDir,
+        'raw': raw,
+        'meta_array': meta_array,
+        'scaledpi': scaledpi,
+    }
+
+    # the svg pages are written as they come in, the html has to wait
+    # for all pages to be done
+    pagehtml = [None] * numfiles
+    elst = [''] * numfiles
 
-        if buildXML:
-            xname = os.path.join(xmlDir, filename.replace('.dat','.xml'))
-            open(xname, 'wb').write(convert2xml.getXML(dict, fname))
+    slst = []
+    slst.append('<?xml version="1.0" encoding="utf-8"?>\n')
+    slst.append('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n')
+    slst.append('<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" >')
+    slst.append('<head>\n')
+    slst.append('<title>' + meta_array['Title'] + '</title>\n')
+    slst.append('<meta name="Author" content="' + meta_array['Authors'] + '" />\n')
+    slst.append('<meta name="Title" content="' + meta_array['Title'] + '" />\n')
+    if 'ASIN' in meta_array:
+        slst.append('<meta name="ASIN" content="' + meta_array['ASIN'] + '" />\n')
+    if 'GUID' in meta_array:
+        slst.append('<meta name="GUID" content="' + meta_array['GUID'] + '" />\n')
+    slst.append('</head>\n')
+    slst.append('<body>\n')
+    slst.append('<h2>List of Pages</h2>\n')
+    slst.append('<div>\n')
 
-        # first get the html
-        pagehtml, tocinfo = flatxml2html.convert2HTML(flat_xml, classlst, fname, bookDir, gd, fixedimage)
-        elst.append(tocinfo)
-        hlst.append(pagehtml)
+    numjobs = renderJobs(numfiles)
+    for job, result in zip(jobs, _renderedPages(jobs, load, state, numjobs)):
+        pageid = job[0]
+        htmls, svgxml, images = result
+        for path, data in images:
+            store.write(path, data)
+        for pnum, html, tocinfo in htmls:
+            print(".", end=' ')
+            pagehtml[pnum] = html
+            elst[pnum] = tocinfo
+        if pageid is None:
+            continue
+        if (raw) :
+            pfile = svgDir + '/page%04d.svg' % pageid
+            slst.append('<a href="svg/page%04d.svg">Page %d</a>\n' % (pageid, pageid))
+        else :
+            pfile = svgDir + '/page%04d.xhtml' % pageid
+            slst.append('<a href="svg/page%04d.xhtml">Page %d</a>\n' % (pageid, pageid))
+        store.write(pfile, svgxml)
+    slst.append('</div>\n')
+    slst.append('<h2><a href="svg/toc.xhtml">Table of Contents</a></h2>\n')
+    slst.append('</body>\n</html>\n')
 
     # finish up the html string and output it
+    hlst.extend(pagehtml)
+    pagehtml = None
     hlst.append('</body>\n</html>\n')
     htmlstr = "".join(hlst)
     hlst = None
-    open(os.path.join(bookDir, htmlFileName), 'w').write(htmlstr)
+    store.write(htmlFileName, htmlstr)
 
     print(" ")
     print('Extracting Table of Contents from Amazon OCR')
@@ -569,67 +751,16 @@ def generateBook(bookDir, raw, fixedimage):
     tlst.append('</body>\n')
     tlst.append('</html>\n')
     tochtml = "".join(tlst)
-    open(os.path.join(svgDir, 'toc.xhtml'), 'w').write(tochtml)
-
-
-    # now create index_svg.xhtml that points to all required files
-    slst = []
-    slst.append('<?xml version="1.0" encoding="utf-8"?>\n')
-    slst.append('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n')
-    slst.append('<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" >')
-    slst.append('<head>\n')
-    slst.append('<title>' + meta_array['Title'] + '</title>\n')
-    slst.append('<meta name="Author" content="' + meta_array['Authors'] + '" />\n')
-    slst.append('<meta name="Title" content="' + meta_array['Title'] + '" />\n')
-    if 'ASIN' in meta_array:
-        slst.append('<meta name="ASIN" content="' + meta_array['ASIN'] + '" />\n')
-    if 'GUID' in meta_array:
-        slst.append('<meta name="GUID" content="' + meta_array['GUID'] + '" />\n')
-    slst.append('</head>\n')
-    slst.append('<body>\n')
+    store.write(svgDir + '/toc.xhtml', tochtml)
 
-    print("Building svg images of each book page")
-    slst.append('<h2>List of Pages</h2>\n')
-    slst.append('<div>\n')
-    idlst = sorted(pageIDMap.keys())
-    numids = len(idlst)
-    cnt = len(idlst)
-    previd = None
-    for j in range(cnt):
-        pageid = idlst[j]
-        if j < cnt - 1:
-            nextid = idlst[j+1]
-        else:
-            nextid = None
-        print('.', end=' ')
-        pagelst = pageIDMap[pageid]
-        flst = []
-        for page in pagelst:
-            flst.append(xmllst[page])
-        flat_svg = b"".join(flst)
-        flst=None
-        svgxml = flatxml2svg.convert2SVG(gd, flat_svg, pageid, previd, nextid, svgDir, raw, meta_array, scaledpi)
-        if (raw) :
-            pfile = open(os.path.join(svgDir,'page%04d.svg' % pageid),'w')
-            slst.append('<a href="svg/page%04d.svg">Page %d</a>\n' % (pageid, pageid))
-        else :
-            pfile = open(os.path.join(svgDir,'page%04d.xhtml' % pageid), 'w')
-            slst.append('<a href="svg/page%04d.xhtml">Page %d</a>\n' % (pageid, pageid))
-        previd = pageid
-        pfile.write(svgxml)
-        pfile.close()
-        counter += 1
-    slst.append('</div>\n')
-    slst.append('<h2><a href="svg/toc.xhtml">Table of Contents</a></h2>\n')
-    slst.append('</body>\n</html>\n')
     svgindex = "".join(slst)
     slst = None
-    open(os.path.join(bookDir, 'index_svg.xhtml'), 'w').write(svgindex)
+    store.write('index_svg.xhtml', svgindex)
 
     print(" ")
 
     # build the opf file
-    opfname = os.path.join(bookDir, 'book.opf')
+    opfname = 'book.opf'
     olst = []
     olst.append('<?xml version="1.0" encoding="utf-8"?>\n')
     olst.append('<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="guid_id">\n')
@@ -652,7 +783,7 @@ def generateBook(bookDir, raw, fixedimage):
     olst.append('   <item id="book" href="book.html" media-type="application/xhtml+xml"/>\n')
     olst.append('   <item id="stylesheet" href="style.css" media-type="text/css"/>\n')
     # adding image files to manifest
-    filenames = os.listdir(imgDir)
+    filenames = store.listdir(imgDir)
     filenames = sorted(filenames)
     for filename in filenames:
         imgname, imgext = os.path.splitext(filename)
@@ -673,7 +804,7 @@ def generateBook(bookDir, raw, fixedimage):
     olst.append('</package>\n')
     opfstr = "".join(olst)
     olst = None
-    open(opfname, 'w').write(opfstr)
+    store.write(opfname, opfstr)
 
     print('Processing Complete')
 
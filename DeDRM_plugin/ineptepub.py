@@ -33,13 +33,15 @@
 #   7.1 - Add ignoble support, dropping the dedicated ignobleepub.py script
 #   7.2 - Only support PyCryptodome; clean up the code
 #   8.0 - Add support for "hardened" Adobe DRM (RMSDK >= 10)
+#   8.1 - Allow checking candidate keys against the book key before decrypting
+#   8.2 - Tell failed post-processing apart from a wrong key
 
 """
 Decrypt Adobe Digital Editions encrypted ePub books.
 """
 
 __license__ = 'GPL v3'
-__version__ = "8.0"
+__version__ = "8.2"
 
 import sys
 import os
@@ -52,6 +54,7 @@ from contextlib import closing
 from lxml import etree
 from uuid import UUID
 import hashlib
+from epubpipeline import PipelineStage, RemoveFileStage, processBook
 
 try:
     from Cryptodome.Cipher import AES, PKCS1_v1_5
@@ -140,6 +143,11 @@ class ADEPTError(Exception):
 class ADEPTNewVersionError(Exception):
     pass
 
+# Raised by DecryptionStage, so decryptBook can tell a wrong key apart
+# from a failure of the other stages.
+class ADEPTDecryptionError(ADEPTError):
+    pass
+
 META_NAMES = ('mimetype', 'META-INF/rights.xml')
 NSMAP = {'adept': 'http://ns.adobe.com/adept',
          'enc': 'http://www.w3.org/2001/04/xmlenc#'}
@@ -148,7 +156,7 @@ class Decryptor(object):
     def __init__(self, bookkey, encryption):
         enc = lambda tag: '{%s}%s' % (NSMAP['enc'], tag)
         self._aes = AES.new(bookkey, AES.MODE_CBC, b'\x00'*16)
-        encryption = etree.fromstring(encryption)
+        self._encryption = encryption = etree.fromstring(encryption)
         self._encrypted = encrypted = set()
         self._otherData = otherData = set()
 
@@ -203,6 +211,36 @@ class Decryptor(object):
             data = self.decompress(data)
         return data
 
+# Pipeline stage that decrypts all Adobe-encrypted files with the given book key
+class DecryptionStage(PipelineStage):
+    def __init__(self, bookkey):
+        self._bookkey = bookkey
+        self._decryptor = None
+
+    def prepare(self, pipeline):
+        encryption = pipeline.read('META-INF/encryption.xml')
+        try:
+            self._decryptor = Decryptor(self._bookkey, encryption)
+        except Exception as e:
+            raise ADEPTDecryptionError("Could not read encryption.xml: {0}".format(e))
+
+    def touches(self, path):
+        return path == "META-INF/encryption.xml" or path.encode('utf-8') in self._decryptor._encrypted
+
+    def transform(self, path, data):
+        if path == "META-INF/encryption.xml":
+            # Check if there's still something in there
+            if self._decryptor.check_if_remaining():
+                print("Adding encryption.xml for the remaining embedded files.")
+                # We removed DRM, but there's still stuff like obfuscated fonts.
+                return self._decryptor.get_xml().encode('utf-8')
+            return None
+        try:
+            return self._decryptor.decrypt(path, data)
+        except Exception as e:
+            # most likely the book key is wrong
+            raise ADEPTDecryptionError("Could not decrypt {0}: {1}".format(path, e))
+
 # check file to make check whether it's probably an Adobe Adept encrypted ePub
 def adeptBook(inpath):
     with closing(ZipFile(open(inpath, 'rb'))) as inf:
@@ -274,15 +312,94 @@ def removeHardening(rights, keytype, keydata):
 
     return unpad(AES.new(kek, AES.MODE_CBC, kekiv).decrypt(keydata), 16) # PKCS#7
 
-def decryptBook(userkey, inpath, outpath):
+def decryptBookKey(userkey, rights, bookkey, keytype):
+    # Unwraps the encrypted book key from rights.xml with the given user key.
+    # Returns None if the user key is the wrong one for this book.
+    if len(bookkey) != 64:
+        # Normal or "hardened" Adobe ADEPT
+        rsakey = RSA.import_key(userkey) # parses the ASN1 structure
+        bookkey = base64.b64decode(bookkey)
+        if int(keytype, 10) > 2:
+            bookkey = removeHardening(rights, keytype, bookkey)
+        try:
+            bookkey = PKCS1_v1_5.new(rsakey).decrypt(bookkey, None) # automatically unpads
+        except ValueError:
+            bookkey = None
+    else:
+        # Adobe PassHash / B&N
+        key = base64.b64decode(userkey)[:16]
+        bookkey = base64.b64decode(bookkey)
+        bookkey = unpad(AES.new(key, AES.MODE_CBC, b'\x00'*16).decrypt(bookkey), 16) # PKCS#7
+
+        if len(bookkey) > 16:
+            bookkey = bookkey[-16:]
+
+    return bookkey
+
+# Parses the license of an ePub once, so the plugin can check a list of
+# candidate keys against the encrypted book key instead of rewriting the
+# whole archive with every single key.
+class BookKeyMatcher(object):
+    def __init__(self, inpath):
+        enc = lambda tag: '{%s}%s' % (NSMAP['enc'], tag)
+        adept = lambda tag: '{%s}%s' % (NSMAP['adept'], tag)
+        with closing(ZipFile(open(inpath, 'rb'))) as inf:
+            self._rights = etree.fromstring(inf.read('META-INF/rights.xml'))
+            bookkeyelem = self._rights.find('.//%s' % (adept('encryptedKey'),))
+            self._bookkey = bookkeyelem.text
+            self._keytype = bookkeyelem.attrib.get('keyType', '0')
+
+            # Keep the tail of the smallest AES-encrypted member. A wrong
+            # book key is very unlikely to produce valid PKCS#7 padding there,
+            # which catches the PassHash keys that unwrap to garbage.
+            self._sample = None
+            encryption = etree.fromstring(inf.read('META-INF/encryption.xml'))
+            expr = './%s/%s/%s' % (enc('EncryptedData'), enc('CipherData'),
+                                   enc('CipherReference'))
+            candidates = []
+            for elem in encryption.findall(expr):
+                path = elem.get('URI', None)
+                method = elem.getparent().getparent().find("./%s" % (enc('EncryptionMethod')))
+                if path is None or method is None or method.get('Algorithm', None) != "http://www.w3.org/2001/04/xmlenc#aes128-cbc":
+                    continue
+                try:
+                    candidates.append((inf.getinfo(path).file_size, path))
+                except KeyError:
+                    pass
+            if len(candidates) > 0:
+                data = inf.read(min(candidates)[1])
+                if len(data) >= 32 and len(data) % 16 == 0:
+                    self._sample = data[-32:]
+
+    def check(self, userkey):
+        try:
+            bookkey = decryptBookKey(userkey, self._rights, self._bookkey, self._keytype)
+        except:
+            return False
+        if bookkey is None or len(bookkey) not in (16, 24, 32):
+            return False
+        if self._sample is None:
+            return True
+
+        # CBC: the last block only depends on the block before it.
+        data = AES.new(bookkey, AES.MODE_CBC, self._sample[:16]).decrypt(self._sample[16:])
+        # xmlenc padding: only the last byte (the length) is defined, the
+        # other padding bytes can be anything
+        pad_len = data[-1]
+        return 1 <= pad_len <= 16
+
+def decryptBook(userkey, inpath, outpath, stages=None):
+    # Any additional pipeline stages (font deobfuscation, watermark removal, ...)
+    # are run in the same pass that writes the decrypted book.
+    # Returns 0 on success, 1 if the book isn't an Adobe ePub, 2 if the key
+    # is wrong and 3 if the key is right, but another stage (or writing the
+    # book) failed; trying other keys won't help then.
     with closing(ZipFile(open(inpath, 'rb'))) as inf:
         namelist = inf.namelist()
         if 'META-INF/rights.xml' not in namelist or \
            'META-INF/encryption.xml' not in namelist:
             print("{0:s} is DRM-free.".format(os.path.basename(inpath)))
             return 1
-        for name in META_NAMES:
-            namelist.remove(name)
         try:
             rights = etree.fromstring(inf.read('META-INF/rights.xml'))
             adept = lambda tag: '{%s}%s' % (NSMAP['adept'], tag)
@@ -300,75 +417,24 @@ def decryptBook(userkey, inpath, outpath):
                 print("{0:s} is not an Adobe-protected ePub!".format(os.path.basename(inpath)))
                 return 1
 
-            if len(bookkey) != 64:
-                # Normal or "hardened" Adobe ADEPT
-                rsakey = RSA.import_key(userkey) # parses the ASN1 structure
-                bookkey = base64.b64decode(bookkey)
-                if int(keytype, 10) > 2:
-                    bookkey = removeHardening(rights, keytype, bookkey)
-                try:
-                    bookkey = PKCS1_v1_5.new(rsakey).decrypt(bookkey, None) # automatically unpads
-                except ValueError:
-                    bookkey = None
-
-                if bookkey is None:
-                    print("Could not decrypt {0:s}. Wrong key".format(os.path.basename(inpath)))
-                    return 2
-            else:
-                # Adobe PassHash / B&N
-                key = base64.b64decode(userkey)[:16]
-                bookkey = base64.b64decode(bookkey)
-                bookkey = unpad(AES.new(key, AES.MODE_CBC, b'\x00'*16).decrypt(bookkey), 16) # PKCS#7
-
-                if len(bookkey) > 16:
-                    bookkey = bookkey[-16:]
-
-            encryption = inf.read('META-INF/encryption.xml')
-            decryptor = Decryptor(bookkey, encryption)
-            kwds = dict(compression=ZIP_DEFLATED, allowZip64=False)
-            with closing(ZipFile(open(outpath, 'wb'), 'w', **kwds)) as outf:
-
-                for path in (["mimetype"] + namelist):
-                    data = inf.read(path)
-                    zi = ZipInfo(path)
-                    zi.compress_type=ZIP_DEFLATED
-
-                    if path == "mimetype":
-                        zi.compress_type = ZIP_STORED
-
-                    elif path == "META-INF/encryption.xml":
-                        # Check if there's still something in there
-                        if (decryptor.check_if_remaining()):
-                            data = decryptor.get_xml()
-                            print("Adding encryption.xml for the remaining embedded files.")
-                            # We removed DRM, but there's still stuff like obfuscated fonts.
-                        else:
-                            continue
-
-
-                    try:
-                        # get the file info, including time-stamp
-                        oldzi = inf.getinfo(path)
-                        # copy across useful fields
-                        zi.date_time = oldzi.date_time
-                        zi.comment = oldzi.comment
-                        zi.extra = oldzi.extra
-                        zi.internal_attr = oldzi.internal_attr
-                        # external attributes are dependent on the create system, so copy both.
-                        zi.external_attr = oldzi.external_attr
-                        zi.create_system = oldzi.create_system
-                        if any(ord(c) >= 128 for c in path) or any(ord(c) >= 128 for c in zi.comment):
-                            # If the file name or the comment contains any non-ASCII char, set the UTF8-flag
-                            zi.flag_bits |= 0x800
-                    except:
-                        pass
-                    if path == "META-INF/encryption.xml":
-                        outf.writestr(zi, data)
-                    else:
-                        outf.writestr(zi, decryptor.decrypt(path, data))
+            bookkey = decryptBookKey(userkey, rights, bookkey, keytype)
         except:
             print("Could not decrypt {0:s} because of an exception:\n{1:s}".format(os.path.basename(inpath), traceback.format_exc()))
             return 2
+    if bookkey is None:
+        print("Could not decrypt {0:s}. Wrong key".format(os.path.basename(inpath)))
+        return 2
+
+    # The rights.xml file is only needed for decryption, leave it out.
+    stages = [DecryptionStage(bookkey), RemoveFileStage('META-INF/rights.xml')] + list(stages or [])
+    try:
+        processBook(inpath, outpath, stages)
+    except ADEPTDecryptionError:
+        print("Could not decrypt {0:s} because of an exception:\n{1:s}".format(os.path.basename(inpath), traceback.format_exc()))
+        return 2
+    except:
+        print("Decrypted {0:s}, but could not write the book because of an exception:\n{1:s}".format(os.path.basename(inpath), traceback.format_exc()))
+        return 3
     return 0
 
 
@@ -50,13 +50,23 @@
 #   9.1.0 - Support for decrypting with owner password, support for V=5, R=5 and R=6 PDF files, support for AES256-encrypted PDFs.
 #   9.1.1 - Only support PyCryptodome; clean up the code
 #   10.0.0 - Add support for "hardened" Adobe DRM (RMSDK >= 10)
+#   10.1.0 - Stream objects to the output instead of keeping the whole document
+#            in memory, limit the memory used for parsed object streams
+#   10.1.1 - Merge all cross reference sections into one index
+#   10.1.2 - Regex based tokenizer working on a memory map of the file
+#   10.1.3 - Support all PNG predictors, the TIFF predictor and LZW streams
+#   10.1.4 - Copy big streams to the output in chunks while decrypting them
+#   10.1.5 - Decode object streams in threads ahead of the serializer
+#   10.1.6 - Buffer the output, cache encoded names
+#   10.1.7 - Optionally repack objects into object streams, leave out duplicate streams
+#   10.1.8 - Remember per object keys and password derived document keys
 
 """
 Decrypts Adobe ADEPT-encrypted PDF files.
 """
 
 __license__ = 'GPL v3'
-__version__ = "10.0.0"
+__version__ = "10.1.8"
 
 import codecs
 import hashlib
@@ -65,12 +75,16 @@ import os
 import re
 import zlib
 import struct
+import mmap
 from io import BytesIO
 from decimal import Decimal
 import itertools
 import xml.etree.ElementTree as etree
 import traceback
+import threading
 from uuid import UUID
+from collections import OrderedDict
+from array import array
 
 try:
     from Cryptodome.Cipher import AES, ARC4, PKCS1_v1_5
@@ -173,6 +187,55 @@ GEN_XREF_STM = 0
 # This is the value for the current document
 gen_xref_stm = False # will be set in PDFSerializer
 
+# Put all objects that aren't streams into new compressed object streams
+# of this many objects each, and write a cross reference stream.
+# 0 = write every object on its own (and follow GEN_XREF_STM)
+REPACK_OBJSTM = 0
+
+# Write streams with the same dictionary and data only once, references
+# to the copies are changed to refer to the first one.
+DEDUP_STREAMS = False
+
+# How much decoded object stream data PDFSerializer keeps parsed in memory.
+# Object streams that haven't been used for the longest time are parsed again
+# if they are needed after they have been dropped.
+OBJSTM_CACHE_SIZE = 32 * 1024 * 1024
+
+# Number of per object keys each PDFDocument remembers (the ones used last).
+# Objects are mostly deciphered one after the other, so this only needs to
+# be big enough for the object streams that are decoded in threads at the
+# same time.
+OBJKEY_CACHE_SIZE = 1024
+
+# Number of document keys derived from passwords (standard security
+# handler) that are remembered, so trying the same password on the same
+# document again doesn't need to run the key derivation again.
+DOCKEY_CACHE_SIZE = 32
+_dockeys = OrderedDict()
+
+# PDFSerializer collects this much output before writing it to the file.
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Number of threads that decode object streams ahead of PDFSerializer.
+# None means automatic: one per core.
+DECODE_JOBS = None
+
+def setDecodeJobs(jobs):
+    global DECODE_JOBS
+    DECODE_JOBS = jobs
+
+# Keys of a cross reference stream dictionary that aren't trailer entries,
+# and the trailer entries about the input's own cross references and
+# encryption, none of which are copied to the output trailer.
+XREF_STREAM_KEYS = frozenset(('Type', 'Size', 'Index', 'W', 'Length', 'Filter',
+                              'DecodeParms', 'F', 'FFilter', 'FDecodeParms',
+                              'DL', 'Prev', 'XRefStm', 'Encrypt'))
+
+# Streams of at least this size aren't read into memory by PDFSerializer
+# in streaming mode, they're deciphered and copied to the output in chunks
+# of this size.
+STREAM_CHUNK_SIZE = 1024 * 1024
+
 # PDF parsing routines from pdfminer, with changes for EBX_HANDLER
 
 #  Utilities
@@ -206,6 +269,10 @@ def nunpack(s, default=0):
 
 STRICT = 0
 
+# Use the regex based tokenizer (PSBaseParser.lex) instead of the
+# character by character one, where the input can be memory mapped.
+FAST_TOKENIZER = True
+
 
 #  PS Exceptions
 
@@ -318,6 +385,30 @@ END_STRING = re.compile(br'[()\\]')
 OCT_STRING = re.compile(br'[0-7]')
 ESC_STRING = { b'b':8, b't':9, b'n':10, b'f':12, b'r':13, b'(':40, b')':41, b'\\':92 }
 
+# Used by the regex tokenizer. Matches one token including the whitespace and
+# comments in front of it, the name of the last group tells what it is.
+# A "<" or ">" on its own is skipped, like the character by character
+# tokenizer does. The lookahead makes sure the whitespace and comments are
+# never given back to match a token.
+TOKEN = re.compile(br'''
+    (?=(?P<space>(?:\s|%[^\r\n]*)*))(?P=space)
+    (?:
+        (?P<literal>/(?:[^#/%\[\]()<>{}\s]|\#[0-9a-fA-F]{0,2})*)
+      | (?P<number>[-+0-9][0-9]*)(?P<decimal>\.[0-9]*)?
+      | (?P<fraction>\.[0-9]*)
+      | (?P<keyword>[A-Za-z][^#/%\[\]()<>{}\s]*)
+      | (?P<string>\()
+      | (?P<hexstring><(?=[\s0-9a-fA-F])[\s0-9a-fA-F]*)
+      | (?P<dictbegin><<)
+      | (?P<dictend>>>)
+      | [<>]
+      | (?P<other>.)
+    )''', re.VERBOSE | re.DOTALL)
+LITERAL_HEX = re.compile(br'#([0-9a-fA-F]{0,2})')
+OCT_ESCAPE = re.compile(br'[0-7]{1,3}')
+KEYWORDS_LEX_STOP = frozenset(KWD(name) for name in
+                              (b'stream', b'endstream', b'endobj', b'xref', b'trailer', b'startxref'))
+
 class PSBaseParser(object):
 
     '''
@@ -327,9 +418,25 @@ class PSBaseParser(object):
 
     def __init__(self, fp):
         self.fp = fp
+        self.data = self.data_map = None
+        if FAST_TOKENIZER:
+            self.map_input()
         self.seek(0)
         return
 
+    def map_input(self):
+        # The regex tokenizer needs the whole input in one buffer.
+        # If the file can't be mapped, use the other tokenizer.
+        if isinstance(self.fp, BytesIO):
+            self.data = self.fp.getvalue()
+            return
+        try:
+            self.data = self.data_map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, OSError, IOError):
+            # empty file, or not a real file
+            self.data = self.data_map = None
+        return
+
     def __repr__(self):
         return '<PSBaseParser: %r, bufpos=%d>' % (self.fp, self.bufpos)
 
@@ -338,6 +445,10 @@ class PSBaseParser(object):
 
     def close(self):
         self.flush()
+        if self.data_map is not None:
+            self.data = None
+            self.data_map.close()
+            self.data_map = None
         return
 
     def tell(self):
@@ -351,15 +462,42 @@ class PSBaseParser(object):
         self.fp.seek(pos0)
         return
 
+    def read_at(self, pos, n):
+        '''
+        Reads n bytes at the given position without moving the parser.
+        '''
+        if self.data is not None:
+            return self.data[pos:pos+n]
+        pos0 = self.fp.tell()
+        self.fp.seek(pos)
+        data = self.fp.read(n)
+        self.fp.seek(pos0)
+        return data
+
+    def filesize(self):
+        if self.data is not None:
+            return len(self.data)
+        pos0 = self.fp.tell()
+        self.fp.seek(0, 2)
+        size = self.fp.tell()
+        self.fp.seek(pos0)
+        return size
+
     def seek(self, pos):
         '''
         Seeks the parser to the given position.
         '''
         self.fp.seek(pos)
         # reset the status for nextline()
-        self.bufpos = pos
-        self.buf = b''
-        self.charpos = 0
+        if self.data is not None:
+            # the whole file is the buffer
+            self.bufpos = 0
+            self.buf = self.data
+            self.charpos = pos
+        else:
+            self.bufpos = pos
+            self.buf = b''
+            self.charpos = 0
         # reset the status for nexttoken()
         self.parse1 = self.parse_main
         self.tokens = []
@@ -367,6 +505,8 @@ class PSBaseParser(object):
 
     def fillbuf(self):
         if self.charpos < len(self.buf): return
+        if self.data is not None:
+            raise PSEOF('Unexpected EOF')
         # fetch next chunk.
         self.bufpos = self.fp.tell()
         self.buf = self.fp.read(self.BUFSIZ)
@@ -517,7 +657,7 @@ class PSBaseParser(object):
         else:
             c = bytes([s[j]])
         if c == b'\\':
-            self.oct = ''
+            self.oct = b''
             return (self.parse_string_1, j+1)
         if c == b'(':
             self.paren += 1
@@ -540,7 +680,7 @@ class PSBaseParser(object):
             self.oct += c
             return (self.parse_string_1, i+1)
         if self.oct:
-            self.token += bytes([int(self.oct, 8)])
+            self.token += bytes([int(self.oct, 8) & 255])
             return (self.parse_string, i)
         if c in ESC_STRING:
             self.token += bytes([ESC_STRING[c]])
@@ -581,12 +721,105 @@ class PSBaseParser(object):
         return (self.parse_main, j)
 
     def nexttoken(self):
+        if self.data is not None:
+            if not self.tokens:
+                self.lex()
+            return self.tokens.pop(0)
         while not self.tokens:
             self.fillbuf()
             (self.parse1, self.charpos) = self.parse1(self.buf, self.charpos)
         token = self.tokens.pop(0)
         return token
 
+    def lex(self, limit=256):
+        '''
+        Regex tokenizer: reads up to limit tokens in one go. It stops after
+        keywords that end an object or where the caller switches to reading
+        lines or stream data, so the position is right for that.
+        '''
+        buf = self.buf
+        pos = self.charpos
+        tokens = self.tokens
+        match = TOKEN.match
+        while len(tokens) < limit:
+            m = match(buf, pos)
+            if m is None:
+                break
+            pos = m.end()
+            kind = m.lastgroup
+            if kind == 'space':
+                # a "<" or ">" that doesn't start or end anything
+                continue
+            if kind == 'literal':
+                name = m.group(kind)[1:]
+                if b'#' in name:
+                    name = LITERAL_HEX.sub(lambda m2: bytes([int(m2.group(1), 16)]) if m2.group(1) else b'', name)
+                tokens.append((m.start(kind), LIT(name)))
+            elif kind == 'number':
+                try:
+                    tokens.append((m.start(kind), int(m.group(kind))))
+                except ValueError:
+                    pass
+            elif kind == 'keyword':
+                token = KWD(m.group(kind))
+                tokens.append((m.start(kind), token))
+                if token in KEYWORDS_LEX_STOP:
+                    break
+            elif kind == 'decimal':
+                token = m.group('number') + m.group(kind)
+                tokens.append((m.start('number'), Decimal(token.decode('utf-8'))))
+            elif kind == 'fraction':
+                tokens.append((m.start(kind), Decimal(m.group(kind).decode('utf-8'))))
+            elif kind == 'string':
+                (token, pos) = self.lex_string(buf, pos)
+                tokens.append((m.start(kind), token))
+            elif kind == 'hexstring':
+                token = HEX_PAIR.sub(lambda m2: bytes([int(m2.group(0), 16)]),
+                                     SPC.sub(b'', m.group(kind)[1:]))
+                tokens.append((m.start(kind), token))
+            elif kind == 'dictbegin':
+                tokens.append((m.start(kind), KEYWORD_DICT_BEGIN))
+            elif kind == 'dictend':
+                tokens.append((m.start(kind), KEYWORD_DICT_END))
+            else:
+                tokens.append((m.start(kind), KWD(m.group(kind))))
+        self.charpos = pos
+        if not tokens:
+            raise PSEOF('Unexpected EOF')
+        return
+
+    def lex_string(self, buf, pos):
+        # Reads a (string) starting after the opening bracket,
+        # returns the string and the position after the closing bracket.
+        parts = []
+        paren = 1
+        while 1:
+            m = END_STRING.search(buf, pos)
+            if not m:
+                raise PSEOF('Unexpected EOF')
+            j = m.start(0)
+            parts.append(buf[pos:j])
+            c = buf[j]
+            pos = j+1
+            if c == 92: # backslash
+                m = OCT_ESCAPE.match(buf, pos)
+                if m:
+                    parts.append(bytes([int(m.group(0), 8) & 255]))
+                    pos = m.end(0)
+                    continue
+                c = buf[pos:pos+1]
+                if c in ESC_STRING:
+                    parts.append(bytes([ESC_STRING[c]]))
+                pos += 1
+            elif c == 40: # (
+                paren += 1
+                parts.append(b'(')
+            else:
+                paren -= 1
+                if not paren:
+                    return (b''.join(parts), pos)
+                parts.append(b')')
+
     def nextline(self):
         '''
         Fetches a next line that ends either with \\r or \\n.
@@ -643,6 +876,11 @@ class PSBaseParser(object):
 
 ##  PSStackParser
 ##
+# the token types nextobject() pushes as they are; the tuple is for
+# subclasses of them
+PLAIN_TOKEN_TYPES = frozenset((int, Decimal, bool, bytearray, bytes, str, PSLiteral))
+PLAIN_TOKEN_CLASSES = tuple(PLAIN_TOKEN_TYPES)
+
 class PSStackParser(PSBaseParser):
 
     def __init__(self, fp):
@@ -699,13 +937,8 @@ class PSStackParser(PSBaseParser):
         '''
         while not self.results:
             (pos, token) = self.nexttoken()
-            if (isinstance(token, int) or
-                    isinstance(token, Decimal) or
-                    isinstance(token, bool) or
-                    isinstance(token, bytearray) or
-                    isinstance(token, bytes) or
-                    isinstance(token, str) or
-                    isinstance(token, PSLiteral)):
+            if (type(token) in PLAIN_TOKEN_TYPES or
+                    isinstance(token, PLAIN_TOKEN_CLASSES)):
                 # normal token
                 self.push((pos, token))
             elif token == KEYWORD_ARRAY_BEGIN:
@@ -902,23 +1135,216 @@ def ascii85decode(data):
     return out
 
 
+##  LZWDecoder
+##
+class LZWDecoder(object):
+    '''
+    Decodes LZWDecode streams. run() yields the decoded data in chunks.
+    '''
+    CHUNKSIZE = 65536
+
+    def __init__(self, fp, earlychange=1):
+        self.fp = fp
+        self.earlychange = earlychange
+        return
+
+    def run(self):
+        data = self.fp.read()
+        out = bytearray()
+        table = [bytes([c]) for c in range(256)] + [None, None]
+        width = 9
+        prev = None
+        bitbuf = nbits = 0
+        for byte in bytearray(data):
+            bitbuf = (bitbuf << 8) | byte
+            nbits += 8
+            if nbits < width:
+                continue
+            nbits -= width
+            code = bitbuf >> nbits
+            bitbuf &= (1 << nbits) - 1
+            if code == 256:
+                # clear table
+                del table[258:]
+                width = 9
+                prev = None
+                continue
+            if code == 257:
+                # end of data
+                break
+            if code < len(table):
+                entry = table[code]
+                if prev is not None:
+                    table.append(prev + entry[:1])
+            elif prev is not None and code == len(table):
+                entry = prev + prev[:1]
+                table.append(entry)
+            else:
+                if STRICT:
+                    raise PDFValueError('Invalid LZW code: %d' % code)
+                break
+            out += entry
+            prev = entry
+            if len(table) + self.earlychange >= (1 << width) and width < 12:
+                width += 1
+            if len(out) >= self.CHUNKSIZE:
+                yield bytes(out)
+                del out[:]
+        if out:
+            yield bytes(out)
+        return
+
+
+# Predictors
+# Masks to add byte strings byte by byte as one big number.
+_ADD_MASKS = {}
+
+def add_bytes(a, b):
+    '''
+    Returns (a[i] + b[i]) & 255 for all bytes of two equally long strings.
+    '''
+    n = len(a)
+    try:
+        (low, high) = _ADD_MASKS[n]
+    except KeyError:
+        low = int.from_bytes(b'\x7f' * n, 'big')
+        high = int.from_bytes(b'\x80' * n, 'big')
+        if len(_ADD_MASKS) < 64:
+            _ADD_MASKS[n] = (low, high)
+    x = int.from_bytes(a, 'big')
+    y = int.from_bytes(b, 'big')
+    # add the low 7 bits, so there's no carry into the next byte,
+    # then put the top bits back
+    return (((x & low) + (y & low)) ^ ((x ^ y) & high)).to_bytes(n, 'big')
+
+_MASK_BYTE = (255).__and__
+
+def running_sum(out, start, end, row, step):
+    '''
+    Stores the running sums (mod 256) of every step'th byte of row, starting
+    with each of the first step bytes, in out[start:end].
+    '''
+    for k in range(step):
+        out[start+k:end:step] = bytes(map(_MASK_BYTE, itertools.accumulate(row[k::step])))
+    return
+
+def png_predictor_decode(data, colors=1, bpc=8, columns=1):
+    '''
+    Undoes the PNG predictors (Predictor 10 to 15). Every row starts with
+    a byte that says which of the five filters was used for it.
+    '''
+    bpp = max(1, (colors * bpc) // 8)
+    rowlen = (colors * bpc * columns + 7) // 8
+    nrows = (len(data) + rowlen) // (rowlen + 1)
+    out = bytearray(max(0, len(data) - nrows))
+    if len(data) == nrows * (rowlen + 1) and nrows:
+        # Cross reference streams usually use the same filter for all rows,
+        # these can be done column by column.
+        ftypes = data[::rowlen+1]
+        if ftypes.count(2) == nrows:
+            # Up: every column is the running sum of its rows
+            for k in range(rowlen):
+                out[k::rowlen] = bytes(map(_MASK_BYTE, itertools.accumulate(data[k+1::rowlen+1])))
+            return bytes(out)
+        if ftypes.count(0) == nrows:
+            out = bytearray(data)
+            del out[::rowlen+1]
+            return bytes(out)
+    prev = bytes(rowlen)
+    start = 0
+    for i in range(0, len(data), rowlen + 1):
+        ftype = data[i]
+        row = data[i+1:i+1+rowlen]
+        n = len(row)
+        end = start + n
+        if n < rowlen:
+            prev = prev[:n]
+        if ftype == 0:
+            # None
+            out[start:end] = row
+        elif ftype == 1:
+            # Sub
+            running_sum(out, start, end, row, bpp)
+        elif ftype == 2:
+            # Up
+            out[start:end] = add_bytes(row, prev)
+        elif ftype == 3:
+            # Average
+            for j in range(n):
+                left = out[start+j-bpp] if j >= bpp else 0
+                out[start+j] = (row[j] + ((left + prev[j]) >> 1)) & 255
+        elif ftype == 4:
+            # Paeth
+            for j in range(n):
+                if j >= bpp:
+                    a = out[start+j-bpp]
+                    c = prev[j-bpp]
+                else:
+                    a = c = 0
+                b = prev[j]
+                p = a + b - c
+                pa = abs(p - a)
+                pb = abs(p - b)
+                pc = abs(p - c)
+                if pa <= pb and pa <= pc:
+                    pred = a
+                elif pb <= pc:
+                    pred = b
+                else:
+                    pred = c
+                out[start+j] = (row[j] + pred) & 255
+        else:
+            raise PDFValueError('Invalid PNG filter type: %r' % ftype)
+        prev = out[start:end]
+        start = end
+    return bytes(out)
+
+def tiff_predictor_decode(data, colors=1, bpc=8, columns=1):
+    '''
+    Undoes TIFF predictor 2: every sample is stored as the difference
+    to the one on its left.
+    '''
+    if bpc != 8:
+        raise PDFNotImplementedError(
+            'Unsupported BitsPerComponent for TIFF predictor: %r' % bpc)
+    rowlen = colors * columns
+    out = bytearray(len(data))
+    for i in range(0, len(data), rowlen):
+        row = data[i:i+rowlen]
+        running_sum(out, i, i+len(row), row, colors)
+    return bytes(out)
+
+
 ##  PDFStream type
 class PDFStream(PDFObject):
-    def __init__(self, dic, rawdata, decipher=None):
+    # source is (parser, pos, rawlen) for streams whose data wasn't read
+    # into memory, rawdata is None then and the data is read from the
+    # parser when it's needed.
+    def __init__(self, dic, rawdata, decipher=None, source=None):
         length = int_value(dic.get('Length', 0))
-        eol = rawdata[length:]
+        if source is not None:
+            (parser, pos, rawlen) = source
+            eol = parser.read_at(pos+length, rawlen-length) if 0 < rawlen-length <= 2 else None
+        else:
+            rawlen = len(rawdata)
+            eol = rawdata[length:]
         # quick and dirty fix for false length attribute,
         # might not work if the pdf stream parser has a problem
         if decipher != None and decipher.__name__ == 'decrypt_aes':
-            if (len(rawdata) % 16) != 0:
-                cutdiv = len(rawdata) // 16
-                rawdata = rawdata[:16*cutdiv]
+            if (rawlen % 16) != 0:
+                cutdiv = rawlen // 16
+                rawlen = 16*cutdiv
         else:
             if eol in (b'\r', b'\n', b'\r\n'):
-                rawdata = rawdata[:length]
+                rawlen = length
+        if source is not None:
+            source = (parser, pos, rawlen)
+        else:
+            rawdata = rawdata[:rawlen]
 
         self.dic = dic
         self.rawdata = rawdata
+        self.source = source
         self.decipher = decipher
         self.data = None
         self.decdata = None
@@ -932,6 +1358,9 @@ class PDFStream(PDFObject):
         return
 
     def __repr__(self):
+        if self.source:
+            return '<PDFStream(%r): raw=%d at %d, %r>' % \
+                   (self.objid, self.source[2], self.source[1], self.dic)
         if self.rawdata:
             return '<PDFStream(%r): raw=%d, %r>' % \
                    (self.objid, len(self.rawdata), self.dic)
@@ -939,27 +1368,51 @@ class PDFStream(PDFObject):
             return '<PDFStream(%r): data=%d, %r>' % \
                    (self.objid, len(self.data), self.dic)
 
-    def decode(self):
-        assert self.data is None and self.rawdata is not None
-        data = self.rawdata
+    def get_filters(self):
+        '''
+        Returns a list of (filter, parameters) to decode the stream with.
+        Indirect objects are resolved here, so decode doesn't need the
+        parser when it gets this list.
+        '''
+        if 'Filter' not in self.dic:
+            return []
+        filters = resolve1(self.dic['Filter'])
+        if 'DP' in self.dic:
+            allparams = resolve1(self.dic['DP'])
+        else:
+            allparams = resolve1(self.dic.get('DecodeParms', {}))
+        if not isinstance(filters, list):
+            filters = [ filters ]
+        result = []
+        for (i, f) in enumerate(filters):
+            # there's either one parameter dictionary for each filter,
+            # or a single one for the only filter
+            if isinstance(allparams, list):
+                params = dict_value(allparams[i]) if i < len(allparams) else {}
+            else:
+                params = dict_value(allparams) if allparams else {}
+            params = dict((k, resolve1(v)) for (k, v) in params.items())
+            result.append((resolve1(f), params))
+        return result
+
+    def decode(self, filters=None):
+        assert self.data is None and (self.rawdata is not None or self.source is not None)
+        if filters is None:
+            filters = self.get_filters()
+        data = self.get_rawdata()
+        self.source = None
         if self.decipher:
             # Handle encryption
             data = self.decipher(self.objid, self.genno, data)
             if gen_xref_stm:
                 self.decdata = data # keep decrypted data
-        if 'Filter' not in self.dic:
-            self.data = data
-            self.rawdata = None
-            return
-        filters = self.dic['Filter']
-        if not isinstance(filters, list):
-            filters = [ filters ]
-        for f in filters:
+        for (f, params) in filters:
             if f in LITERALS_FLATE_DECODE:
                 # will get errors if the document is encrypted.
                 data = zlib.decompress(data)
             elif f in LITERALS_LZW_DECODE:
-                data = b''.join(LZWDecoder(BytesIO(data)).run())
+                earlychange = int_value(params.get('EarlyChange', 1))
+                data = b''.join(LZWDecoder(BytesIO(data), earlychange).run())
             elif f in LITERALS_ASCII85_DECODE:
                 data = ascii85decode(data)
             elif f == LITERAL_CRYPT:
@@ -967,31 +1420,18 @@ class PDFStream(PDFObject):
             else:
                 raise PDFNotImplementedError('Unsupported filter: %r' % f)
             # apply predictors
-            if 'DP' in self.dic:
-                params = self.dic['DP']
-            else:
-                params = self.dic.get('DecodeParms', {})
-            if 'Predictor' in params:
-                pred = int_value(params['Predictor'])
-                if pred:
-                    if pred != 12:
-                        raise PDFNotImplementedError(
-                            'Unsupported predictor: %r' % pred)
-                    if 'Columns' not in params:
-                        raise PDFValueError(
-                            'Columns undefined for predictor=12')
-                    columns = int_value(params['Columns'])
-                    buf = b''
-                    ent0 = b'\x00' * columns
-                    for i in range(0, len(data), columns+1):
-                        pred = data[i]
-                        ent1 = data[i+1:i+1+columns]
-                        if pred == 2:
-                            ent1 = b''.join(bytes([(a+b) & 255]) \
-                                           for (a,b) in zip(ent0,ent1))
-                        buf += ent1
-                        ent0 = ent1
-                    data = buf
+            pred = int_value(params.get('Predictor', 1))
+            if pred > 1:
+                colors = int_value(params.get('Colors', 1))
+                bpc = int_value(params.get('BitsPerComponent', 8))
+                columns = int_value(params.get('Columns', 1))
+                if pred == 2:
+                    data = tiff_predictor_decode(data, colors, bpc, columns)
+                elif pred >= 10 and pred <= 15:
+                    data = png_predictor_decode(data, colors, bpc, columns)
+                else:
+                    raise PDFNotImplementedError(
+                        'Unsupported predictor: %r' % pred)
         self.data = data
         self.rawdata = None
         return
@@ -1002,17 +1442,40 @@ class PDFStream(PDFObject):
         return self.data
 
     def get_rawdata(self):
+        if self.source is not None:
+            (parser, pos, rawlen) = self.source
+            return parser.read_at(pos, rawlen)
         return self.rawdata
 
     def get_decdata(self):
         if self.decdata is not None:
             return self.decdata
-        data = self.rawdata
+        data = self.get_rawdata()
         if self.decipher and data:
             # Handle encryption
             data = self.decipher(self.objid, self.genno, data)
         return data
 
+    def iter_decdata(self, chunksize=None):
+        '''
+        Yields the deciphered data in pieces. Streams that weren't read
+        into memory are read and deciphered chunksize bytes at a time
+        (STREAM_CHUNK_SIZE if it is None).
+        '''
+        if self.source is None or self.decdata is not None:
+            yield self.get_decdata()
+            return
+        if chunksize is None:
+            chunksize = STREAM_CHUNK_SIZE
+        (parser, pos, rawlen) = self.source
+        if not self.decipher:
+            for i in range(pos, pos+rawlen, chunksize):
+                yield parser.read_at(i, min(chunksize, pos+rawlen-i))
+            return
+        for data in parser.doc.decipher_chunks(self.objid, self.genno,
+                                               parser, pos, rawlen, chunksize):
+            yield data
+
 
 ##  PDF Exceptions
 ##
@@ -1046,6 +1509,9 @@ class PDFXRef(object):
     def objids(self):
         return iter(self.offsets.keys())
 
+    def count(self):
+        return len(self.offsets)
+
     def load(self, parser):
         self.offsets = {}
         while 1:
@@ -1101,6 +1567,10 @@ class PDFXRef(object):
             raise
         return (None, pos)
 
+    def entries(self):
+        for (objid, (genno, pos)) in self.offsets.items():
+            yield (objid, None, pos)
+
 
 ##  PDFXRefStream
 ##
@@ -1121,6 +1591,11 @@ class PDFXRefStream(object):
             for objid in range(first, first + size):
                 yield objid
 
+    def count(self):
+        # rows in the stream, free objects included
+        count = sum(size for (_, size) in self.index)
+        return min(count, len(self.data) // self.entlen) if self.entlen else 0
+
     def load(self, parser, debug=0):
         (_,objid) = parser.nexttoken() # ignored
         (_,genno) = parser.nexttoken() # ignored
@@ -1161,6 +1636,206 @@ class PDFXRefStream(object):
         # this is a free object
         raise KeyError(objid)
 
+    def entries(self):
+        '''
+        Decodes all rows in one go, yields (objid, stmid, pos) for
+        every object that isn't free.
+        '''
+        entlen = self.entlen
+        count = sum(size for (_, size) in self.index)
+        # a truncated stream ends the table early
+        count = min(count, len(self.data) // entlen) if entlen else 0
+        data = self.data[:count * entlen]
+        def column(start, width, default):
+            # the values of one field for all rows
+            if not width:
+                return [default] * count
+            values = list(data[start::entlen])
+            for k in range(1, width):
+                values = [(v << 8) | b for (v, b) in zip(values, data[start+k::entlen])]
+            return values
+        types = column(0, self.fl1, 1)
+        field2 = column(self.fl1, self.fl2, 0)
+        field3 = column(self.fl1+self.fl2, self.fl3, 0)
+        objids = itertools.chain.from_iterable(
+            range(first, first + size) for (first, size) in self.index)
+        for (objid, f1, f2, f3) in zip(objids, types, field2, field3):
+            if f1 == 1:
+                yield (objid, None, f2)
+            elif f1 == 2:
+                yield (objid, f2, f3)
+        return
+
+
+##  PDFXRefIndex
+##
+##  Location of every object in the document, merged from all cross
+##  reference sections. If an object is in more than one section, the
+##  first section in the list (the newest one) wins.
+##
+class PDFXRefIndex(object):
+
+    def __init__(self, xrefs=()):
+        # positions[objid] is the file offset of the object or its index in
+        # the object stream stmids[objid], -1 if the object doesn't exist.
+        # Object ids are taken from the file, so the arrays only go up to
+        # the trailer's /Size, and no further than twice the number of
+        # entries; objects above that are kept in others, by objid.
+        self.stmids = array('q')
+        self.positions = array('q')
+        self.others = {}
+        count = 0
+        size = None
+        for xref in xrefs:
+            count += xref.count()
+            trailer = getattr(xref, 'trailer', None)
+            if trailer and isinstance(trailer.get('Size'), int):
+                size = max(size or 0, trailer['Size'])
+        self.limit = 2 * count + 1024
+        if size is not None:
+            self.limit = min(self.limit, size)
+        for xref in reversed(xrefs):
+            self.add(xref)
+        return
+
+    def __repr__(self):
+        return '<PDFXRefIndex: size=%d, others=%d>' % (len(self.positions), len(self.others))
+
+    def grow(self, size):
+        n = min(max(size, 2 * len(self.positions)), self.limit) - len(self.positions)
+        self.stmids.extend(array('q', [0]) * n)
+        self.positions.extend(array('q', [-1]) * n)
+        return
+
+    def add(self, xref):
+        stmids = self.stmids
+        positions = self.positions
+        limit = self.limit
+        for (objid, stmid, pos) in xref.entries():
+            if objid < 0:
+                continue
+            if objid >= limit:
+                self.others[objid] = (stmid, pos)
+                continue
+            if objid >= len(positions):
+                self.grow(objid + 1)
+            stmids[objid] = stmid or 0
+            positions[objid] = pos
+        return
+
+    def getpos(self, objid):
+        if objid >= self.limit:
+            return self.others[objid]
+        try:
+            pos = self.positions[objid]
+        except IndexError:
+            raise KeyError(objid)
+        if pos < 0 or objid < 0:
+            raise KeyError(objid)
+        return (self.stmids[objid] or None, pos)
+
+
+##  PDFObjStmCache
+##
+##  Holds the parsed objects of object streams. Once the decoded size of all
+##  streams exceeds the budget, the least recently used ones are dropped.
+##
+class PDFObjStmCache(object):
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+        return
+
+    def __repr__(self):
+        return '<PDFObjStmCache: streams=%d, size=%d>' % (len(self.entries), self.size)
+
+    def __contains__(self, stmid):
+        return stmid in self.entries
+
+    def get(self, stmid):
+        try:
+            (objs, size) = self.entries[stmid]
+        except KeyError:
+            return None
+        self.entries.move_to_end(stmid)
+        return objs
+
+    def put(self, stmid, objs, size):
+        if stmid in self.entries:
+            self.size -= self.entries.pop(stmid)[1]
+        self.entries[stmid] = (objs, size)
+        self.size += size
+        if self.budget is None:
+            return
+        # always keep the stream that was just added
+        while self.size > self.budget and len(self.entries) > 1:
+            (_, (_, oldsize)) = self.entries.popitem(last=False)
+            self.size -= oldsize
+        return
+
+
+##  PDFObjStmPrefetcher
+##
+##  Deciphers and inflates the object streams PDFSerializer is going to need
+##  next in a thread pool, in the order they will be needed. zlib and the
+##  ciphers release the GIL, parsing the objects stays in the main thread.
+##
+class PDFObjStmPrefetcher(object):
+
+    def __init__(self, doc, stmids, jobs):
+        from concurrent.futures import ThreadPoolExecutor
+        self.doc = doc
+        self.stmids = list(stmids)
+        self.next = 0
+        self.window = jobs * 2
+        self.running = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        return
+
+    def __repr__(self):
+        return '<PDFObjStmPrefetcher: running=%d, left=%d>' % \
+               (len(self.running), len(self.stmids) - self.next)
+
+    def fill(self):
+        # Only call this while the parser isn't in the middle of an object,
+        # the streams are read with it.
+        while len(self.running) < self.window and self.next < len(self.stmids):
+            stmid = self.stmids[self.next]
+            self.next += 1
+            if stmid in self.running or stmid in self.doc.parsed_objs:
+                continue
+            stream = self.doc.getobj(stmid)
+            if not isinstance(stream, PDFStream) or stream.data is not None:
+                continue
+            filters = stream.get_filters()
+            self.running[stmid] = (stream, self.executor.submit(stream.decode, filters))
+        return
+
+    def take(self, stmid):
+        # Returns the decoded stream, or None if it wasn't prefetched.
+        try:
+            (stream, future) = self.running.pop(stmid)
+        except KeyError:
+            return None
+        future.result()
+        return stream
+
+    def discard(self, stmid):
+        # The stream was parsed already, its objects came from the cache.
+        try:
+            (stream, future) = self.running.pop(stmid)
+        except KeyError:
+            return
+        future.cancel()
+        return
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.running.clear()
+        return
+
 
 ##  PDFDocument
 ##
@@ -1171,15 +1846,28 @@ class PDFXRefStream(object):
 ##
 class PDFDocument(object):
 
-    def __init__(self):
+    def __init__(self, objstm_cache_size=None):
         self.xrefs = []
+        self.xrefindex = PDFXRefIndex()
         self.objs = {}
-        self.parsed_objs = {}
+        self.parsed_objs = PDFObjStmCache(objstm_cache_size)
+        # if False, getobj doesn't remember the objects it returns
+        self.keep_objs = True
+        # streams of at least this size are read from the file when needed
+        self.passthrough_size = None
+        self.prefetcher = None
         self.root = None
         self.catalog = None
         self.parser = None
         self.encryption = None
         self.decipher = None
+        # (objid, genno) -> key from genkey
+        self.objkeys = OrderedDict()
+        # the object streams are deciphered in threads
+        self.objkeys_lock = threading.Lock()
+        # results of hash_V5, it gets called again with the same values
+        # while checking the owner and user passwords
+        self.hashes_V5 = {}
         return
 
     # set_parser(parser)
@@ -1196,6 +1884,7 @@ class PDFDocument(object):
         # Retrieve the information of each header that was appended
         # (maybe multiple times) at the end of the document.
         self.xrefs = parser.read_xref()
+        self.xrefindex = PDFXRefIndex(self.xrefs)
         for xref in self.xrefs:
             trailer = xref.trailer
             if not trailer: continue
@@ -1385,6 +2074,12 @@ class PDFDocument(object):
 
 
     def hash_V5(self, password, salt, userdata, param):
+        args = (bytes(password), bytes(salt), bytes(userdata))
+        if args not in self.hashes_V5:
+            self.hashes_V5[args] = self.compute_hash_V5(password, salt, userdata, param)
+        return self.hashes_V5[args]
+
+    def compute_hash_V5(self, password, salt, userdata, param):
         R = int_value(param['R'])
         K = SHA256(password + salt + userdata)
         if R < 6:
@@ -1520,26 +2215,17 @@ class PDFDocument(object):
         if R >= 7:
             raise PDFEncryptionError('Unknown revision: %r' % R)
 
-        # check owner pass:
-        retval = self.check_owner_password(password, docid, param)
-        if retval is True or retval is not None:
-            #print("Owner pass is valid - " + str(retval))
-            if retval is True:
-                self.decrypt_key = self.recover_encryption_key_with_password(password, docid, param)
-            else:
-                self.decrypt_key = retval
-
-        if self.decrypt_key is None or self.decrypt_key is True or self.decrypt_key is False:
-            # That's not the owner password. Check if it's the user password.
-            retval = self.check_user_password(password, docid, param)
-            if retval is True or retval is not None:
-                #print("User pass is valid")
-                if retval is True:
-                    self.decrypt_key = self.recover_encryption_key_with_password(password, docid, param)
-                else:
-                    self.decrypt_key = retval
+        keyid = self.standard_key_id(password, docid, param)
+        if keyid in _dockeys:
+            _dockeys.move_to_end(keyid)
+            self.decrypt_key = _dockeys[keyid]
+        else:
+            self.decrypt_key = self.derive_standard_key(password, docid, param)
+            _dockeys[keyid] = self.decrypt_key
+            while len(_dockeys) > DOCKEY_CACHE_SIZE:
+                _dockeys.popitem(last=False)
 
-        if self.decrypt_key is None or self.decrypt_key is True or self.decrypt_key is False:
+        if self.decrypt_key is None:
             raise ADEPTInvalidPasswordError("Password invalid.")
 
 
@@ -1598,6 +2284,44 @@ class PDFDocument(object):
         self.ready = True
         return
 
+    def standard_key_id(self, password, docid, param):
+        # Hash over the password and everything in the encryption
+        # dictionary the document key depends on.
+        hash = hashlib.sha256(password)
+        hash.update(repr(docid).encode('utf-8'))
+        for name in ('V', 'R', 'Length', 'P', 'O', 'U', 'OE', 'UE', 'EncryptMetadata', 'CF'):
+            hash.update(repr((name, resolve1(param.get(name)))).encode('utf-8'))
+        return hash.digest()
+
+    # derive_standard_key(password, docid, param)
+    #   Returns the document key for the owner or user password,
+    #   or None if the password is wrong.
+    def derive_standard_key(self, password, docid, param):
+        self.decrypt_key = None
+
+        # check owner pass:
+        retval = self.check_owner_password(password, docid, param)
+        if retval is True or retval is not None:
+            #print("Owner pass is valid - " + str(retval))
+            if retval is True:
+                self.decrypt_key = self.recover_encryption_key_with_password(password, docid, param)
+            else:
+                self.decrypt_key = retval
+
+        if self.decrypt_key is None or self.decrypt_key is True or self.decrypt_key is False:
+            # That's not the owner password. Check if it's the user password.
+            retval = self.check_user_password(password, docid, param)
+            if retval is True or retval is not None:
+                #print("User pass is valid")
+                if retval is True:
+                    self.decrypt_key = self.recover_encryption_key_with_password(password, docid, param)
+                else:
+                    self.decrypt_key = retval
+
+        if self.decrypt_key is None or self.decrypt_key is True or self.decrypt_key is False:
+            return None
+        return self.decrypt_key
+
 
     def initialize_ebx_ignoble(self, keyb64, docid, param):
         self.is_printable = self.is_modifiable = self.is_extractable = True
@@ -1751,8 +2475,26 @@ class PDFDocument(object):
         # Looks like they stopped this useless obfuscation.
         return self.decrypt_key
 
-    def decrypt_aes(self, objid, genno, data):
+    # objkey(objid, genno)
+    #   Returns genkey(objid, genno). Every string of an object is deciphered
+    #   on its own, so the keys of the last objects are remembered.
+    def objkey(self, objid, genno):
+        # least recently used keys are dropped
+        keys = self.objkeys
+        with self.objkeys_lock:
+            key = keys.get((objid, genno))
+            if key is not None:
+                keys.move_to_end((objid, genno))
+                return key
         key = self.genkey(objid, genno)
+        with self.objkeys_lock:
+            keys[(objid, genno)] = key
+            if len(keys) > OBJKEY_CACHE_SIZE:
+                keys.popitem(last=False)
+        return key
+
+    def decrypt_aes(self, objid, genno, data):
+        key = self.objkey(objid, genno)
         ivector = data[:16]
         data = data[16:]
         plaintext = AES.new(key,AES.MODE_CBC,ivector).decrypt(data)
@@ -1762,9 +2504,36 @@ class PDFDocument(object):
         return plaintext
 
     def decrypt_rc4(self, objid, genno, data):
-        key = self.genkey(objid, genno)
+        key = self.objkey(objid, genno)
         return ARC4.new(key).decrypt(data)
 
+    # decipher_chunks(objid, genno, parser, pos, rawlen, chunksize)
+    #   Same as decipher on the rawlen bytes at pos in the input, but
+    #   reads and yields the data chunksize bytes at a time.
+    def decipher_chunks(self, objid, genno, parser, pos, rawlen, chunksize):
+        if self.decipher == self.decrypt_rc4:
+            cipher = ARC4.new(self.objkey(objid, genno))
+            for i in range(pos, pos+rawlen, chunksize):
+                yield cipher.decrypt(parser.read_at(i, min(chunksize, pos+rawlen-i)))
+        elif self.decipher == self.decrypt_aes and rawlen >= 32 and rawlen % 16 == 0:
+            key = self.objkey(objid, genno)
+            # Decrypt the last block first to know how much padding
+            # there is before anything gets written.
+            tail = parser.read_at(pos+rawlen-32, 32)
+            pad = AES.new(key,AES.MODE_CBC,tail[:16]).decrypt(tail[16:])[-1]
+            # same result as decrypt_aes for broken padding
+            left = max(rawlen - 16 - pad, 0) if pad else 0
+            cipher = AES.new(key,AES.MODE_CBC,parser.read_at(pos, 16))
+            chunksize -= chunksize % 16
+            for i in range(pos+16, pos+rawlen, chunksize):
+                if left <= 0:
+                    break
+                data = cipher.decrypt(parser.read_at(i, min(chunksize, pos+rawlen-i)))
+                yield data[:left]
+                left -= len(data)
+        else:
+            yield self.decipher(objid, genno, parser.read_at(pos, rawlen))
+
 
     KEYWORD_OBJ = KWD(b'obj')
 
@@ -1776,43 +2545,16 @@ class PDFDocument(object):
             genno = 0
             obj = self.objs[objid]
         else:
-            for xref in self.xrefs:
-                try:
-                    (stmid, index) = xref.getpos(objid)
-                    break
-                except KeyError:
-                    pass
-            else:
+            try:
+                (stmid, index) = self.xrefindex.getpos(objid)
+            except KeyError:
                 #if STRICT:
                 #    raise PDFSyntaxError('Cannot locate objid=%r' % objid)
                 return None
             if stmid:
                 if gen_xref_stm:
                     return PDFObjStmRef(objid, stmid, index)
-                # Stuff from pdfminer: extract objects from object stream
-                stream = stream_value(self.getobj(stmid))
-                if stream.dic.get('Type') is not LITERAL_OBJSTM:
-                    if STRICT:
-                        raise PDFSyntaxError('Not a stream object: %r' % stream)
-                try:
-                    n = stream.dic['N']
-                except KeyError:
-                    if STRICT:
-                        raise PDFSyntaxError('N is not defined: %r' % stream)
-                    n = 0
-
-                if stmid in self.parsed_objs:
-                    objs = self.parsed_objs[stmid]
-                else:
-                    parser = PDFObjStrmParser(stream.get_data(), self)
-                    objs = []
-                    try:
-                        while 1:
-                            (_,obj) = parser.nextobject()
-                            objs.append(obj)
-                    except PSEOF:
-                        pass
-                    self.parsed_objs[stmid] = objs
+                (n, objs) = self.getobjstm(stmid)
                 genno = 0
                 i = n*2+index
                 try:
@@ -1846,9 +2588,48 @@ class PDFDocument(object):
                     obj.set_objid(objid, genno)
                 if self.decipher:
                     obj = decipher_all(self.decipher, objid, genno, obj)
-            self.objs[objid] = obj
+            # Numbers are always kept: stream lengths get resolved while
+            # the parser is in the middle of reading the stream.
+            if self.keep_objs or isinstance(obj, int):
+                self.objs[objid] = obj
         return obj
 
+    # getobjstm(stmid)
+    #   Returns the number of objects and the list of parsed objects
+    #   in an object stream.
+    def getobjstm(self, stmid):
+        cached = self.parsed_objs.get(stmid)
+        if cached is not None:
+            if self.prefetcher is not None:
+                self.prefetcher.discard(stmid)
+            return cached
+        # Stuff from pdfminer: extract objects from object stream
+        stream = None
+        if self.prefetcher is not None:
+            stream = self.prefetcher.take(stmid)
+        if stream is None:
+            stream = stream_value(self.getobj(stmid))
+        if stream.dic.get('Type') is not LITERAL_OBJSTM:
+            if STRICT:
+                raise PDFSyntaxError('Not a stream object: %r' % stream)
+        try:
+            n = stream.dic['N']
+        except KeyError:
+            if STRICT:
+                raise PDFSyntaxError('N is not defined: %r' % stream)
+            n = 0
+        data = stream.get_data()
+        parser = PDFObjStrmParser(data, self)
+        objs = []
+        try:
+            while 1:
+                (_,obj) = parser.nextobject()
+                objs.append(obj)
+        except PSEOF:
+            pass
+        self.parsed_objs.put(stmid, (n, objs), len(data))
+        return (n, objs)
+
 
 class PDFObjStmRef(object):
     maxindex = 0
@@ -1915,8 +2696,12 @@ class PDFParser(PSStackParser):
                     raise PDFSyntaxError('Unexpected EOF')
                 return
             pos += len(line)
-            self.fp.seek(pos)
-            data = self.fp.read(objlen)
+            if self.doc.passthrough_size is not None and objlen >= self.doc.passthrough_size:
+                # big stream, leave the data in the file
+                data = None
+            else:
+                self.fp.seek(pos)
+                data = self.fp.read(objlen)
             self.seek(pos+objlen)
             while 1:
                 try:
@@ -1928,12 +2713,18 @@ class PDFParser(PSStackParser):
                 if b'endstream' in line:
                     i = line.index(b'endstream')
                     objlen += i
-                    data += line[:i]
+                    if data is not None:
+                        data += line[:i]
                     break
                 objlen += len(line)
-                data += line
+                if data is not None:
+                    data += line
             self.seek(pos+objlen)
-            obj = PDFStream(dic, data, self.doc.decipher)
+            if data is None:
+                source = (self, pos, min(objlen, self.filesize()-pos))
+                obj = PDFStream(dic, None, self.doc.decipher, source)
+            else:
+                obj = PDFStream(dic, data, self.doc.decipher)
             self.push((pos, obj))
             return
 
@@ -2058,6 +2849,7 @@ def adeptGetUserUUID(inf):
         inf = open(inf, 'rb')
         pars = PDFParser(doc, inf)
 
+        pars.close()
         (docid, param) = doc.encryption
         type = literal_name(param['Filter'])
         if type != 'EBX_HANDLER':
@@ -2082,15 +2874,42 @@ def adeptGetUserUUID(inf):
 ###
 ### My own code, for which there is none else to blame
 
+# bytes.isalnum() for a single byte
+ALNUM_BYTES = frozenset(b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz')
+
+# characters that need a backslash in front of them in a PDF string
+ESCAPE_STRING = re.compile(br'[\\\n()]')
+STRING_ESCAPES = { b'\\': b'\\\\', b'\n': b'\\n', b'(': b'\\(', b')': b'\\)' }
+
+def escape_char(m):
+    return STRING_ESCAPES[m.group()]
+
 class PDFSerializer(object):
-    def __init__(self, inf, userkey, inept=True):
+    # With streaming=True, objects are read from the input file again when
+    # they're needed instead of being kept in memory after they have been
+    # written, and at most objstm_cache_size bytes of decoded object streams
+    # are kept (None means OBJSTM_CACHE_SIZE). Only the cross reference table
+    # stays in memory.
+    def __init__(self, inf, userkey, inept=True, streaming=True, objstm_cache_size=None):
         global GEN_XREF_STM, gen_xref_stm
-        gen_xref_stm = GEN_XREF_STM > 1
+        if objstm_cache_size is None:
+            objstm_cache_size = OBJSTM_CACHE_SIZE
+        gen_xref_stm = GEN_XREF_STM > 1 and not REPACK_OBJSTM
+        self.objstm_size = REPACK_OBJSTM
+        self.dedup = DEDUP_STREAMS
         self.version = inf.read(8)
         inf.seek(0)
-        self.doc = doc = PDFDocument()
-        parser = PDFParser(doc, inf)
+        self.doc = doc = PDFDocument(objstm_cache_size if streaming else None)
+        self.parser = parser = PDFParser(doc, inf)
         doc.initialize(userkey, inept)
+        doc.keep_objs = not streaming
+        if streaming:
+            doc.passthrough_size = STREAM_CHUNK_SIZE
+        self.streaming = streaming
+        # encoded names of dictionary keys and literals
+        self.names = {}
+        # objid -> objid of the identical stream that's written instead
+        self.aliases = {}
         self.objids = objids = set()
         for xref in reversed(doc.xrefs):
             trailer = xref.trailer
@@ -2103,31 +2922,189 @@ class PDFSerializer(object):
             objids.remove(trailer.pop('Encrypt').objid)
         self.trailer = trailer
 
-    def dump(self, outf):
-        self.outf = outf
-        self.write(self.version)
-        self.write(b'\n%\xe2\xe3\xcf\xd3\n')
-        doc = self.doc
-        objids = self.objids
-        xrefs = {}
-        maxobj = max(objids)
-        trailer = dict(self.trailer)
-        trailer['Size'] = maxobj + 1
+    def close(self):
+        # releases the memory map of the input file
+        self.parser.close()
+
+    def prefetcher(self, objids):
+        # Returns a PDFObjStmPrefetcher for the object streams the objects
+        # are in, or None if they're not worth decoding in threads.
+        if gen_xref_stm or self.parser.data is None:
+            # object streams are copied as they are, or the input file
+            # can only be read through the parser
+            return None
+        jobs = DECODE_JOBS
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        if jobs <= 1:
+            return None
+        stmids = []
+        seen = set()
         for objid in objids:
+            try:
+                (stmid, _) = self.doc.xrefindex.getpos(objid)
+            except KeyError:
+                continue
+            if stmid and stmid not in seen:
+                seen.add(stmid)
+                stmids.append(stmid)
+        if len(stmids) < 2:
+            return None
+        return PDFObjStmPrefetcher(self.doc, stmids, jobs)
+
+    def find_duplicates(self):
+        # Reads all streams and makes every stream that's the same as one
+        # before it an alias of that one. Only the digests are kept.
+        doc = self.doc
+        first = {}
+        for objid in sorted(self.objids):
+            try:
+                (stmid, _) = doc.xrefindex.getpos(objid)
+            except KeyError:
+                continue
+            if stmid:
+                # streams are never in object streams
+                continue
+            obj = doc.getobj(objid)
+            if not isinstance(obj, PDFStream) or \
+                   obj.dic.get('Type') in (LITERAL_OBJSTM, LITERAL_XREF):
+                continue
+            # the data is the same, so the length is too, even if it's
+            # stored in different objects
+            dic = dict((k, v) for (k, v) in obj.dic.items() if k != 'Length')
+            digest = hashlib.sha256(self.serialize_packed(dic))
+            for data in obj.iter_decdata():
+                digest.update(data)
+            digest = digest.digest()
+            if digest in first:
+                self.aliases[objid] = first[digest]
+            else:
+                first[digest] = objid
+            if self.streaming:
+                doc.objs.pop(objid, None)
+            obj = None
+        if self.aliases:
+            print("Left out {0:d} duplicate streams".format(len(self.aliases)))
+
+    def dump_objects(self, xrefs):
+        # Write the objects in order, so objects from the same
+        # object stream are next to each other.
+        doc = self.doc
+        aliases = self.aliases
+        for objid in sorted(self.objids):
+            if objid in aliases:
+                continue
+            if doc.prefetcher is not None:
+                doc.prefetcher.fill()
             obj = doc.getobj(objid)
             if isinstance(obj, PDFObjStmRef):
                 xrefs[objid] = obj
                 continue
             if obj is not None:
+                if self.objstm_size:
+                    if not isinstance(obj, PDFStream):
+                        self.pack_object(objid, obj, xrefs)
+                        obj = None
+                        continue
+                    if obj.dic.get('Type') in (LITERAL_OBJSTM, LITERAL_XREF):
+                        # replaced by the new ones
+                        continue
                 try:
                     genno = obj.genno
                 except AttributeError:
                     genno = 0
                 xrefs[objid] = (self.tell(), genno)
                 self.serialize_indirect(objid, obj)
+                if self.streaming and not isinstance(obj, int):
+                    # drop what was cached while setting up the document
+                    doc.objs.pop(objid, None)
+            obj = None
+        if self.objstm_size:
+            self.write_objstm(xrefs)
+
+    # Objects for the next object stream are collected in self.packed
+    # until there's objstm_size of them.
+    def pack_object(self, objid, obj, xrefs):
+        self.packed.append((objid, self.serialize_packed(obj)))
+        if len(self.packed) >= self.objstm_size:
+            self.write_objstm(xrefs)
+
+    def write_objstm(self, xrefs):
+        if not self.packed:
+            return
+        stmid = self.nextobjid
+        self.nextobjid += 1
+        header = []
+        offset = 0
+        for (index, (objid, data)) in enumerate(self.packed):
+            header.append(b'%d %d' % (objid, offset))
+            offset += len(data) + 1
+            xrefs[objid] = PDFObjStmRef(objid, stmid, index)
+        header = b' '.join(header) + b'\n'
+        data = zlib.compress(header + b'\n'.join(data for (_, data) in self.packed))
+        dic = {'Type': LITERAL_OBJSTM, 'N': len(self.packed), 'First': len(header),
+               'Length': len(data), 'Filter': LITERALS_FLATE_DECODE[0]}
+        self.packed = []
+        xrefs[stmid] = (self.tell(), 0)
+        self.write(b'%d 0 obj' % (stmid,))
+        self.serialize_object(dic)
+        self.write(b'stream\n')
+        self.write_data(data)
+        self.write(b'\nendstream\nendobj\n')
+
+    def serialize_packed(self, obj):
+        # Returns the serialized object, without writing it to the file.
+        saved = (self.outf, self.buf, self.pos, self.last)
+        self.outf = BytesIO()
+        self.buf = bytearray()
+        self.pos = 0
+        self.last = b''
+        try:
+            self.serialize_object(obj)
+            self.flush()
+            return self.outf.getvalue()
+        finally:
+            (self.outf, self.buf, self.pos, self.last) = saved
+
+    def dump(self, outf):
+        self.outf = outf
+        self.buf = bytearray()
+        self.pos = outf.tell()
+        self.last = b''
+        version = self.version
+        if self.objstm_size or gen_xref_stm:
+            # object streams and cross reference streams need PDF 1.5
+            m = re.match(br'%PDF-(\d+)\.(\d+)', version)
+            if m is None or (int(m.group(1)), int(m.group(2))) < (1, 5):
+                version = b'%PDF-1.5'
+        self.write(version)
+        self.write(b'\n%\xe2\xe3\xcf\xd3\n')
+        doc = self.doc
+        objids = self.objids
+        xrefs = {}
+        maxobj = max(objids)
+        # everything from the input trailer but what describes its cross
+        # reference stream (if it had one), which is written anew
+        trailer = dict((k, v) for (k, v) in self.trailer.items()
+                       if k not in XREF_STREAM_KEYS)
+        trailer['Size'] = maxobj + 1
+        if self.dedup:
+            self.find_duplicates()
+        # new object streams are numbered after the last object
+        self.packed = []
+        self.nextobjid = maxobj + 1
+        doc.prefetcher = self.prefetcher(sorted(objids))
+        try:
+            self.dump_objects(xrefs)
+        finally:
+            if doc.prefetcher is not None:
+                doc.prefetcher.close()
+                doc.prefetcher = None
         startxref = self.tell()
+        if self.objstm_size:
+            maxobj = self.nextobjid - 1
 
-        if not gen_xref_stm:
+        if not gen_xref_stm and not self.objstm_size:
             self.write(b'xref\n')
             self.write(b'0 %d\n' % (maxobj + 1,))
             for objid in range(0, maxobj + 1):
@@ -2189,28 +3166,57 @@ class PDFSerializer(object):
                 data.append(struct.pack('>L', f3)[-fl3:])
             index.extend((first, prev - first + 1))
             data = zlib.compress(b''.join(data))
-            dic = {'Type': LITERAL_XREF, 'Size': prev + 1, 'Index': index,
-                   'W': [1, fl2, fl3], 'Length': len(data),
-                   'Filter': LITERALS_FLATE_DECODE[0],
-                   'Root': trailer['Root'],}
-            if 'Info' in trailer:
-                dic['Info'] = trailer['Info']
+            dic = dict(trailer)
+            dic.update({'Type': LITERAL_XREF, 'Size': prev + 1, 'Index': index,
+                        'W': [1, fl2, fl3], 'Length': len(data),
+                        'Filter': LITERALS_FLATE_DECODE[0],})
             xrefstm = PDFStream(dic, data)
             self.serialize_indirect(maxobj, xrefstm)
             self.write(b'startxref\n%d\n%%%%EOF' % startxref)
+        self.flush()
+
+    # The output is collected in self.buf and written to the file once
+    # there's WRITE_BUFFER_SIZE bytes of it. self.last is the last byte
+    # that was written to the file.
     def write(self, data):
+        buf = self.buf
+        buf += data
+        if len(buf) >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def write_data(self, data):
+        # for stream data, big pieces aren't copied into the buffer
+        if len(data) < WRITE_BUFFER_SIZE:
+            self.write(data)
+            return
+        self.flush()
         self.outf.write(data)
+        self.pos += len(data)
         self.last = data[-1:]
 
+    def flush(self):
+        buf = self.buf
+        if buf:
+            self.outf.write(buf)
+            self.pos += len(buf)
+            self.last = bytes(buf[-1:])
+            del buf[:]
+
     def tell(self):
-        return self.outf.tell()
+        return self.pos + len(self.buf)
+
+    def after_alnum(self):
+        # True if the last byte written was a letter or digit,
+        # so the next token needs a space in front of it.
+        buf = self.buf
+        if buf:
+            return buf[-1] in ALNUM_BYTES
+        return self.last.isalnum()
 
     def escape_string(self, string):
-        string = string.replace(b'\\', b'\\\\')
-        string = string.replace(b'\n', b'\\n')
-        string = string.replace(b'(', b'\\(')
-        string = string.replace(b')', b'\\)')
-        return string
+        if ESCAPE_STRING.search(string) is None:
+            return string
+        return ESCAPE_STRING.sub(escape_char, string)
 
     def serialize_object(self, obj):
         if isinstance(obj, dict):
@@ -2221,8 +3227,12 @@ class PDFSerializer(object):
                 del obj['Type']
             # end - hope this doesn't have bad effects
             self.write(b'<<')
+            names = self.names
             for key, val in obj.items():
-                self.write(str(LIT(key.encode('utf-8'))).encode('utf-8'))
+                name = names.get(key)
+                if name is None:
+                    name = names[key] = str(LIT(key.encode('utf-8'))).encode('utf-8')
+                self.write(name)
                 self.serialize_object(val)
             self.write(b'>>')
         elif isinstance(obj, list):
@@ -2237,21 +3247,21 @@ class PDFSerializer(object):
         elif isinstance(obj, str):
             self.write(b'(%s)' % self.escape_string(obj.encode('utf-8')))
         elif isinstance(obj, bool):
-            if self.last.isalnum():
+            if self.after_alnum():
                 self.write(b' ')
-            self.write(str(obj).lower().encode('utf-8'))
+            self.write(b'true' if obj else b'false')
         elif isinstance(obj, int):
-            if self.last.isalnum():
+            if self.after_alnum():
                 self.write(b' ')
-            self.write(str(obj).encode('utf-8'))
+            self.write(b'%d' % obj)
         elif isinstance(obj, Decimal):
-            if self.last.isalnum():
+            if self.after_alnum():
                 self.write(b' ')
             self.write(str(obj).encode('utf-8'))
         elif isinstance(obj, PDFObjRef):
-            if self.last.isalnum():
+            if self.after_alnum():
                 self.write(b' ')
-            self.write(b'%d %d R' % (obj.objid, 0))
+            self.write(b'%d %d R' % (self.aliases.get(obj.objid, obj.objid), 0))
         elif isinstance(obj, PDFStream):
             ### If we don't generate cross ref streams the object streams
             ### are no longer useful, as we have extracted all objects from
@@ -2259,21 +3269,27 @@ class PDFSerializer(object):
             if obj.dic.get('Type') == LITERAL_OBJSTM and not gen_xref_stm:
                 self.write(b'(deleted)')
             else:
-                data = obj.get_decdata()
                 self.serialize_object(obj.dic)
                 self.write(b'stream\n')
-                self.write(data)
+                for data in obj.iter_decdata():
+                    self.write_data(data)
                 self.write(b'\nendstream')
+        elif isinstance(obj, PSLiteral):
+            # never starts with a letter or digit
+            name = self.names.get(obj)
+            if name is None:
+                name = self.names[obj] = str(obj).encode('utf-8')
+            self.write(name)
         else:
             data = str(obj).encode('utf-8')
-            if bytes([data[0]]).isalnum() and self.last.isalnum():
+            if data[0] in ALNUM_BYTES and self.after_alnum():
                 self.write(b' ')
             self.write(data)
 
     def serialize_indirect(self, objid, obj):
         self.write(b'%d 0 obj' % (objid,))
         self.serialize_object(obj)
-        if self.last.isalnum():
+        if self.after_alnum():
             self.write(b'\n')
         self.write(b'endobj\n')
 
@@ -2291,6 +3307,8 @@ def decryptBook(userkey, inpath, outpath, inept=True):
                 print("error writing pdf: {0}".format(e))
                 traceback.print_exc()
                 return 2
+            finally:
+                serializer.close()
     return 0
 
 
@@ -2299,17 +3317,132 @@ def getPDFencryptionType(inpath):
         doc = doc = PDFDocument()
         parser = PDFParser(doc, inf)
         filter = doc.initialize_and_return_filter()
+        parser.close()
         return filter
 
 
+def _tokenizer_sample(count=2000):
+    # A PDF using most of the syntax the tokenizers have to deal with.
+    out = [b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n']
+    offsets = []
+    def add(body):
+        offsets.append(sum(len(x) for x in out))
+        out.append(b'%d 0 obj\n%s\nendobj\n' % (len(offsets), body))
+    add(b'<< /Type /Catalog /Pages 2 0 R >>')
+    add(b'<</Type/Pages/Kids[]/Count 0>>')
+    for i in range(3, count):
+        if i % 10 == 0:
+            data = b'BT /F1 12 Tf (Hello %d) Tj ET' % i
+            add(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(data), data))
+        else:
+            add(b'<< /Name#20With#41Hex /A#2fB#zz /N -%d /P +%d /D %d.25 /F .5 /Neg -.75 /Odd 1. %% comment\n'
+                b'/S (nested (paren) \\( \\) \\\\ esc\\n\\tab\\\nline) /E () /H <48 65 6c6C6f> /Ho <abc>\n'
+                b'/A [1 %d 0 R /X true false null [ ] {}] /Sub<</K[%d 0 R]/Empty<<>>>> >>' % (i, i, i, i - 1, i - 2))
+    startxref = sum(len(x) for x in out)
+    out.append(b'xref\n0 %d\n0000000000 65535 f \n' % (len(offsets) + 1))
+    out.extend(b'%010d 00000 n \n' % pos for pos in offsets)
+    out.append(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(offsets) + 1, startxref))
+    return b''.join(out)
+
+
+def _canonical(obj):
+    # Something that compares equal for equal objects from different documents.
+    if isinstance(obj, PDFObjRef):
+        return ('R', obj.objid, obj.genno)
+    if isinstance(obj, PDFStream):
+        return ('stream', _canonical(obj.dic), obj.rawdata)
+    if isinstance(obj, dict):
+        return dict((k, _canonical(v)) for (k, v) in obj.items())
+    if isinstance(obj, list):
+        return [_canonical(v) for v in obj]
+    return (type(obj), obj)
+
+
+def _parse_all(fp, whole):
+    # Reads every token (if whole is True) and every object of a file,
+    # returns them and how long each took.
+    import time
+    start = time.time()
+    tokens = []
+    if whole:
+        parser = PSBaseParser(fp)
+        try:
+            while 1:
+                tokens.append(_canonical(parser.nexttoken()))
+        except PSEOF:
+            pass
+        parser.close()
+    middle = time.time()
+    doc = PDFDocument()
+    parser = PDFParser(doc, fp)
+    doc.ready = True
+    objids = set()
+    for xref in doc.xrefs:
+        objids.update(xref.objids())
+    objs = [(objid, _canonical(doc.getobj(objid))) for objid in sorted(objids)]
+    parser.close()
+    return (tokens, objs, middle - start, time.time() - middle)
+
+
+def benchmark_tokenizers(paths=()):
+    # Checks that both tokenizers return the same tokens and objects, and
+    # compares their speed. Uses a generated sample unless PDF files are given,
+    # the sample is plain text, so it is also tokenized as a whole.
+    # Returns the number of files where the results differ.
+    global FAST_TOKENIZER
+    saved = FAST_TOKENIZER
+    if paths:
+        inputs = [(path, lambda path=path: open(path, 'rb')) for path in paths]
+    else:
+        sample = _tokenizer_sample()
+        inputs = [("sample", lambda: BytesIO(sample))]
+    failed = 0
+    try:
+        for (name, opener) in inputs:
+            results = []
+            for fast in (False, True):
+                FAST_TOKENIZER = fast
+                engine = "regex" if fast else "state machine"
+                with opener() as fp:
+                    try:
+                        (tokens, objs, t1, t2) = _parse_all(fp, not paths)
+                    except Exception as e:
+                        print("{0}: {1} tokenizer failed: {2!r}".format(name, engine, e))
+                        results.append(None)
+                        continue
+                results.append((tokens, objs))
+                print("{0}: {1} tokenizer: {2} tokens in {3:.3f} s, {4} objects in {5:.3f} s".format(
+                    name, engine, len(tokens), t1, len(objs), t2))
+            if results[0] == results[1]:
+                print("{0}: same results".format(name))
+            else:
+                failed += 1
+                print("{0}: RESULTS DIFFER".format(name))
+    finally:
+        FAST_TOKENIZER = saved
+    return failed
+
+
 
 def cli_main():
     sys.stdout=SafeUnbuffered(sys.stdout)
     sys.stderr=SafeUnbuffered(sys.stderr)
     argv=unicode_argv()
     progname = os.path.basename(argv[0])
+    global REPACK_OBJSTM, DEDUP_STREAMS
+    while len(argv) > 1 and argv[1].startswith('--'):
+        opt = argv.pop(1)
+        if opt == '--repack':
+            REPACK_OBJSTM = 100
+        elif opt.startswith('--repack='):
+            REPACK_OBJSTM = int(opt[len('--repack='):])
+        elif opt == '--dedup':
+            DEDUP_STREAMS = True
+        else:
+            print("unknown option {0}".format(opt))
+            return 1
     if len(argv) != 4:
-        print("usage: {0} <keyfile.der> <inbook.pdf> <outbook.pdf>".format(progname))
+        print("usage: {0} [--repack[=objects]] [--dedup] <keyfile.der> <inbook.pdf> <outbook.pdf>".format(progname))
         return 1
     keypath, inpath, outpath = argv[1:]
     userkey = open(keypath,'rb').read()
@@ -2436,6 +3569,8 @@ def gui_main():
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark-tokenizer':
+        sys.exit(benchmark_tokenizers(sys.argv[2:]))
     if len(sys.argv) > 1:
         sys.exit(cli_main())
     sys.exit(gui_main())
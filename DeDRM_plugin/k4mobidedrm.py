@@ -5,7 +5,7 @@
 # Copyright © 2008-2020 by Apprentice Harper et al.
 
 __license__ = 'GPL v3'
-__version__ = '6.0'
+__version__ = '6.1'
 
 # Engine to remove drm from Kindle and Mobipocket ebooks
 # for personal use for archiving and converting your ebooks
@@ -61,6 +61,7 @@ __version__ = '6.0'
 #  5.6 - Invoke KFXZipBook to handle zipped KFX files
 #  5.7 - Revamp cleanup_name
 #  6.0 - Added Python 3 compatibility for calibre 5.0
+#  6.1 - GetDecryptedBook can sort the PIDs so the most likely ones are tried first
 
 
 import sys, os, re
@@ -198,7 +199,10 @@ def unescape(text):
         return text # leave as is
     return re.sub("&#?\\w+;", fixup, text)
 
-def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime = time.time()):
+# pidorder, if given, is called as pidorder(md1, md2, pids) with the book's PID
+# meta info and returns the PIDs in the order they should be tried.
+# The returned book's pid attribute is set to the PID that worked.
+def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime = time.time(), pidorder = None):
     # handle the obvious cases at the beginning
     if not os.path.isfile(infile):
         raise DrmException("Input file does not exist.")
@@ -233,8 +237,10 @@ def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime
     # extend PID list with book-specific PIDs from seriala and kDatabases
     md1, md2 = mb.getPIDMetaInfo()
     totalpids.extend(kgenpids.getPidList(md1, md2, serials, kDatabases))
-    # remove any duplicates
-    totalpids = list(set(totalpids))
+    # remove any duplicates, keeping the order
+    totalpids = list(dict.fromkeys(totalpids))
+    if pidorder is not None:
+        totalpids = pidorder(md1, md2, totalpids)
     print("Found {1:d} keys to try after {0:.1f} seconds".format(time.time()-starttime, len(totalpids)))
     #print totalpids
 
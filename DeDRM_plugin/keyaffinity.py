@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+__license__ = 'GPL v3'
+
+# Remembers which key decrypted which books, so that key can be tried first
+# next time. Stored next to the plugin preferences.
+
+# Standard Python modules.
+import os, sys
+import hashlib
+import traceback
+
+
+#@@CALIBRE_COMPAT_CODE@@
+
+
+try:
+    from calibre.utils.config import JSONConfig
+except:
+    from standalone.jsonconfig import JSONConfig
+
+from __init__ import PLUGIN_NAME
+
+# Number of books per format we remember the key for.
+MAX_BOOKS = 5000
+
+
+def keyid(value):
+    # For keys that don't have a name (like Kindle PIDs) we store a hash
+    # instead of the key itself.
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return hashlib.sha1(bytes(value)).hexdigest()[:16]
+
+
+def pidkeyid(pid):
+    # Mobi and Topaz books only use the first 8 digits of the PID,
+    # KFX uses the full DSN + account secret.
+    if isinstance(pid, (bytes, bytearray)):
+        pid = pid.decode('latin-1')
+    if len(pid) <= 10:
+        pid = pid[0:8]
+    return keyid(pid)
+
+
+def kindlebookid(md1, md2):
+    # Identifies a Kindle book by the meta info its PIDs are generated from.
+    if not md1:
+        return None
+    return keyid(bytes(md1) + bytes(md2 or b''))
+
+
+class DeDRM_KeyAffinity():
+    def __init__(self, json_path=None):
+        if json_path is None:
+            JSON_PATH = os.path.join("plugins", PLUGIN_NAME.strip().lower().replace(' ', '_') + '_key_affinity.json')
+        else:
+            JSON_PATH = json_path
+
+        self.affinity = JSONConfig(JSON_PATH)
+        self.affinity.defaults['formats'] = {}
+
+    def _format(self, fmt):
+        return self.affinity['formats'].get(fmt, { "keys": {}, "books": {} })
+
+    def order(self, fmt, candidates, book_id=None, key=lambda c: c[0]):
+        # Sort candidates most-likely-first: the key that decrypted this book
+        # before, then the other keys by how many books of this format they
+        # decrypted. "key" maps a candidate to the name stored in record().
+        # Keys that never worked keep their original order.
+        candidates = list(candidates)
+        try:
+            data = self._format(fmt)
+            counts = data["keys"]
+            bookkey = data["books"].get(book_id) if book_id is not None else None
+            return sorted(candidates, key=lambda c: (key(c) != bookkey, -counts.get(key(c), 0)))
+        except:
+            traceback.print_exc()
+            return candidates
+
+    def record(self, fmt, keyname, book_id=None):
+        try:
+            formats = self.affinity['formats']
+            data = formats.get(fmt, { "keys": {}, "books": {} })
+            data["keys"][keyname] = data["keys"].get(keyname, 0) + 1
+            if book_id is not None:
+                books = data["books"]
+                books.pop(book_id, None)
+                books[book_id] = keyname
+                # Forget the oldest books
+                while len(books) > MAX_BOOKS:
+                    del books[next(iter(books))]
+            formats[fmt] = data
+            # reassign so the change gets written to disk
+            self.affinity['formats'] = formats
+        except:
+            traceback.print_exc()
@@ -6,12 +6,15 @@
 #  2.0   - Python 3 for calibre 5.0
 #  2.1   - Some fixes for debugging
 #  2.1.1 - Whitespace!
+#  2.2   - Copy the unencrypted files in the .kfx-zip without recompressing them
+#  2.3   - Remember which PID decrypted the voucher
 
 
 import os, sys
 import shutil
 import traceback
 import zipfile
+import zipfilerugged
 
 from io import BytesIO
 
@@ -32,6 +35,7 @@ class KFXZipBook:
         self.infile = infile
         self.voucher = None
         self.decrypted = {}
+        self.pid = None
 
     def getPIDMetaInfo(self):
         return (None, None)
@@ -84,6 +88,7 @@ class KFXZipBook:
                 voucher = DrmIonVoucher(BytesIO(data), pid[:dsn_len], pid[dsn_len:])
                 voucher.parse()
                 voucher.decryptvoucher()
+                self.pid = pid
                 break
             except:
                 traceback.print_exc()
@@ -118,7 +123,16 @@ class KFXZipBook:
         if not self.decrypted:
             shutil.copyfile(self.infile, outpath)
         else:
-            with zipfile.ZipFile(self.infile, 'r') as zif:
-                with zipfile.ZipFile(outpath, 'w') as zof:
+            with zipfilerugged.ZipFile(self.infile, 'r') as zif:
+                with zipfilerugged.ZipFile(outpath, 'w') as zof:
                     for info in zif.infolist():
-                        zof.writestr(info, self.decrypted.get(info.filename, zif.read(info.filename)))
+                        if info.flag_bits & 0x800:
+                            filename = info.filename.decode('utf-8')
+                        else:
+                            filename = info.filename.decode('cp437')
+                        if filename in self.decrypted:
+                            info.flag_bits &= ~0x08
+                            zof.writestr(info, self.decrypted[filename])
+                        else:
+                            # Copy everything else over without recompressing it
+                            zof.copyraw(zif, info)
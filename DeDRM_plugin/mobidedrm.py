@@ -7,7 +7,7 @@
 
 from __future__ import print_function
 __license__ = 'GPL v3'
-__version__ = "1.1"
+__version__ = "1.5"
 
 # This is a python script. You need a Python interpreter to run it.
 # For example, ActiveState Python, which exists for windows.
@@ -75,11 +75,16 @@ __version__ = "1.1"
 #  0.42 - Added GPL v3 licence. updated/removed some print statements
 #  1.0  - Python 3 compatibility for calibre 5.0
 #  1.1  - Speed Python PC1 implementation up a little bit
+#  1.2  - Remember which PID decrypted the book
+#  1.3  - Python PC1 implementation from alfcrypto is used if the library can't be loaded
+#  1.4  - Decrypt the records of large books in parallel
+#  1.5  - Memory map the input and write the output record by record
 
 import sys
 import os
 import struct
 import binascii
+import mmap
 try:
     from alfcrypto import Pukall_Cipher
 except:
@@ -159,6 +164,9 @@ class DrmException(Exception):
 
 # Implementation of Pukall Cipher 1
 def PC1(key, src, decryption=True):
+    # the alfcrypto library only takes bytes, not memoryviews or bytearrays
+    if not isinstance(src, bytes):
+        src = bytes(src)
     # if we can get it from alfcrypto, use that
     try:
         return Pukall_Cipher().PC1(key,src,decryption)
@@ -168,11 +176,16 @@ def PC1(key, src, decryption=True):
         pass
 
     # use slow python version, since Pukall_Cipher didn't load
+    return PC1_reference(key, src, decryption)
+
+# Straightforward implementation of the algorithm, much slower than the
+# table driven one in alfcrypto but easier to follow.
+def PC1_reference(key, src, decryption=True):
     sum1 = 0;
     sum2 = 0;
     keyXorVal = 0;
     if len(key)!=16:
-         DrmException ("PC1: Bad key length")
+        raise DrmException ("PC1: Bad key length")
     wkey = []
     for i in range(8):
         wkey.append(key[i*2]<<8 | key[i*2+1])
@@ -198,6 +211,69 @@ def PC1(key, src, decryption=True):
         dst[i] = curByte
     return bytes(dst)
 
+# Number of threads (or processes) used to decrypt the records of a book.
+# None means automatic: books larger than PARALLEL_THRESHOLD use all cores,
+# if the alfcrypto library is available (it releases the GIL, the Python
+# implementation doesn't, so that needs processes and is only used if the
+# number of jobs is set explicitly).
+DECRYPT_JOBS = None
+PARALLEL_THRESHOLD = 8 * 1024 * 1024
+
+def setDecryptJobs(jobs):
+    global DECRYPT_JOBS
+    DECRYPT_JOBS = jobs
+
+def _decryptRecordChunk(key, records):
+    return [PC1(key, data) for data in records]
+
+# Returns the number of workers to decrypt "total" bytes of records with.
+def decryptJobs(total):
+    if DECRYPT_JOBS is not None:
+        return DECRYPT_JOBS
+    native = getattr(globals().get('Pukall_Cipher'), 'native', False)
+    if not native or total < PARALLEL_THRESHOLD:
+        return 1
+    return os.cpu_count() or 1
+
+# Decrypts a list of records, each starting with fresh cipher state.
+# Returns the decrypted records in the same order.
+def decryptRecords(key, records, jobs=None):
+    native = getattr(globals().get('Pukall_Cipher'), 'native', False)
+    total = sum(len(data) for data in records)
+    if jobs is None:
+        jobs = decryptJobs(total)
+
+    if jobs <= 1 or len(records) < 2:
+        return _decryptRecordChunk(key, records)
+
+    # Split the book into a few chunks per worker, so they all get
+    # about the same amount of work without too much overhead per record.
+    chunksize = max(total // (jobs * 4), 256 * 1024)
+    chunks = []
+    current = []
+    current_size = 0
+    for data in records:
+        current.append(bytes(data))
+        current_size += len(data)
+        if current_size >= chunksize:
+            chunks.append(current)
+            current = []
+            current_size = 0
+    if current:
+        chunks.append(current)
+
+    if native:
+        from concurrent.futures import ThreadPoolExecutor as Executor
+    else:
+        from concurrent.futures import ProcessPoolExecutor as Executor
+
+    with Executor(max_workers=min(jobs, len(chunks))) as executor:
+        results = executor.map(_decryptRecordChunk, [key] * len(chunks), chunks)
+        decrypted = []
+        for result in results:
+            decrypted.extend(result)
+    return decrypted
+
 # accepts unicode returns unicode
 def checksumPid(s):
     letters = 'ABCDEFGHIJKLMNPQRSTUVWXYZ123456789'
@@ -241,7 +317,11 @@ def getSizeOfTrailingDataEntries(ptr, size, flags):
 
 
 class MobiBook:
+    # Returns a memoryview of the section in the mapped file,
+    # or the patched copy if the section was patched.
     def loadSection(self, section):
+        if section in self.patched:
+            return self.patched[section]
         if (section + 1 == self.num_sections):
             endoff = len(self.data_file)
         else:
@@ -251,7 +331,17 @@ class MobiBook:
 
     def cleanup(self):
         # to match function in Topaz book
-        pass
+        if self.data_file is None:
+            return
+        self.data_file.release()
+        self.data_file = None
+        if self.data_map is not None:
+            try:
+                self.data_map.close()
+            except BufferError:
+                # somebody still holds a section, it gets closed once that's gone
+                pass
+        self.fo.close()
 
     def __init__(self, infile):
         print("MobiDeDrm v{0:s}.\nCopyright © 2008-2020 The Dark Reverser, Apprentice Harper et al.".format(__version__))
@@ -261,14 +351,26 @@ class MobiBook:
         except:
             print("AlfCrypto not found. Using python PC1 implementation.")
 
+        # Map the file instead of reading it, so large books don't need
+        # to fit into memory (several times) while they are decrypted.
+        self.fo = open(infile, 'rb')
+        try:
+            self.data_map = mmap.mmap(self.fo.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data_file = memoryview(self.data_map)
+        except (ValueError, OSError):
+            # empty file, or no mmap support for this file
+            self.data_map = None
+            self.data_file = memoryview(self.fo.read())
+        self.patched = {}
+        self.found_key = None
+
         # initial sanity check on file
-        self.data_file = open(infile, 'rb').read()
-        self.mobi_data = ''
-        self.header = self.data_file[0:78]
+        self.header = bytes(self.data_file[0:78])
         if self.header[0x3C:0x3C+8] != b'BOOKMOBI' and self.header[0x3C:0x3C+8] != b'TEXtREAd':
             raise DrmException("Invalid file format")
         self.magic = self.header[0x3C:0x3C+8]
         self.crypto_type = -1
+        self.pid = None
 
         # build up section offset and flag info
         self.num_sections, = struct.unpack('>H', self.header[76:78])
@@ -278,8 +380,9 @@ class MobiBook:
             flags, val = a1, a2<<16|a3<<8|a4
             self.sections.append( (offset, flags, val) )
 
-        # parse information from section 0
-        self.sect = self.loadSection(0)
+        # parse information from section 0, we keep a copy
+        # of it as it gets patched
+        self.sect = self.patched[0] = bytearray(self.loadSection(0))
         self.records, = struct.unpack('>H', self.sect[0x8:0x8+2])
         self.compression, = struct.unpack('>H', self.sect[0x0:0x0+2])
 
@@ -312,7 +415,7 @@ class MobiBook:
             exth_flag, = struct.unpack('>L', self.sect[0x80:0x84])
             exth = b''
             if exth_flag & 0x40:
-                exth = self.sect[16 + self.mobi_length:]
+                exth = bytes(self.sect[16 + self.mobi_length:])
             if (len(exth) >= 12) and (exth[:4] == b'EXTH'):
                 nitems, = struct.unpack('>I', exth[8:12])
                 pos = 12
@@ -355,7 +458,7 @@ class MobiBook:
             else:
                 toff, tlen = struct.unpack('>II', self.sect[0x54:0x5c])
                 tend = toff + tlen
-                title = self.sect[toff:tend]
+                title = bytes(self.sect[toff:tend])
             if self.mobi_codepage in codec_map.keys():
                 codec = codec_map[self.mobi_codepage]
         if title == b'':
@@ -378,19 +481,13 @@ class MobiBook:
                 token += sval
         return rec209, token
 
-    # new must be byte array
-    def patch(self, off, new):
-        self.data_file = self.data_file[:off] + new + self.data_file[off+len(new):]
-
     # new must be byte array
     def patchSection(self, section, new, in_off = 0):
-        if (section + 1 == self.num_sections):
-            endoff = len(self.data_file)
-        else:
-            endoff = self.sections[section + 1][0]
-        off = self.sections[section][0]
-        assert off + in_off + len(new) <= endoff
-        self.patch(off + in_off, new)
+        if section not in self.patched:
+            self.patched[section] = bytearray(self.loadSection(section))
+        data = self.patched[section]
+        assert in_off + len(new) <= len(data)
+        data[in_off:in_off + len(new)] = new
 
     # pids in pidlist must be unicode, returned key is byte array, pid is unicode
     def parseDRM(self, data, count, pidlist):
@@ -427,7 +524,50 @@ class MobiBook:
         return [found_key,pid]
 
     def getFile(self, outpath):
-        open(outpath,'wb').write(self.mobi_data)
+        with open(outpath, 'wb') as f:
+            self.writeBook(f)
+
+    # Writes the book to the file object f, decrypting the text records
+    # in batches on the way, so only a few records are in memory at once.
+    def writeBook(self, f):
+        f.write(self.data_file[:self.sections[0][0]])
+        f.write(self.loadSection(0))
+        if self.found_key is None:
+            for i in range(1, self.num_sections):
+                f.write(self.loadSection(i))
+            return
+
+        print("Decrypting. Please wait . . .", end=' ')
+        last = min(self.records, self.num_sections - 1)
+        if last + 1 < self.num_sections:
+            end = self.sections[last + 1][0]
+        else:
+            end = len(self.data_file)
+        jobs = decryptJobs(end - self.sections[1][0])
+        batch_limit = max(jobs, 1) * 1024 * 1024
+
+        batch = []
+        batch_size = 0
+        def flush():
+            decrypted = decryptRecords(self.found_key, [record for record, trailing in batch], jobs)
+            for i, decoded_data in enumerate(decrypted):
+                f.write(decoded_data)
+                f.write(batch[i][1])
+            del batch[:]
+
+        for i in range(1, last + 1):
+            data = self.loadSection(i)
+            extra_size = getSizeOfTrailingDataEntries(data, len(data), self.extra_data_flags)
+            batch.append((data[0:len(data) - extra_size], data[len(data) - extra_size:]))
+            batch_size += len(data)
+            if batch_size >= batch_limit:
+                flush()
+                batch_size = 0
+        flush()
+
+        for i in range(last + 1, self.num_sections):
+            f.write(self.loadSection(i))
+        print("done")
 
     def getBookType(self):
         if self.print_replica:
@@ -454,7 +594,6 @@ class MobiBook:
             print("This book is not encrypted.")
             # we must still check for Print Replica
             self.print_replica = (self.loadSection(1)[0:4] == b'%MOP')
-            self.mobi_data = self.data_file
             return
         if crypto_type != 2 and crypto_type != 1:
             raise DrmException("Cannot decode unknown Mobipocket encryption type {0:d}".format(crypto_type))
@@ -496,7 +635,7 @@ class MobiBook:
             drm_ptr, drm_count, drm_size, drm_flags = struct.unpack('>LLLL', self.sect[0xA8:0xA8+16])
             if drm_count == 0:
                 raise DrmException("Encryption not initialised. Must be opened with Mobipocket Reader first.")
-            found_key, pid = self.parseDRM(self.sect[drm_ptr:drm_ptr+drm_size], drm_count, goodpids)
+            found_key, pid = self.parseDRM(bytes(self.sect[drm_ptr:drm_ptr+drm_size]), drm_count, goodpids)
             if not found_key:
                 raise DrmException("No key found in {0:d} PIDs tried.".format(len(goodpids)))
             # kill the drm keys
@@ -508,30 +647,19 @@ class MobiBook:
             print("File has default encryption, no specific key needed.")
         else:
             print("File is encoded with PID {0}.".format(checksumPid(pid)))
+            self.pid = pid
 
         # clear the crypto type
         self.patchSection(0, b'\0' * 2, 0xC)
 
-        # decrypt sections
-        print("Decrypting. Please wait . . .", end=' ')
-        mobidataList = []
-        mobidataList.append(self.data_file[:self.sections[1][0]])
-        for i in range(1, self.records+1):
-            data = self.loadSection(i)
+        # The records get decrypted while the book is written (see writeBook),
+        # only check the first one for Print Replica here.
+        self.found_key = found_key
+        if self.records > 0:
+            data = self.loadSection(1)
             extra_size = getSizeOfTrailingDataEntries(data, len(data), self.extra_data_flags)
-            if i%100 == 0:
-                print(".", end=' ')
-            # print "record %d, extra_size %d" %(i,extra_size)
             decoded_data = PC1(found_key, data[0:len(data) - extra_size])
-            if i==1:
-                self.print_replica = (decoded_data[0:4] == b'%MOP')
-            mobidataList.append(decoded_data)
-            if extra_size > 0:
-                mobidataList.append(data[-extra_size:])
-        if self.num_sections > self.records+1:
-            mobidataList.append(self.data_file[self.sections[self.records+1][0]:])
-        self.mobi_data = b''.join(mobidataList)
-        print("done")
+            self.print_replica = (decoded_data[0:4] == b'%MOP')
         return
 
 # pids in pidlist must be unicode
@@ -539,8 +667,14 @@ def getUnencryptedBook(infile,pidlist):
     if not os.path.isfile(infile):
         raise DrmException("Input File Not Found.")
     book = MobiBook(infile)
-    book.processBook(pidlist)
-    return book.mobi_data
+    try:
+        book.processBook(pidlist)
+        from io import BytesIO
+        data = BytesIO()
+        book.writeBook(data)
+        return data.getvalue()
+    finally:
+        book.cleanup()
 
 
 def cli_main():
@@ -560,8 +694,12 @@ def cli_main():
         else:
             pidlist = []
         try:
-            stripped_file = getUnencryptedBook(infile, pidlist)
-            open(outfile, 'wb').write(stripped_file)
+            book = MobiBook(infile)
+            try:
+                book.processBook(pidlist)
+                book.getFile(outfile)
+            finally:
+                book.cleanup()
         except DrmException as e:
             print("MobiDeDRM v{0} Error: {1:s}".format(__version__,e.args[0]))
             return 1
@@ -50,6 +50,9 @@ def decryptepub(infile, outdir, rscpath):
                     if rv == 0:
                         print("Decrypted Adobe ePub with key file {0}".format(filename))
                         break
+                    if rv == 3:
+                        # right key, but the book could not be written
+                        break
                 except Exception as e:
                     errlog += traceback.format_exc()
                     errlog += str(e)
@@ -70,6 +73,9 @@ def decryptepub(infile, outdir, rscpath):
                     if rv == 0:
                         print("Decrypted B&N ePub with key file {0}".format(filename))
                         break
+                    if rv == 3:
+                        # right key, but the book could not be written
+                        break
                 except Exception as e:
                     errlog += traceback.format_exc()
                     errlog += str(e)
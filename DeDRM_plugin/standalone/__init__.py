@@ -13,6 +13,7 @@ OPT_SHORT_TO_LONG = [
     ["f", "force"], 
     ["h", "help"], 
     ["i", "import"],
+    ["j", "jobs"],
     ["o", "output"],
     ["p", "password"],
     ["q", "quiet"],
@@ -110,7 +111,7 @@ def handle_single_argument(arg, next):
     global _additional_params
     global config_file_path
     
-    if arg in ["--username", "--password", "--output", "--outputdir"]: 
+    if arg in ["--username", "--password", "--output", "--outputdir", "--jobs", "--threads", "--summary"]: 
         used_up = 1
         _additional_params.append(arg)
         if next is None or len(next) == 0: 
@@ -129,7 +130,7 @@ def handle_single_argument(arg, next):
         config_file_path = next[0]
         used_up = 1
 
-    elif arg in ["--help", "--credits", "--verbose", "--quiet", "--extract", "--import", "--overwrite", "--force"]:
+    elif arg in ["--help", "--credits", "--verbose", "--quiet", "--extract", "--import", "--overwrite", "--force", "--no-cache", "--rebuild-cache"]:
         _additional_params.append(arg)
 
         
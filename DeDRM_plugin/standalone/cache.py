@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# CLI interface for the DeDRM plugin (useable without Calibre, too)
+# Conversion cache for remove_drm
+
+from __future__ import absolute_import, print_function
+
+# Copyright © 2021 NoDRM
+
+#@@CALIBRE_COMPAT_CODE@@
+
+import os, sys
+import hashlib
+import json
+import time
+
+# Only books that are in the cache are remembered, so this limits the
+# size of the cache file (roughly 500 bytes per book).
+DEFAULT_MAX_ENTRIES = 10000
+
+# Preferences that influence the output of remove_drm.
+_KEY_PREFS = [ "bandnkeys", "adeptkeys", "ereaderkeys", "kindlekeys", "androidkeys",
+               "pids", "serials", "adobe_pdf_passphrases", "lcp_passphrases",
+               "deobfuscate_fonts", "remove_watermarks" ]
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def keyset_fingerprint(dedrmprefs):
+    # Hash over all keys and settings, so books are converted again
+    # when the user adds a key or changes the post-processing settings.
+    sha = hashlib.sha256()
+    for name in _KEY_PREFS:
+        sha.update(json.dumps([name, dedrmprefs[name]], sort_keys=True, default=str).encode("utf-8"))
+    return sha.hexdigest()
+
+
+class ConversionCache(object):
+    # On-disk index of books remove_drm has already converted.
+    #
+    # "books" is keyed by the SHA-256 of the input file and the output file
+    # (without its extension, which depends on the book), so the same book
+    # converted to two places is two entries. They record the type from
+    # determine_file_type, the output file and the name of the key that
+    # worked. "keys" has the key that last worked for each hash, to try it
+    # first even if the book goes somewhere else this time. "files" maps
+    # input paths to their size, mtime and hash, so an unchanged input
+    # doesn't need to be hashed again.
+
+    def __init__(self, path, version, fingerprint, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.version = version
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.books = {}
+        self.keys = {}
+        self.files = {}
+        self.dirty = False
+
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            # entries from before they had the hash in them are dropped
+            self.books = dict((k, v) for (k, v) in data.get("books", {}).items() if "hash" in v)
+            self.keys = data.get("keys", {})
+            self.files = data.get("files", {})
+        except FileNotFoundError:
+            pass
+        except Exception:
+            print("Conversion cache " + path + " is damaged, starting with an empty cache.", file=sys.stderr)
+
+    def clear(self):
+        self.books = {}
+        self.keys = {}
+        self.files = {}
+        self.dirty = True
+
+    def content_hash(self, input_file):
+        st = os.stat(input_file)
+        known = self.files.get(input_file)
+        if known is not None and known["size"] == st.st_size and known["mtime"] == st.st_mtime_ns:
+            return known["hash"]
+
+        digest = hash_file(input_file)
+        self.files[input_file] = { "size": st.st_size, "mtime": st.st_mtime_ns, "hash": digest }
+        self.dirty = True
+        return digest
+
+    def book_key(self, digest, output_file):
+        return digest + ":" + os.path.splitext(output_file)[0]
+
+    def lookup(self, digest, output_file):
+        if digest is None:
+            return None
+        return self.books.get(self.book_key(digest, output_file))
+
+    def preferred_key(self, digest):
+        # The key that worked for this book the last time, wherever it
+        # was written to.
+        return self.keys.get(digest)
+
+    def is_current(self, entry):
+        # True if the book was converted with the same plugin version and
+        # keys, and the output from back then is still there.
+        if entry is None:
+            return False
+        if entry["version"] != self.version or entry["fingerprint"] != self.fingerprint:
+            return False
+        if entry["output"] is None or not os.path.isfile(entry["output"]):
+            return False
+        return True
+
+    def record(self, digest, result):
+        self.books[self.book_key(digest, result["output"])] = {
+            "hash": digest,
+            "input": result["input"],
+            "output": result["output"],
+            "type": result["type"],
+            "key": result["key"],
+            "status": result["status"],
+            "version": self.version,
+            "fingerprint": self.fingerprint,
+            "used": time.time(),
+        }
+        if result["key"] is not None:
+            self.keys[digest] = result["key"]
+        self.dirty = True
+
+    def touch(self, entry):
+        entry["used"] = time.time()
+        self.dirty = True
+
+    def evict(self):
+        # Drop the least recently used books once there's too many.
+        if len(self.books) > self.max_entries:
+            by_age = sorted(self.books.items(), key=lambda x: x[1]["used"])
+            for key, entry in by_age[:len(self.books) - self.max_entries]:
+                del self.books[key]
+            self.dirty = True
+
+        known_hashes = set(entry["hash"] for entry in self.books.values())
+        for digest in list(self.keys.keys()):
+            if digest not in known_hashes:
+                del self.keys[digest]
+                self.dirty = True
+        for path in list(self.files.keys()):
+            if self.files[path]["hash"] not in known_hashes:
+                del self.files[path]
+                self.dirty = True
+
+    def save(self):
+        self.evict()
+        if not self.dirty:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({ "books": self.books, "keys": self.keys, "files": self.files }, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
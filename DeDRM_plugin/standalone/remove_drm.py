@@ -11,6 +11,12 @@ from __future__ import absolute_import, print_function
 #@@CALIBRE_COMPAT_CODE@@
 
 import os, sys
+import codecs
+import json
+import shutil
+import tempfile
+import time
+import traceback
 
 from zipfile import ZipInfo, ZipFile, ZIP_STORED, ZIP_DEFLATED
 from contextlib import closing
@@ -26,14 +32,19 @@ def print_removedrm_help():
     print()
     print("remove_drm: Remove DRM from one or multiple files")
     print()
-    print_std_usage("remove_drm", "<filename> ... [ -o <filename> ] [ -f ]")
+    print_std_usage("remove_drm", "<filename> ... [ -o <filename> ] [ -f ] [ -j <jobs> ]")
     
     print()
     print("Options: ")
     print_opt(None, "outputdir", "Folder to export the file(s) to")
     print_opt("o", "output", "File name to export the file to")
-    print_opt("f", "force", "Overwrite output file if it already exists")
+    print_opt("f", "force", "Overwrite output file if it already exists, even if it's up to date")
     print_opt(None, "overwrite", "Replace DRMed file with DRM-free file (implies --force)")
+    print_opt("j", "jobs", "Number of files to process in parallel (default: 1)")
+    print_opt(None, "threads", "Number of threads to decrypt a single Kindle or PDF book with (default: automatic), also the number of processes to render a Topaz book with (default: 1)")
+    print_opt(None, "summary", "Write a JSON summary with the result for each file")
+    print_opt(None, "no-cache", "Convert all files, even if they haven't changed since the last run")
+    print_opt(None, "rebuild-cache", "Forget all previously converted files and convert everything again")
 
 
 def determine_file_type(file):
@@ -89,7 +100,134 @@ def determine_file_type(file):
      
 
 
-def dedrm_single_file(input_file, output_file):
+class RemoveDRMError(Exception):
+    pass
+
+
+def _prefer(candidates, keyname):
+    # Move the key that worked for this book last time to the front.
+    if keyname is None:
+        return candidates
+    return sorted(candidates, key=lambda c: c[0] != keyname)
+
+
+def _try_adept_epub(input_file, output_file, dedrmprefs, passhash, preferred_key=None):
+    import ineptepub
+    import epubpipeline
+
+    if passhash:
+        keys = list(dedrmprefs['bandnkeys'].items())
+    else:
+        keys = [(name, codecs.decode(value, 'hex')) for name, value in dedrmprefs['adeptkeys'].items()]
+    keys = _prefer(keys, preferred_key)
+
+    try:
+        keymatcher = ineptepub.BookKeyMatcher(input_file)
+    except:
+        keymatcher = None
+
+    for keyname, userkey in keys:
+        if keymatcher is not None and not keymatcher.check(userkey):
+            continue
+        print("Trying key " + keyname)
+        stages = epubpipeline.postProcessStages(dedrmprefs)
+        result = ineptepub.decryptBook(userkey, input_file, output_file, stages)
+        if result == 0:
+            return keyname
+        if result == 3:
+            # the key was right, the other ones won't do any better
+            raise RemoveDRMError("Decrypted with key " + keyname + ", but post-processing the book failed")
+
+    raise RemoveDRMError("None of the keys could decrypt this book")
+
+
+def _try_pdf(input_file, output_file, dedrmprefs, preferred_key=None, decrypt_jobs=None):
+    import ineptpdf
+
+    ineptpdf.setDecodeJobs(decrypt_jobs)
+
+    pdf_encryption = ineptpdf.getPDFencryptionType(input_file)
+    if pdf_encryption is None:
+        shutil.copyfile(input_file, output_file)
+        return None
+
+    if pdf_encryption == "EBX_HANDLER":
+        candidates = [(name, codecs.decode(value, 'hex'), True) for name, value in dedrmprefs['adeptkeys'].items()]
+        candidates += [(name, value, False) for name, value in dedrmprefs['bandnkeys'].items()]
+    elif pdf_encryption == "Standard" or pdf_encryption == "Adobe.APS":
+        passwords = [""] + dedrmprefs['adobe_pdf_passphrases']
+        candidates = [("password_{0}".format(i), bytearray(pw, "utf-8"), True) for i, pw in enumerate(passwords)]
+    else:
+        raise RemoveDRMError("Encryption '{0}' is unsupported".format(pdf_encryption))
+
+    for keyname, userkey, inept in _prefer(candidates, preferred_key):
+        print("Trying key " + keyname)
+        try:
+            if ineptpdf.decryptBook(userkey, input_file, output_file, inept) == 0:
+                return keyname
+        except ineptpdf.ADEPTNewVersionError:
+            raise RemoveDRMError("Book uses unsupported (too new) Adobe DRM")
+        except Exception:
+            pass
+
+    raise RemoveDRMError("None of the keys could decrypt this book")
+
+
+def _try_kindle(input_file, output_file, dedrmprefs, preferred_key=None, decrypt_jobs=None):
+    import k4mobidedrm
+    import mobidedrm
+    import keyaffinity
+
+    mobidedrm.setDecryptJobs(decrypt_jobs)
+    # and the number of processes to render the pages of a Topaz book with
+    import genbook
+    genbook.setRenderJobs(decrypt_jobs)
+
+    serials = list(dedrmprefs['serials'])
+    for android_serials_list in dedrmprefs['androidkeys'].values():
+        serials.extend(android_serials_list)
+    kindleDatabases = list(dedrmprefs['kindlekeys'].items())
+
+    # PIDs have no names, the key is remembered by a hash of the PID
+    # (the same one the plugin's key affinity uses).
+    def pidorder(md1, md2, pids):
+        if preferred_key is None:
+            return pids
+        return sorted(pids, key=lambda pid: keyaffinity.pidkeyid(pid) != preferred_key)
+
+    # Returns the extension for the output file, that's only known
+    # once the book is decrypted (Print Replica books become .azw4),
+    # and the key that worked.
+    book = k4mobidedrm.GetDecryptedBook(input_file, kindleDatabases, [], serials, list(dedrmprefs['pids']), time.time(), pidorder)
+    try:
+        book.getFile(output_file)
+        key = None
+        if book.pid is not None:
+            key = keyaffinity.pidkeyid(book.pid)
+        return book.getBookExtension(), key
+    finally:
+        book.cleanup()
+
+
+def _try_ereader(input_file, output_file, dedrmprefs, preferred_key=None):
+    import erdr2pml
+
+    for keyname, userkey in _prefer(list(dedrmprefs['ereaderkeys'].items()), preferred_key):
+        print("Trying key " + keyname)
+        if erdr2pml.decryptBook(input_file, output_file, True, codecs.decode(userkey, 'hex')) == 0:
+            return keyname
+
+    raise RemoveDRMError("None of the keys could decrypt this book")
+
+
+def _output_extension(ftype, input_file):
+    # Some of the back ends produce a different format than the input.
+    if ftype == "PDB":
+        return ".pmlz"
+    return os.path.splitext(input_file)[1]
+
+
+def dedrm_single_file(input_file, output_file, config_path=None, preferred_key=None, decrypt_jobs=None):
     # When this runs, all the stupid file handling is done. 
     # Just take the file at the absolute path "input_file"
     # and export it, DRM-free, to "output_file". 
@@ -99,6 +237,26 @@ def dedrm_single_file(input_file, output_file):
 
     # The output directory might not exist yet.
 
+    # Returns a dictionary with the result, so it can be
+    # passed back from a worker process and put into the summary.
+
+    # If "preferred_key" is set, that key (which worked for an earlier
+    # version of this book) is tried first. "decrypt_jobs" is the number of
+    # threads for decrypting a Kindle or PDF book (and of processes for
+    # rendering the pages of a Topaz book), None means automatic (a single
+    # process for Topaz books).
+
+    starttime = time.time()
+    result = {
+        "input": input_file,
+        "output": None,
+        "type": None,
+        "status": "failed",
+        "key": None,
+        "error": None,
+        "seconds": 0.0,
+    }
+
     print("File " + input_file + " to " + output_file)
 
     # Okay, first check the file type and don't rely on the extension. 
@@ -107,19 +265,140 @@ def dedrm_single_file(input_file, output_file):
     except: 
         print("Can't determine file type for this file.")
         ftype = None
-    
+
+    result["type"] = ftype
+
     if ftype is None: 
-        return
+        result["status"] = "unsupported"
+        result["error"] = "Unknown file type"
+        result["seconds"] = time.time() - starttime
+        return result
+
+    tmpdir = None
+    try:
+        import prefs
+        if config_path is None:
+            from standalone.__init__ import config_file_path
+            config_path = config_file_path
+        dedrmprefs = prefs.DeDRM_Prefs(os.path.abspath(config_path))
+
+        ext = _output_extension(ftype, input_file)
+
+        outdir = os.path.dirname(output_file)
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+        # Write into a temporary folder next to the output file first,
+        # then move the result into place.
+        tmpdir = tempfile.mkdtemp(dir=outdir)
+        tmp_output = os.path.join(tmpdir, "output" + ext)
+
+        key = None
+        if ftype in ["ADEPT", "ADEPT-PassHash"]:
+            key = _try_adept_epub(input_file, tmp_output, dedrmprefs, ftype == "ADEPT-PassHash", preferred_key)
+        elif ftype == "PDF":
+            key = _try_pdf(input_file, tmp_output, dedrmprefs, preferred_key, decrypt_jobs)
+        elif ftype in ["MOBI", "TPZ", "KFX-ZIP"]:
+            ext, key = _try_kindle(input_file, tmp_output, dedrmprefs, preferred_key, decrypt_jobs)
+        elif ftype == "PDB":
+            key = _try_ereader(input_file, tmp_output, dedrmprefs, preferred_key)
+        elif ftype == "LCP":
+            raise RemoveDRMError("LCP DRM removal is not supported")
+        elif ext.lower() == ".epub":
+            # DRM-free EPUB, still run the post-processing
+            import epubpipeline
+            epubpipeline.processBook(input_file, tmp_output, epubpipeline.postProcessStages(dedrmprefs))
+            result["status"] = "drm-free"
+        else:
+            shutil.copyfile(input_file, tmp_output)
+            result["status"] = "drm-free"
+
+        if os.path.splitext(output_file)[1].lower() != ext.lower():
+            output_file = os.path.splitext(output_file)[0] + ext
+        shutil.move(tmp_output, output_file)
+        result["output"] = output_file
+        result["key"] = key
+        if result["status"] == "failed":
+            result["status"] = "decrypted"
+    except Exception as e:
+        traceback.print_exc()
+        result["error"] = "{0}: {1}".format(type(e).__name__, e)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, True)
+
+    result["seconds"] = time.time() - starttime
+    print("{0} {1} after {2:.1f} seconds".format(os.path.basename(input_file), result["status"], result["seconds"]))
+    return result
+
+
+def _dedrm_worker(args):
+    # Entry point for the worker processes.
+    input_file, output_file, config_path, preferred_key, decrypt_jobs = args
+    try:
+        return dedrm_single_file(input_file, output_file, config_path, preferred_key, decrypt_jobs)
+    except Exception as e:
+        return { "input": input_file, "output": None, "type": None, "status": "failed",
+                 "key": None, "error": "{0}: {1}".format(type(e).__name__, e), "seconds": 0.0 }
+
+
+def run_batch(tasks, jobs, config_path, decrypt_jobs=None):
+    # Runs dedrm_single_file over all (input, output, preferred key) tuples in "tasks".
+    # With more than one job, the files are processed in a process pool.
+    # Only a few files per worker are queued at any time, so memory use
+    # doesn't grow with the size of the library.
+    results = []
+    tasks = [(input_file, output_file, config_path, preferred_key, decrypt_jobs) for input_file, output_file, preferred_key in tasks]
+
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            results.append(_dedrm_worker(task))
+        return results
+
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+    max_in_flight = jobs * 2
+    order = {}
+    pending = set()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        task_iter = iter(enumerate(tasks))
+        while True:
+            while len(pending) < max_in_flight:
+                try:
+                    idx, task = next(task_iter)
+                except StopIteration:
+                    break
+                future = executor.submit(_dedrm_worker, task)
+                order[future] = idx
+                pending.add(future)
+
+            if len(pending) == 0:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    res = future.result()
+                except Exception as e:
+                    task = tasks[order[future]]
+                    res = { "input": task[0], "output": None, "type": None, "status": "failed",
+                            "key": None, "error": "{0}: {1}".format(type(e).__name__, e), "seconds": 0.0 }
+                results.append((order.pop(future), res))
+
+    results.sort(key=lambda x: x[0])
+    return [res for idx, res in results]
 
-    
-    
-    
 
 def perform_action(params, files):
     output = None
     outputdir = None
     force = False
     overwrite_original = False
+    jobs = 1
+    decrypt_jobs = None
+    summary = None
+    use_cache = True
+    rebuild_cache = False
 
 
     if len(files) == 0:
@@ -137,6 +416,28 @@ def perform_action(params, files):
         elif p == "--overwrite":
             overwrite_original = True
             force = True
+        elif p == "--jobs":
+            try:
+                jobs = int(params.pop(0))
+            except ValueError:
+                print("--jobs needs a number.", file=sys.stderr)
+                return 1
+            if jobs < 1:
+                jobs = os.cpu_count() or 1
+        elif p == "--threads":
+            try:
+                decrypt_jobs = int(params.pop(0))
+            except ValueError:
+                print("--threads needs a number.", file=sys.stderr)
+                return 1
+            if decrypt_jobs < 1:
+                decrypt_jobs = None
+        elif p == "--summary":
+            summary = params.pop(0)
+        elif p == "--no-cache":
+            use_cache = False
+        elif p == "--rebuild-cache":
+            rebuild_cache = True
         elif p == "--help":
             print_removedrm_help()
             return 0
@@ -160,6 +461,22 @@ def perform_action(params, files):
         return 1
 
 
+    from standalone.__init__ import config_file_path
+    from __version import PLUGIN_VERSION
+    config_path = os.path.abspath(config_file_path)
+
+    cache = None
+    if use_cache:
+        import prefs
+        from standalone.cache import ConversionCache, keyset_fingerprint
+        cache_path = os.path.splitext(config_path)[0] + "_cache.json"
+        cache = ConversionCache(cache_path, PLUGIN_VERSION, keyset_fingerprint(prefs.DeDRM_Prefs(config_path)))
+        if rebuild_cache:
+            cache.clear()
+
+    tasks = []
+    hashes = {}
+    cached_results = []
 
     for file in files:
 
@@ -189,21 +506,68 @@ def perform_action(params, files):
                     fn, f_ext = os.path.splitext(output_filename)
                     output_filename = fn + "_nodrm" + f_ext
 
-
+        output_filename = os.path.abspath(output_filename)
+        preferred_key = None
+
+        if cache is not None:
+            try:
+                digest = cache.content_hash(file)
+            except OSError:
+                digest = None
+            entry = cache.lookup(digest, output_filename)
+            if not force and cache.is_current(entry):
+                # Already converted with the same plugin version and keys.
+                # With --force it's converted (and its output overwritten)
+                # again all the same.
+                cache.touch(entry)
+                cached_results.append({ "input": file, "output": entry["output"], "type": entry["type"],
+                                        "status": "cached", "key": entry["key"], "error": None, "seconds": 0.0 })
+                continue
+            if digest is not None:
+                preferred_key = cache.preferred_key(digest)
+            hashes[file] = digest
         
         if os.path.isfile(output_filename) and not force:
             print("Skipping file " + file + " because output file already exists (use --force).", file=sys.stderr)
             continue
 
-        
+        tasks.append((file, output_filename, preferred_key))
 
-        dedrm_single_file(file, output_filename)
 
-       
+    starttime = time.time()
+    if decrypt_jobs is None and jobs > 1:
+        # The files are already processed in parallel.
+        decrypt_jobs = 1
+    results = run_batch(tasks, jobs, config_path, decrypt_jobs)
+    totaltime = time.time() - starttime
 
+    if cache is not None:
+        for res in results:
+            digest = hashes.get(res["input"])
+            if digest is not None and res["status"] in ["decrypted", "drm-free"]:
+                cache.record(digest, res)
+        try:
+            cache.save()
+        except OSError as e:
+            print("Can't write conversion cache: " + str(e), file=sys.stderr)
 
+    if len(cached_results) > 0:
+        print("Skipped {0} unchanged file(s) that were already converted.".format(len(cached_results)))
+    results = cached_results + results
+
+    failed = [res for res in results if res["status"] not in ["decrypted", "drm-free", "cached"]]
+    print("Processed {0} file(s) in {1:.1f} seconds, {2} failed.".format(len(results), totaltime, len(failed)))
+    for res in failed:
+        print("  " + res["input"] + ": " + str(res["error"]), file=sys.stderr)
+
+    if summary is not None:
+        with open(summary, "w") as f:
+            json.dump({ "version": PLUGIN_VERSION, "jobs": jobs, "seconds": totaltime, "files": results }, f, indent=2)
+
+    if len(failed) > 0:
+        return 1
     return 0
     
 
 if __name__ == "__main__":
-    print("This code is not intended to be executed directly!", file=sys.stderr)
\ No newline at end of file
+    print("This code is not intended to be executed directly!", file=sys.stderr)
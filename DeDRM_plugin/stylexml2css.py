@@ -14,8 +14,9 @@ from struct import unpack
 debug = False
 
 class DocParser(object):
-    def __init__(self, flatxml, fontsize, ph, pw):
-        self.flatdoc = flatxml.split(b'\n')
+    def __init__(self, doc, fontsize, ph, pw):
+        # convert2xml.PageDoc of the style sheet
+        self.doc = doc
         self.fontsize = int(fontsize)
         self.ph = int(ph) * 1.0
         self.pw = int(pw) * 1.0
@@ -51,55 +52,30 @@ class DocParser(object):
     # find tag if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
         result = None
-        docList = self.flatdoc
-        cnt = len(docList)
-        if end == -1 :
-            end = cnt
-        else:
-            end = min(cnt,end)
-        foundat = -1
-        for j in range(pos, end):
-            item = docList[j]
-            if item.find(b'=') >= 0:
-                (name, argres) = item.split(b'=',1)
-            else :
-                name = item
-                argres = b''
-            if (isinstance(tagpath,str)):
-                tagpath = tagpath.encode('utf-8')
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
+        foundat = self.doc.find(tagpath, pos, end)
+        if foundat >= 0 :
+            result = self.doc.text(foundat)
         return foundat, result
 
 
     # return list of start positions for the tagpath
     def posinDoc(self, tagpath):
-        startpos = []
-        pos = 0
-        res = b""
-        while res != None :
-            (foundpos, res) = self.findinDoc(tagpath, pos, -1)
-            if res != None :
-                startpos.append(foundpos)
-            pos = foundpos + 1
-        return startpos
+        return list(self.doc.positions(tagpath))
 
     # returns a vector of integers for the tagpath
     def getData(self, tagpath, pos, end, clean=False):
-        if clean:
-            digits_only = re.compile(rb'''([0-9]+)''')
         argres=[]
-        (foundat, argt) = self.findinDoc(tagpath, pos, end)
-        if (argt != None) and (len(argt) > 0) :
-            argList = argt.split(b'|')
-            for strval in argList:
-                if clean:
-                    m = re.search(digits_only, strval)
-                    if m != None:
-                        strval = m.group()
-                argres.append(int(strval))
+        foundat = self.doc.find(tagpath, pos, end)
+        if foundat < 0 :
+            return argres
+        if not clean:
+            return self.doc.values(foundat)
+        digits_only = re.compile(rb'''([0-9]+)''')
+        for strval in self.doc.strings(foundat):
+            m = re.search(digits_only, strval)
+            if m != None:
+                strval = m.group()
+            argres.append(int(strval))
         return argres
 
     def process(self):
@@ -270,21 +246,21 @@ class DocParser(object):
 
 
 
-def convert2CSS(flatxml, fontsize, ph, pw):
+def convert2CSS(doc, fontsize, ph, pw):
 
     print('          ', 'Using font size:',fontsize)
     print('          ', 'Using page height:', ph)
     print('          ', 'Using page width:', pw)
 
     # create a document parser
-    dp = DocParser(flatxml, fontsize, ph, pw)
+    dp = DocParser(doc, fontsize, ph, pw)
     if debug: print('          ', 'Created DocParser.')
     csspage = dp.process()
     if debug: print('          ', 'Processed DocParser.')
     return csspage
 
 
-def getpageIDMap(flatxml):
-    dp = DocParser(flatxml, 0, 0, 0)
+def getpageIDMap(doc):
+    dp = DocParser(doc, 0, 0, 0)
     pageidnumbers = dp.getData('info.original.pid', 0, -1, True)
     return pageidnumbers
@@ -8,21 +8,30 @@
 #  4.9  - moved unicode_argv call inside main for Windows DeDRM compatibility
 #  5.0  - Fixed potential unicode problem with command line interface
 #  6.0  - Added Python 3 compatibility for calibre 5.0
+#  6.1  - Remember which PID decrypted the book
+#  6.2  - Keep the decrypted records in memory instead of extracting them to a
+#         temporary directory, and write the zip files straight from there
+#  6.3  - Keep the plain Python cipher as reference for the alfcrypto benchmark
+#  6.4  - Read the book through a memory map with topazreader
 
-__version__ = '6.0'
+__version__ = '6.4'
 
 import sys
 import os, csv, getopt
+import functools
 
 #@@CALIBRE_COMPAT_CODE@@
 
 
-import zlib, zipfile, tempfile, shutil
+import zlib
+import mmap
 import traceback
 from struct import pack
 from struct import unpack
 
 from alfcrypto import Topaz_Cipher
+import topazstore
+import topazreader
 
 # Wrap a stream so that output gets flushed immediately
 # and also make sure that any unicode strings get
@@ -97,47 +106,10 @@ class DrmException(Exception):
     pass
 
 
-# recursive zip creation support routine
-def zipUpDir(myzip, tdir, localname):
-    currentdir = tdir
-    if localname != "":
-        currentdir = os.path.join(currentdir,localname)
-    list = os.listdir(currentdir)
-    for file in list:
-        afilename = file
-        localfilePath = os.path.join(localname, afilename)
-        realfilePath = os.path.join(currentdir,file)
-        if os.path.isfile(realfilePath):
-            myzip.write(realfilePath, localfilePath)
-        elif os.path.isdir(realfilePath):
-            zipUpDir(myzip, tdir, localfilePath)
-
 #
 # Utility routines
 #
 
-# Get a 7 bit encoded number from file
-def bookReadEncodedNumber(fo):
-    flag = False
-    data = ord(fo.read(1))
-    if data == 0xFF:
-        flag = True
-        data = ord(fo.read(1))
-    if data >= 0x80:
-        datax = (data & 0x7F)
-        while data >= 0x80 :
-            data = ord(fo.read(1))
-            datax = (datax <<7) + (data & 0x7F)
-        data = datax
-    if flag:
-        data = -data
-    return data
-
-# Get a length prefixed string from file
-def bookReadString(fo):
-    stringLength = bookReadEncodedNumber(fo)
-    return unpack(str(stringLength)+'s',fo.read(stringLength))[0]
-
 #
 # crypto routines
 #
@@ -146,26 +118,30 @@ def bookReadString(fo):
 def topazCryptoInit(key):
     return Topaz_Cipher().ctx_init(key)
 
-#     ctx1 = 0x0CAFFE19E
-#     for keyChar in key:
-#         keyByte = ord(keyChar)
-#         ctx2 = ctx1
-#         ctx1 = ((((ctx1 >>2) * (ctx1 >>7))&0xFFFFFFFF) ^ (keyByte * keyByte * 0x0F902007)& 0xFFFFFFFF )
-#     return [ctx1,ctx2]
-
 # decrypt data with the context prepared by topazCryptoInit()
 def topazCryptoDecrypt(data, ctx):
     return Topaz_Cipher().decrypt(data, ctx)
-#     ctx1 = ctx[0]
-#     ctx2 = ctx[1]
-#     plainText = ""
-#     for dataChar in data:
-#         dataByte = ord(dataChar)
-#         m = (dataByte ^ ((ctx1 >> 3) &0xFF) ^ ((ctx2<<3) & 0xFF)) &0xFF
-#         ctx2 = ctx1
-#         ctx1 = (((ctx1 >> 2) * (ctx1 >> 7)) &0xFFFFFFFF) ^((m * m * 0x0F902007) &0xFFFFFFFF)
-#         plainText += chr(m)
-#     return plainText
+
+# Straightforward implementation of the cipher, much slower than the
+# library or the table driven one in alfcrypto but easier to follow.
+def topazCryptoInitReference(key):
+    ctx1 = 0x0CAFFE19E
+    for keyByte in key:
+        ctx2 = ctx1
+        ctx1 = ((((ctx1 >>2) * (ctx1 >>7))&0xFFFFFFFF) ^ (keyByte * keyByte * 0x0F902007)& 0xFFFFFFFF )
+    return [ctx1,ctx2]
+
+def topazCryptoDecryptReference(data, ctx):
+    ctx1 = ctx[0]
+    ctx2 = ctx[1]
+    plainText = bytearray(len(data))
+    for i in range(len(data)):
+        dataByte = data[i]
+        m = (dataByte ^ ((ctx1 >> 3) &0xFF) ^ ((ctx2<<3) & 0xFF)) &0xFF
+        ctx2 = ctx1
+        ctx1 = (((ctx1 >> 2) * (ctx1 >> 7)) &0xFFFFFFFF) ^((m * m * 0x0F902007) &0xFFFFFFFF)
+        plainText[i] = m
+    return bytes(plainText)
 
 # Decrypt data with the PID
 def decryptRecord(data,PID):
@@ -207,13 +183,20 @@ def decryptDkeyRecords(data,PID):
 class TopazBook:
     def __init__(self, filename):
         self.fo = open(filename, 'rb')
-        self.outdir = tempfile.mkdtemp()
-        # self.outdir = 'rawdat'
+        try:
+            self.data_map = mmap.mmap(self.fo.fileno(), 0, access=mmap.ACCESS_READ)
+            self.reader = topazreader.TopazReader(self.data_map)
+        except (ValueError, OSError):
+            # empty file, or no mmap support for this file
+            self.data_map = None
+            self.reader = topazreader.TopazReader(self.fo.read())
+        self.store = None
+        self.pid = None
         self.bookPayloadOffset = 0
         self.bookHeaderRecords = {}
         self.bookMetadata = {}
         self.bookKey = None
-        magic = unpack('4s',self.fo.read(4))[0]
+        magic = unpack('4s',self.reader.read(4))[0]
         if magic != b'TPZ0':
             raise DrmException("Parse Error : Invalid Header, not a Topaz file")
         self.parseTopazHeaders()
@@ -223,42 +206,42 @@ class TopazBook:
         def bookReadHeaderRecordData():
             # Read and return the data of one header record at the current book file position
             # [[offset,decompressedLength,compressedLength],...]
-            nbValues = bookReadEncodedNumber(self.fo)
+            nbValues = self.reader.readNumber()
             if debug: print("%d records in header " % nbValues, end=' ')
             values = []
             for i in range (0,nbValues):
-                values.append([bookReadEncodedNumber(self.fo),bookReadEncodedNumber(self.fo),bookReadEncodedNumber(self.fo)])
+                values.append([self.reader.readNumber(),self.reader.readNumber(),self.reader.readNumber()])
             return values
         def parseTopazHeaderRecord():
             # Read and parse one header record at the current book file position and return the associated data
             # [[offset,decompressedLength,compressedLength],...]
-            if ord(self.fo.read(1)) != 0x63:
+            if ord(self.reader.read(1)) != 0x63:
                 raise DrmException("Parse Error : Invalid Header")
-            tag = bookReadString(self.fo)
+            tag = self.reader.readString()
             record = bookReadHeaderRecordData()
             return [tag,record]
-        nbRecords = bookReadEncodedNumber(self.fo)
+        nbRecords = self.reader.readNumber()
         if debug: print("Headers: %d" % nbRecords)
         for i in range (0,nbRecords):
             result = parseTopazHeaderRecord()
             if debug: print(result[0], ": ", result[1])
             self.bookHeaderRecords[result[0]] = result[1]
-        if ord(self.fo.read(1))  != 0x64 :
+        if ord(self.reader.read(1))  != 0x64 :
             raise DrmException("Parse Error : Invalid Header")
-        self.bookPayloadOffset = self.fo.tell()
+        self.bookPayloadOffset = self.reader.tell()
 
     def parseMetadata(self):
         # Parse the metadata record from the book payload and return a list of [key,values]
-        self.fo.seek(self.bookPayloadOffset + self.bookHeaderRecords[b'metadata'][0][0])
-        tag = bookReadString(self.fo)
+        self.reader.seek(self.bookPayloadOffset + self.bookHeaderRecords[b'metadata'][0][0])
+        tag = self.reader.readString()
         if tag != b'metadata' :
             raise DrmException("Parse Error : Record Names Don't Match")
-        flags = ord(self.fo.read(1))
-        nbRecords = ord(self.fo.read(1))
+        flags = ord(self.reader.read(1))
+        nbRecords = ord(self.reader.read(1))
         if debug: print("Metadata Records: %d" % nbRecords)
         for i in range (0,nbRecords) :
-            keyval = bookReadString(self.fo)
-            content = bookReadString(self.fo)
+            keyval = self.reader.readString()
+            content = self.reader.readString()
             if debug: print(keyval)
             if debug: print(content)
             self.bookMetadata[keyval] = content
@@ -292,13 +275,13 @@ class TopazBook:
         except:
             raise DrmException("Parse Error : Invalid Record, record not found")
 
-        self.fo.seek(self.bookPayloadOffset + recordOffset)
+        self.reader.seek(self.bookPayloadOffset + recordOffset)
 
-        tag = bookReadString(self.fo)
+        tag = self.reader.readString()
         if tag != name :
             raise DrmException("Parse Error : Invalid Record, record name doesn't match")
 
-        recordIndex = bookReadEncodedNumber(self.fo)
+        recordIndex = self.reader.readNumber()
         if recordIndex < 0 :
             encrypted = True
             recordIndex = -recordIndex -1
@@ -308,9 +291,9 @@ class TopazBook:
 
         if (self.bookHeaderRecords[name][index][2] > 0):
             compressed = True
-            record = self.fo.read(self.bookHeaderRecords[name][index][2])
+            record = self.reader.read(self.bookHeaderRecords[name][index][2])
         else:
-            record = self.fo.read(self.bookHeaderRecords[name][index][1])
+            record = self.reader.read(self.bookHeaderRecords[name][index][1])
 
         if encrypted:
             if self.bookKey:
@@ -334,12 +317,12 @@ class TopazBook:
         except DrmException as e:
             print("no dkey record found, book may not be encrypted")
             print("attempting to extract files without a book key")
-            self.createBookDirectory()
+            self.createBookStore()
             self.extractFiles()
             print("Successfully Extracted Topaz contents")
             import genbook
 
-            rv = genbook.generateBook(self.outdir, raw, fixedimage)
+            rv = genbook.generateBook(self.store, raw, fixedimage)
             if rv == 0:
                 print("Book Successfully generated.")
             return rv
@@ -360,6 +343,7 @@ class TopazBook:
                 pass
             else:
                 bookKey = bookKeys[0]
+                self.pid = pid.decode('latin-1')
                 print("Book Key Found! ({0})".format(bookKey.hex()))
                 break
 
@@ -367,72 +351,65 @@ class TopazBook:
             raise DrmException("No key found in {0:d} keys tried. Read the FAQs at noDRM's repository: https://github.com/noDRM/DeDRM_tools/blob/master/FAQs.md".format(len(pidlst)))
 
         self.setBookKey(bookKey)
-        self.createBookDirectory()
+        self.createBookStore()
         self.extractFiles()
         print("Successfully Extracted Topaz contents")
         import genbook
 
-        rv = genbook.generateBook(self.outdir, raw, fixedimage)
+        rv = genbook.generateBook(self.store, raw, fixedimage)
         if rv == 0:
             print("Book Successfully generated")
         return rv
 
-    def createBookDirectory(self):
-        outdir = self.outdir
-        # create output directory structure
-        if not os.path.exists(outdir):
-            os.makedirs(outdir)
-        destdir =  os.path.join(outdir,"img")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,"color_img")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,"page")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,"glyphs")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
+    def createBookStore(self):
+        if self.store is not None:
+            self.store.close()
+        self.store = topazstore.TopazRecordStore()
+        for folder in ("img", "color_img", "page", "glyphs"):
+            self.store.makedirs(folder)
+
+    def getRecordData(self, name, index):
+        record = self.getBookPayloadRecord(name, index)
+        if isinstance(record, str):
+            record = bytes(record, 'latin-1')
+        return bytes(record)
 
     def extractFiles(self):
-        outdir = self.outdir
+        # Only tells the store where to find each record, they are
+        # decrypted when genbook (or the zip file) needs them.
+        store = self.store
         for headerRecord in self.bookHeaderRecords:
             name = headerRecord
             if name != b'dkey':
                 ext = ".dat"
                 if name == b'img': ext = ".jpg"
                 if name == b'color' : ext = ".jpg"
-                print("Processing Section: {0}\n. . .".format(name.decode('utf-8')), end=' ')
-                for index in range (0,len(self.bookHeaderRecords[name])) :
+                destdir = ""
+                if name == b'img':
+                    destdir = "img/"
+                if name == b'color':
+                    destdir = "color_img/"
+                if name == b'page':
+                    destdir = "page/"
+                if name == b'glyphs':
+                    destdir = "glyphs/"
+                records = self.bookHeaderRecords[name]
+                print("Processing Section: {0}, {1:d} records".format(name.decode('utf-8'), len(records)))
+                for index in range (0,len(records)) :
+                    # empty records never got extracted
+                    if records[index][1] == 0 and records[index][2] == 0:
+                        continue
                     fname = "{0}{1:04d}{2}".format(name.decode('utf-8'),index,ext)
-                    destdir = outdir
-                    if name == b'img':
-                        destdir =  os.path.join(outdir,"img")
-                    if name == b'color':
-                        destdir =  os.path.join(outdir,"color_img")
-                    if name == b'page':
-                        destdir =  os.path.join(outdir,"page")
-                    if name == b'glyphs':
-                        destdir =  os.path.join(outdir,"glyphs")
-                    outputFile = os.path.join(destdir,fname)
-                    print(".", end=' ')
-                    record = self.getBookPayloadRecord(name,index)
-                    if isinstance(record, str):
-                        record=bytes(record, 'latin-1')
-                    if record != b'':
-                        open(outputFile, 'wb').write(record)
-                print(" ")
+                    store.add(destdir + fname, functools.partial(self.getRecordData, name, index))
 
     def getFile(self, zipname):
-        htmlzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
-        htmlzip.write(os.path.join(self.outdir,"book.html"),"book.html")
-        htmlzip.write(os.path.join(self.outdir,"book.opf"),"book.opf")
-        if os.path.isfile(os.path.join(self.outdir,"cover.jpg")):
-            htmlzip.write(os.path.join(self.outdir,"cover.jpg"),"cover.jpg")
-        htmlzip.write(os.path.join(self.outdir,"style.css"),"style.css")
-        zipUpDir(htmlzip, self.outdir, "img")
-        htmlzip.close()
+        store = self.store
+        paths = ["book.html", "book.opf"]
+        if store.exists("cover.jpg"):
+            paths.append("cover.jpg")
+        paths.append("style.css")
+        paths.extend(store.walk("img"))
+        store.writeZip(zipname, paths)
 
     def getBookType(self):
         return "Topaz"
@@ -441,15 +418,20 @@ class TopazBook:
         return ".htmlz"
 
     def getSVGZip(self, zipname):
-        svgzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
-        svgzip.write(os.path.join(self.outdir,"index_svg.xhtml"),"index_svg.xhtml")
-        zipUpDir(svgzip, self.outdir, "svg")
-        zipUpDir(svgzip, self.outdir, "img")
-        svgzip.close()
+        store = self.store
+        paths = ["index_svg.xhtml"] + store.walk("svg") + store.walk("img")
+        store.writeZip(zipname, paths)
 
     def cleanup(self):
-        if os.path.isdir(self.outdir):
-            shutil.rmtree(self.outdir, True)
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        if self.reader is not None:
+            self.reader = None
+            if self.data_map is not None:
+                self.data_map.close()
+                self.data_map = None
+            self.fo.close()
 
 def usage(progname):
     print("Removes DRM protection from Topaz ebooks and extracts the contents")
@@ -520,7 +502,7 @@ def cli_main():
         zipname = os.path.join(outdir, bookname + "_SVG.zip")
         tb.getSVGZip(zipname)
 
-        # removing internal temporary directory of pieces
+        # removing the decrypted records
         tb.cleanup()
 
     except DrmException as e:
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# topazreader.py
+
+# Released under the terms of the GNU General Public Licence, version 3
+# <http://www.gnu.org/licenses/>
+
+# Revision history:
+#   1.0 - Initial version
+
+"""
+Reads the numbers and strings Topaz books and their records are made of
+"""
+
+import io
+import sys
+import itertools
+from array import array
+
+# Every number ends with its only byte below 0x80. Numbers with more
+# than one byte before that one (above 16383 or below -127) are rare
+# enough to be decoded one by one.
+_HIGH_BYTES = bytes(range(0x80, 0x100))
+_LOW_MASK = bytes([1] * 0x80 + [0] * 0x80)
+
+
+class NumberTable(dict):
+    # encoded number -> value, for the long numbers (dictionary indexes
+    # come up again and again)
+    def __missing__(self, key):
+        value = TopazReader(key).readNumber()
+        if len(key) <= 3:
+            self[key] = value
+        return value
+
+_long_numbers = NumberTable()
+
+# for the numbers of two bytes: the first byte without its high bit, in
+# two parts, one for the high byte of the value and one for bit 7 of the
+# low byte
+_HIGH_PART = bytes([0] * 0x80 + [(c & 0x7F) >> 1 for c in range(0x80, 0x100)])
+_BIT7_PART = bytes([0] * 0x80 + [(c & 1) << 7 for c in range(0x80, 0x100)])
+
+def decodeShortNumbers(data):
+    # All numbers in data, none of them longer than two bytes.
+    # Each byte below 0x80 ends a number; we pick those and the bytes
+    # in front of them, and put together the 16 bit values with bytes
+    # operations only, no Python code per number.
+    last = data.translate(None, _HIGH_BYTES)
+    if len(last) == len(data):
+        return list(data)
+    first = bytes(itertools.compress(b'\x00' + data, data.translate(_LOW_MASK)))
+    count = len(last)
+    # adding the numbers can't carry from one byte to the next
+    low = (int.from_bytes(last, 'big') + int.from_bytes(first.translate(_BIT7_PART), 'big')).to_bytes(count, 'big')
+    values = bytearray(2 * count)
+    values[0::2] = first.translate(_HIGH_PART)
+    values[1::2] = low
+    result = array('H')
+    result.frombytes(values)
+    if sys.byteorder == 'little':
+        result.byteswap()
+    result = result.tolist()
+    # negative numbers start with 0xFF
+    i = first.find(b'\xff')
+    while i >= 0:
+        result[i] = -last[i]
+        i = first.find(b'\xff', i + 1)
+    return result
+
+
+class TopazReader(object):
+    # Topaz files are sequences of 7 bit encoded numbers: the most
+    # significant group comes first, every byte but the last one has the
+    # high bit set, and negative numbers start with an extra 0xFF byte.
+    # Strings are a number (the length) followed by the bytes.
+    #
+    # The data can be bytes, a memoryview or an mmap; the reader only
+    # keeps a position into it, like a file.
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.size = len(data)
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.size
+        self.pos = max(0, pos)
+        return self.pos
+
+    def atEnd(self):
+        return self.pos >= self.size
+
+    def read(self, count=-1):
+        start = self.pos
+        if count < 0:
+            end = self.size
+        else:
+            end = min(self.size, start + count)
+        self.pos = max(start, end)
+        return bytes(self.data[start:end])
+
+    # the byte aheadi - 1 bytes after the current position, or None
+    def peek(self, aheadi=1):
+        pos = self.pos + aheadi - 1
+        if pos >= self.size:
+            return None
+        return self.data[pos]
+
+    # next number, or None if the data ends before it does
+    def readNumber(self):
+        data = self.data
+        size = self.size
+        pos = self.pos
+        if pos >= size:
+            return None
+        c = data[pos]
+        pos += 1
+        if c < 0x80:
+            self.pos = pos
+            return c
+        negative = False
+        if c == 0xFF:
+            if pos >= size:
+                self.pos = pos
+                return None
+            negative = True
+            c = data[pos]
+            pos += 1
+        if c >= 0x80:
+            value = c & 0x7F
+            while c >= 0x80:
+                if pos >= size:
+                    self.pos = pos
+                    return None
+                c = data[pos]
+                pos += 1
+                value = (value << 7) + (c & 0x7F)
+            c = value
+        self.pos = pos
+        if negative:
+            return -c
+        return c
+
+    # the next count numbers as a list
+    def readNumbers(self, count):
+        if count <= 0:
+            return []
+        data = self.data
+        size = self.size
+        pos = self.pos
+
+        # find the end, by counting bytes below 0x80
+        found = 0
+        start = pos
+        end = pos + count
+        while True:
+            end = min(end, size)
+            found += len(bytes(data[start:end]).translate(None, _HIGH_BYTES))
+            if found == count:
+                break
+            if end >= size:
+                self.pos = size
+                raise ValueError("Topaz data ends in the middle of a list of %d numbers" % count)
+            start = end
+            end += count - found
+        while data[end - 1] >= 0x80:
+            end -= 1
+        self.pos = end
+
+        numbers = bytes(data[pos:end])
+        # two high bytes in a row start a long number
+        mask = numbers.translate(_LOW_MASK)
+        start = mask.find(b'\x00\x00')
+        if start < 0:
+            return decodeShortNumbers(numbers)
+        if mask.count(b'\x00\x00') * 16 > count:
+            # too many long ones for the bulk decoding to pay off
+            reader = TopazReader(numbers)
+            return [reader.readNumber() for i in range(count)]
+        result = []
+        last = 0
+        while start >= 0:
+            if start > last:
+                result.extend(decodeShortNumbers(numbers[last:start]))
+            last = mask.find(b'\x01', start) + 1
+            result.append(_long_numbers[numbers[start:last]])
+            start = mask.find(b'\x00\x00', last)
+        if last < len(numbers):
+            result.extend(decodeShortNumbers(numbers[last:]))
+        return result
+
+    # The numbers of a 0x76 loop command, cnt numbers stored in one of
+    # several ways: with bit 0 of mode set they are stored minus an offset
+    # that comes first, and the rest of mode is how many times the list
+    # was replaced by the differences between neighbours before storing.
+    def readVector(self, cnt, mode):
+        adj = 0
+        if mode & 1:
+            adj = self.readNumber()
+        x = self.readNumbers(cnt)
+        if adj:
+            x = [v - adj for v in x]
+        for i in range(mode >> 1):
+            x = list(itertools.accumulate(x))
+        return x
+
+    # next length prefixed string, or None if there is no length
+    def readString(self):
+        length = self.readNumber()
+        if length is None:
+            return None
+        start = self.pos
+        self.pos = min(self.size, start + length)
+        return bytes(self.data[start:start + length])
+
+
+# Straightforward version reading one byte at a time from a file, the
+# way the Topaz tools used to. Only kept for the benchmark.
+def readEncodedNumberReference(file):
+    flag = False
+    c = file.read(1)
+    if (len(c) == 0):
+        return None
+    data = ord(c)
+    if data == 0xFF:
+        flag = True
+        c = file.read(1)
+        if (len(c) == 0):
+            return None
+        data = ord(c)
+    if data >= 0x80:
+        datax = (data & 0x7F)
+        while data >= 0x80 :
+            c = file.read(1)
+            if (len(c) == 0):
+                return None
+            data = ord(c)
+            datax = (datax <<7) + (data & 0x7F)
+        data = datax
+    if flag:
+        data = -data
+    return data
+
+
+def encodeNumber(number):
+    # bytes for one number, as readNumber expects them
+    negative = number < 0
+    if negative:
+        number = -number
+    result = [number & 0x7F]
+    number >>= 7
+    while number:
+        result.append((number & 0x7F) | 0x80)
+        number >>= 7
+    if negative:
+        result.append(0xFF)
+    elif result[-1] == 0xFF:
+        # a positive number must not start with the negative marker
+        result.append(0x80)
+    return bytes(reversed(result))
+
+
+def benchmark(pages=20, words=4000, seed=1):
+    # Decodes synthetic page records, tokens with a few scalar arguments
+    # and the vectors a page is mostly made of (glyph positions and ids,
+    # first glyph of each word), both the old way (a file, one byte per
+    # read, peeking with read and seek, summing up the differences in a
+    # loop) and with TopazReader, and checks both get the same numbers.
+    import random
+    import time
+
+    def vector(values, mode):
+        adj = 0
+        if mode & 1:
+            adj = min(values) - 1
+        values = [v - adj for v in values]
+        for i in range(mode >> 1):
+            values = [values[0]] + [values[j] - values[j - 1] for j in range(1, len(values))]
+        head = b'\x76' + encodeNumber(len(values)) + encodeNumber(mode)
+        if mode & 1:
+            head += encodeNumber(adj)
+        return head + b''.join([encodeNumber(v) for v in values])
+
+    rnd = random.Random(seed)
+    records = []
+    for p in range(pages):
+        body = bytearray()
+        for t in range(words // 10):
+            for value in (rnd.randrange(1, 300), rnd.randrange(-5000, 5000), rnd.randrange(0, 100)):
+                if value != 0x76:
+                    body += encodeNumber(value)
+        glyphs = words * 5
+        x = 0
+        xs = []
+        for i in range(glyphs):
+            x = (x + rnd.randrange(40, 120)) % 8000
+            xs.append(x)
+        body += vector(xs, 3)
+        body += vector(sorted(rnd.randrange(0, 11000) for i in range(glyphs)), 2)
+        body += vector([rnd.randrange(0, 400) for i in range(glyphs)], 0)
+        body += vector(sorted(rnd.sample(range(glyphs), words)), 2)
+        records.append(bytes(body))
+
+    def old(record):
+        fo = io.BytesIO(record)
+        result = []
+        while True:
+            c = fo.read(1)
+            if len(c) == 0:
+                break
+            fo.seek(-1, 1)
+            if c[0] == 0x76:
+                fo.read(1)
+                cnt = readEncodedNumberReference(fo)
+                mode = readEncodedNumberReference(fo)
+                adj = 0
+                if mode & 1:
+                    adj = readEncodedNumberReference(fo)
+                mode = mode >> 1
+                x = []
+                for i in range(cnt):
+                    x.append(readEncodedNumberReference(fo) - adj)
+                for i in range(mode):
+                    for j in range(1, cnt):
+                        x[j] = x[j] + x[j - 1]
+                result.extend(x)
+            else:
+                result.append(readEncodedNumberReference(fo))
+        return result
+
+    def new(record):
+        reader = TopazReader(record)
+        result = []
+        while True:
+            c = reader.peek(1)
+            if c is None:
+                break
+            if c == 0x76:
+                reader.read(1)
+                cnt = reader.readNumber()
+                mode = reader.readNumber()
+                result.extend(reader.readVector(cnt, mode))
+            else:
+                result.append(reader.readNumber())
+        return result
+
+    size = sum(len(record) for record in records)
+    expected = None
+    times = []
+    for name, func in (("file, one byte per read", old), ("TopazReader", new)):
+        start = time.time()
+        result = [func(record) for record in records]
+        elapsed = time.time() - start
+        times.append(elapsed)
+        if expected is None:
+            expected = result
+        status = "ok" if result == expected else "MISMATCH"
+        print("{0:<24s} {1:8.3f} s  {2:8.2f} MB/s  {3}".format(name, elapsed, size / max(elapsed, 1e-9) / 1e6, status))
+    print("speedup: {0:.1f}x".format(times[0] / max(times[1], 1e-9)))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# topazstore.py
+
+# Released under the terms of the GNU General Public Licence, version 3
+# <http://www.gnu.org/licenses/>
+
+# Revision history:
+#   1.0 - Initial version
+#   1.1 - Keep records once they are loaded for the output zips or a copy,
+#         images are in both zips and were decrypted for each of them
+
+"""
+Holds the records of a Topaz book and the files genbook creates from them
+"""
+
+import os
+import io
+import shutil
+import tempfile
+import zipfile
+
+# Files are kept in memory until they add up to this many bytes,
+# everything after that goes into a single temporary file.
+MEMORY_LIMIT = 64 * 1024 * 1024
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class TopazStore(object):
+    # Base class for the places genbook reads the book records from and
+    # writes its output to. Files are named by their path relative to the
+    # book directory, always with forward slashes ("page/page0000.dat",
+    # "svg/toc.xhtml"). Text is written as UTF-8.
+    #
+    # The stores define exists, listdir, read and write, the methods here
+    # are built on those.
+
+    def makedirs(self, folder):
+        pass
+
+    def open(self, path):
+        return io.BytesIO(self.read(path))
+
+    def copy(self, src, dst):
+        self.write(dst, self.read(src))
+
+    def chunks(self, path):
+        # The file contents in pieces, for writing it to a zip file.
+        yield self.read(path)
+
+    def walk(self, folder):
+        # All files below folder, sorted, as paths relative to the book.
+        result = []
+        for name in sorted(self.listdir(folder)):
+            path = folder + '/' + name
+            if self.isdir(path):
+                result.extend(self.walk(path))
+            else:
+                result.append(path)
+        return result
+
+    def isdir(self, path):
+        return False
+
+    def writeZip(self, zipname, paths):
+        outzip = zipfile.ZipFile(zipname, 'w', zipfile.ZIP_DEFLATED, False)
+        try:
+            for path in paths:
+                with outzip.open(path, 'w') as out:
+                    for chunk in self.chunks(path):
+                        out.write(chunk)
+        finally:
+            outzip.close()
+
+    def close(self):
+        pass
+
+
+class TopazDirStore(TopazStore):
+    # The unpacked book as a directory tree, the way the old command line
+    # tools left it.
+
+    def __init__(self, bookDir):
+        self.bookDir = bookDir
+
+    def _path(self, path):
+        return os.path.join(self.bookDir, *path.split('/'))
+
+    def exists(self, path):
+        return os.path.exists(self._path(path))
+
+    def isdir(self, path):
+        return os.path.isdir(self._path(path))
+
+    def listdir(self, folder):
+        return os.listdir(self._path(folder))
+
+    def read(self, path):
+        with open(self._path(path), 'rb') as f:
+            return f.read()
+
+    def open(self, path):
+        return open(self._path(path), 'rb')
+
+    def write(self, path, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        fname = self._path(path)
+        dirname = os.path.dirname(fname)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(fname, 'wb') as f:
+            f.write(data)
+
+    def makedirs(self, folder):
+        if not self.exists(folder):
+            os.makedirs(self._path(folder))
+
+    def copy(self, src, dst):
+        shutil.copyfile(self._path(src), self._path(dst))
+
+    def chunks(self, path):
+        with open(self._path(path), 'rb') as f:
+            while True:
+                chunk = f.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+
+class TopazRecordStore(TopazStore):
+    # Keeps everything in memory (or in one temporary file once there's
+    # too much of it) instead of thousands of small files.
+    #
+    # Book records are added with a loader function and only decrypted
+    # when somebody reads them (or they go into an output zip), after that
+    # they are kept like any other file, so each one is decrypted once.
+
+    def __init__(self, memory_limit=None):
+        if memory_limit is None:
+            memory_limit = MEMORY_LIMIT
+        self.memory_limit = memory_limit
+        self.memory = 0
+        # path -> function returning the file data, for records not read yet
+        self.sources = {}
+        # path -> bytes, or (offset, length) in the spill file
+        self.files = {}
+        # paths whose bytes are another file's (copies), not counted in memory
+        self.copies = set()
+        self.folders = set([''])
+        self.spill = None
+
+    def _addpath(self, path):
+        folder = path.rpartition('/')[0]
+        while folder not in self.folders:
+            self.folders.add(folder)
+            folder = folder.rpartition('/')[0]
+
+    def add(self, path, loader):
+        self._addpath(path)
+        self.sources[path] = loader
+
+    def makedirs(self, folder):
+        self._addpath(folder + '/')
+
+    def exists(self, path):
+        return path in self.files or path in self.sources or path in self.folders
+
+    def isdir(self, path):
+        return path in self.folders
+
+    def listdir(self, folder):
+        prefix = folder + '/' if folder else ''
+        names = set()
+        for paths in (self.files, self.sources, self.folders):
+            for path in paths:
+                if path.startswith(prefix) and path != folder:
+                    names.add(path[len(prefix):].partition('/')[0])
+        return list(names)
+
+    def _drop(self, path):
+        # forgets the data of path, and the memory it was counted for
+        self.sources.pop(path, None)
+        old = self.files.pop(path, None)
+        if path in self.copies:
+            self.copies.discard(path)
+        elif isinstance(old, bytes):
+            self.memory -= len(old)
+
+    def _store(self, path, data):
+        self._addpath(path)
+        self._drop(path)
+        if self.memory + len(data) <= self.memory_limit:
+            self.files[path] = data
+            self.memory += len(data)
+            return
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile()
+        self.spill.seek(0, 2)
+        self.files[path] = (self.spill.tell(), len(data))
+        self.spill.write(data)
+
+    def write(self, path, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._store(path, bytes(data))
+
+    def read(self, path):
+        entry = self.files.get(path)
+        if entry is None:
+            if path not in self.sources:
+                raise IOError("No such file in Topaz book: " + path)
+            data = self.sources[path]()
+            self._store(path, data)
+            return data
+        if isinstance(entry, bytes):
+            return entry
+        offset, length = entry
+        self.spill.seek(offset)
+        return self.spill.read(length)
+
+    def copy(self, src, dst):
+        # both share the data, loaded once
+        if src not in self.files:
+            self.read(src)
+        if src == dst:
+            return
+        entry = self.files[src]
+        self._addpath(dst)
+        self._drop(dst)
+        self.files[dst] = entry
+        if isinstance(entry, bytes):
+            self.copies.add(dst)
+
+    def chunks(self, path):
+        entry = self.files.get(path)
+        if entry is None:
+            yield self.read(path)
+        elif isinstance(entry, bytes):
+            yield entry
+        else:
+            offset, length = entry
+            while length > 0:
+                self.spill.seek(offset)
+                chunk = self.spill.read(min(length, COPY_CHUNK_SIZE))
+                offset += len(chunk)
+                length -= len(chunk)
+                yield chunk
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        self.files = {}
+        self.copies = set()
+        self.sources = {}
+        self.memory = 0
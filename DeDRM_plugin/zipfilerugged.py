@@ -896,6 +896,50 @@ class ZipFile:
 
         return  ZipExtFile(zef_file, mode, zinfo, zd)
 
+    def readraw(self, name):
+        """Return the raw (still compressed) bytes for 'name'."""
+        if not self.fp:
+            raise RuntimeError(
+                  "Attempt to read ZIP archive that was already closed")
+
+        if isinstance(name, ZipInfo):
+            zinfo = name
+        else:
+            zinfo = self.getinfo(name)
+
+        if zinfo.flag_bits & 0x1:
+            raise RuntimeError("File %s is encrypted" % name)
+
+        if self._filePassed:
+            zef_file = self.fp
+        else:
+            zef_file = open(self.filename, 'rb')
+
+        try:
+            zef_file.seek(zinfo.header_offset, 0)
+
+            fheader = zef_file.read(sizeFileHeader)
+            if fheader[0:4] != stringFileHeader:
+                raise BadZipfile("Bad magic number for file header")
+
+            fheader = struct.unpack(structFileHeader, fheader)
+            fname = zef_file.read(fheader[_FH_FILENAME_LENGTH])
+            if fheader[_FH_EXTRA_FIELD_LENGTH]:
+                zef_file.read(fheader[_FH_EXTRA_FIELD_LENGTH])
+
+            if fname != zinfo.orig_filename:
+                raise BadZipfile(
+                          'File name in directory "%s" and header "%s" differ.' % (
+                              zinfo.orig_filename, fname))
+
+            bytes = zef_file.read(zinfo.compress_size)
+            if len(bytes) != zinfo.compress_size:
+                raise BadZipfile("Truncated file data for %s" % name)
+            return bytes
+        finally:
+            if not self._filePassed:
+                zef_file.close()
+
     def extract(self, member, path=None, pwd=None):
         """Extract a member from the archive to the current working directory,
            using its full name. Its file information is extracted as accurately
@@ -1106,6 +1150,45 @@ class ZipFile:
         self.filelist.append(zinfo)
         self.NameToInfo[zinfo.filename] = zinfo
 
+    def writeraw(self, zinfo, bytes):
+        """Write a file into the archive without recompressing it. 'bytes'
+        must already be compressed with zinfo.compress_type, and zinfo.CRC
+        and zinfo.file_size must describe the uncompressed data. This is
+        used to copy unchanged members from one archive to another."""
+        if not self.fp:
+            raise RuntimeError(
+                  "Attempt to write to ZIP archive that was already closed")
+
+        zinfo.flag_bits &= ~0x08                # Sizes go into the header
+        zinfo.compress_size = len(bytes)
+        zinfo.header_offset = self.fp.tell()    # Start of header bytes
+        self._writecheck(zinfo)
+        self._didModify = True
+        self.fp.write(zinfo.FileHeader())
+        self.fp.write(bytes)
+        self.fp.flush()
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+    def copyraw(self, srczip, name, zinfo=None):
+        """Copy member 'name' of the ZipFile 'srczip' into this archive
+        without decompressing it. 'zinfo' can be used to change the
+        name and attributes, the sizes and CRC are taken from the source."""
+        srcinfo = name if isinstance(name, ZipInfo) else srczip.getinfo(name)
+        bytes = srczip.readraw(srcinfo)
+        if zinfo is None:
+            zinfo = ZipInfo(srcinfo.filename, srcinfo.date_time)
+            zinfo.comment = srcinfo.comment
+            zinfo.extra = srcinfo.extra
+            zinfo.internal_attr = srcinfo.internal_attr
+            zinfo.external_attr = srcinfo.external_attr
+            zinfo.create_system = srcinfo.create_system
+            zinfo.flag_bits = srcinfo.flag_bits & 0x800
+        zinfo.compress_type = srcinfo.compress_type
+        zinfo.CRC = srcinfo.CRC
+        zinfo.file_size = srcinfo.file_size
+        self.writeraw(zinfo, bytes)
+
     def __del__(self):
         """Call the "close()" method in case the user forgot."""
         self.close()
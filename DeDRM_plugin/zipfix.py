@@ -11,6 +11,7 @@
 #   1.0 - Initial release
 #   1.1 - Updated to handle zip file metadata correctly
 #   2.0 - Python 3 for calibre 5.0
+#   2.1 - Split out the reading side so it can be used without rewriting the file
 
 """
 Re-write zip (or ePub) fixing problems with file names (and mimetype entry).
@@ -43,13 +44,9 @@ class ZipInfo(zipfilerugged.ZipInfo):
         super(ZipInfo, self).__init__(*args, **kwargs)
         self.compress_type = compress_type
 
-class fixZip:
-    def __init__(self, zinput, zoutput):
-        self.ztype = 'zip'
-        if zinput.lower().find('.epub') >= 0 :
-            self.ztype = 'epub'
+class readZip:
+    def __init__(self, zinput):
         self.inzip = zipfilerugged.ZipFile(zinput,'r')
-        self.outzip = zipfilerugged.ZipFile(zoutput,'w')
         # open the input zip for reading only as a raw file
         self.bzf = open(zinput,'rb')
 
@@ -107,7 +104,34 @@ class fixZip:
 
         return data
 
+    def readmember(self, zinfo):
+        # returns the (possibly corrected) file name and the file data.
+        # if the local and central file names don't match, trust the local one
+        try:
+            return zinfo.filename, self.inzip.read(zinfo.filename)
+        except zipfilerugged.BadZipfile or zipfilerugged.error:
+            return self.getlocalname(zinfo), self.getfiledata(zinfo)
+
+    def needsfix(self):
+        # cheap check (no decompression) whether any member has a local
+        # file name that differs from the one in the central directory
+        for zinfo in self.inzip.infolist():
+            if self.getlocalname(zinfo) != zinfo.orig_filename:
+                return True
+        return False
+
+    def close(self):
+        self.bzf.close()
+        self.inzip.close()
+
 
+class fixZip(readZip):
+    def __init__(self, zinput, zoutput):
+        super(fixZip, self).__init__(zinput)
+        self.ztype = 'zip'
+        if zinput.lower().find('.epub') >= 0 :
+            self.ztype = 'epub'
+        self.outzip = zipfilerugged.ZipFile(zoutput,'w')
 
     def fix(self):
         # get the zipinfo for each member of the input archive
@@ -136,13 +160,7 @@ class fixZip:
         # write the rest of the files
         for zinfo in self.inzip.infolist():
             if zinfo.filename != b"mimetype" or self.ztype != 'epub':
-                data = None
-                try:
-                    data = self.inzip.read(zinfo.filename)
-                except zipfilerugged.BadZipfile or zipfilerugged.error:
-                    local_name = self.getlocalname(zinfo)
-                    data = self.getfiledata(zinfo)
-                    zinfo.filename = local_name
+                zinfo.filename, data = self.readmember(zinfo)
 
                 # create new ZipInfo with only the useful attributes from the old info
                 nzinfo = ZipInfo(zinfo.filename, zinfo.date_time, compress_type=zinfo.compress_type)
@@ -154,8 +172,7 @@ class fixZip:
                 nzinfo.flag_bits = zinfo.flag_bits & 0x800  # preserve UTF-8 flag
                 self.outzip.writestr(nzinfo,data)
 
-        self.bzf.close()
-        self.inzip.close()
+        self.close()
         self.outzip.close()
 
 
@@ -166,6 +183,18 @@ def usage():
     """)
 
 
+def needsRepair(infile):
+    # Returns True if the archive can't be read as-is by the other scripts.
+    try:
+        zr = readZip(infile)
+        try:
+            return zr.needsfix()
+        finally:
+            zr.close()
+    except:
+        return True
+
+
 def repairBook(infile, outfile):
     if not os.path.exists(infile):
         print("Error: Input Zip File does not exist")